@@ -1,29 +1,39 @@
 
 # Import necessary modules
-import geopandas as gpd
-import json
 import dash
 from dash import html, dcc, register_page, callback
 from dash.dependencies import Output, Input, State
 import plotly.graph_objects as go
+import gzip
 import os
-import requests
 import pandas as pd
-import fetch_fleet_data
-import fetch_trip_data
+import live_stream
+import data_plane
+import route_shapes
+import eta_engine
+import route_index
+import arrivals
+import departure_boards
+import on_time
+import stop_events
+import interpolation
+import journey_planner
+import linear_referencing
+import freshness
+import profiling
+import fleet_map
+import headways
+import realtime_cache
+import static_dataset
+import timetables
 from datetime import datetime, date
 from dash import callback_context, no_update
 from zoneinfo import ZoneInfo
 from urllib.parse import parse_qs, urlparse
-from flask import Flask, Response
-import glob
+from flask import Flask, Response, request, send_from_directory
 from zoneinfo import ZoneInfo
 import numpy as np
 
-# Fallback data from the last run of the Github Actions Workflow
-bus_updates = "https://raw.githubusercontent.com/CP8714/BC_Transit_tracker/refs/heads/main/data/bus_updates.json"
-trip_updates = "https://raw.githubusercontent.com/CP8714/BC_Transit_tracker/refs/heads/main/data/trip_updates.json"
-
 page_flags = {
     "bus_tracker": False,
     "next_buses": False
@@ -43,6 +53,179 @@ def sitemap():
     </urlset>"""
     return Response(xml, mimetype="application/xml")
 
+# Server-sent event stream pushing the position and ETAs of running buses whenever the realtime data changes.
+# Clients can optionally filter by bus, route, or stop with comma separated values e.g. /stream/vehicles?route=6,6A&stop=100032
+# Every open stream holds a worker thread, so a worker already serving live_stream.max_clients streams turns new clients away
+@server.route("/stream/vehicles")
+def stream_vehicles():
+    if not live_stream.open_stream():
+        return Response("Too many live streams, try again later", status=503, mimetype="text/plain",
+                        headers={"Retry-After": str(live_stream.retry_after_seconds)})
+    bus_numbers = {value for value in request.args.get("bus", "").split(",") if value}
+    route_numbers = {value.split("-")[0] for value in request.args.get("route", "").split(",") if value}
+    stop_ids = {value for value in request.args.get("stop", "").split(",") if value}
+    response = Response(
+        live_stream.stream_vehicle_events(bus_numbers, route_numbers, stop_ids),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # Called by the WSGI server once the client disconnects, even if the stream never started
+    response.call_on_close(live_stream.close_stream)
+    return response
+
+# Upcoming arrivals at several stops at once, e.g. every bay of an exchange or every stop shown on a display wall
+# e.g. /api/arrivals?stop=100002,100003&route=6&variants=1&limit=10&merge=1
+@server.route("/api/arrivals")
+def api_arrivals():
+    stop_ids = [value for value in request.args.get("stop", "").split(",") if value.isdigit()]
+    route_numbers = [value for value in request.args.get("route", "").split(",") if value]
+    include_variants = request.args.get("variants") == "1"
+    merge = request.args.get("merge") == "1"
+    limit = min(int(request.args.get("limit", "10")) if request.args.get("limit", "10").isdigit() else 10, 100)
+    service_id_list = [np.int64(x) for x in get_service_id()]
+    next_arrivals = departure_boards.get_departures(stop_ids, service_id_list, load_buses(), load_current_trips(), route_numbers, include_variants, limit, merge)
+    return arrivals.arrivals_to_json(next_arrivals, merge)
+
+# Position of a bus dead-reckoned from its last reported position, speed, and current trip, e.g. /api/vehicles/interpolated?bus=9541
+@server.route("/api/vehicles/interpolated")
+def api_interpolated_vehicle():
+    motion = interpolation.get_motion_model(load_buses(), load_current_trips(), request.args.get("bus", ""))
+    if motion is None:
+        return {"error": "bus is not running"}, 404
+    return interpolation.get_model_position(motion)
+
+# Earliest arrival journey between two stops leaving now or at a given time today, using the realtime estimates unless realtime=0
+# e.g. /api/journey?from=100002&to=100032&time=14:30&realtime=1
+@server.route("/api/journey")
+def api_journey():
+    origin = request.args.get("from", "")
+    destination = request.args.get("to", "")
+    if not origin.isdigit() or not destination.isdigit():
+        return {"error": "from and to must be stop ids"}, 400
+    departure_time = None
+    if request.args.get("time"):
+        try:
+            hours, minutes = request.args["time"].split(":")
+            departure_time = int(hours) * 3600 + int(minutes) * 60
+        except ValueError:
+            return {"error": "time must be HH:MM"}, 400
+    service_id_list = [np.int64(x) for x in get_service_id()]
+    try:
+        journey = journey_planner.plan_journey(origin, destination, service_id_list, load_buses(), load_current_trips(),
+                                               departure_time, request.args.get("realtime") != "0")
+    except KeyError:
+        return {"error": "stop does not exist"}, 404
+    if journey is None:
+        return {"error": "no journey found"}, 404
+    return journey
+
+# Freshness lags of every stage of the realtime data rendered by this worker and its alarms, along with the stage times of the data
+# currently served. Only reads the metrics, so monitors can poll it without counting as renders
+@server.route("/api/freshness")
+def api_freshness():
+    freshness_metrics = freshness.get_metrics()
+    freshness_metrics["current"] = freshness.get_trace(load_buses())
+    return freshness_metrics
+
+# Actual arrival, departure, and passed events of a service day at some stops, on some routes, or of some trips, for reliability reports
+# e.g. /api/events?date=20260901&stop=100002,100003&route=6-VIC
+@server.route("/api/events")
+def api_events():
+    service_date = request.args.get("date", datetime.now(ZoneInfo(on_time.service_timezone)).strftime("%Y%m%d"))
+    if not service_date.isdigit() or len(service_date) != 8:
+        return {"error": "date must be YYYYMMDD"}, 400
+    events_df = stop_events.load_events(service_date)
+    stop_ids = [int(value) for value in request.args.get("stop", "").split(",") if value.isdigit()]
+    if stop_ids:
+        events_df = events_df[events_df["stop_id"].isin(stop_ids)]
+    for column, argument in [("route_id", "route"), ("trip_id", "trip")]:
+        values = [value for value in request.args.get(argument, "").split(",") if value]
+        if values:
+            events_df = events_df[events_df[column].isin(values)]
+    return {"date": service_date, "events": events_df.to_dict("records")}
+
+# Scheduled timetable of a stop on a service day, prebuilt after every static ingest and cached by browsers and CDNs
+# e.g. /timetables/20260901/100032.json
+@server.route("/timetables/<service_date>/<int:stop_id>.json")
+def timetable(service_date, stop_id):
+    content, version = timetables.get_timetable(service_date, stop_id)
+    if content is None:
+        return {"error": f"no timetable for stop {stop_id} on {service_date}"}, 404
+    # A written timetable is revalidated with its version once it is cache_seconds old, and one computed on the spot isn't kept.
+    # The ETag is weak since the same version is sent gzipped or not
+    headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if version is not None:
+        headers.update({"Cache-Control": f"public, max-age={timetables.cache_seconds}", "ETag": f'W/"{version}"'})
+        if request.if_none_match.contains_weak(version):
+            return Response(status=304, headers=headers)
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+    else:
+        content = gzip.decompress(content)
+    return Response(content, mimetype="application/json", headers=headers)
+
+# Markers of the fleet map inside a viewport, for clients drawing their own map
+# e.g. /api/fleet?south=48.40&west=-123.45&north=48.47&east=-123.33&zoom=12&color=delay
+@server.route("/api/fleet")
+def api_fleet():
+    view = fleet_map.get_view({}, None)
+    bounds = view["bounds"]
+    try:
+        bounds = {edge: float(request.args.get(edge, bounds[edge])) for edge in ["south", "west", "north", "east"]}
+        zoom = float(request.args.get("zoom", view["zoom"]))
+    except ValueError:
+        return {"error": "south, west, north, east, and zoom must be numbers"}, 400
+    index = fleet_map.get_fleet_index(load_buses(), load_current_trips(), get_service_id())
+    return fleet_map.get_fleet_markers(index, bounds, zoom, request.args.get("color", "route"))
+
+# Headways of every route and direction with the buses which are bunched or behind a gap, for monitoring
+# e.g. /api/headways?route=6 or /api/headways?route=6,14-VIC
+@server.route("/api/headways")
+def api_headways():
+    route_headways = headways.get_route_headways(load_buses(), load_current_trips())
+    routes = [value for value in request.args.get("route", "").split(",") if value]
+    if routes:
+        # Routes are selected by route number like everywhere else on the site, or by their full route id
+        route_headways["routes"] = [route for route in route_headways["routes"] if route["route"] in routes or route["route"].split("-")[0] in routes]
+    return route_headways
+
+# Profiles a request sent with the profiling token in the X-Profile header, and returns the name of its profile file in that header
+@server.before_request
+def start_request_profile():
+    profiling.start_request_profile(request.headers.get(profiling.profile_header), request.path)
+
+@server.after_request
+def stop_request_profile(response):
+    profile_file = profiling.stop_request_profile()
+    if profile_file:
+        response.headers[profiling.profile_header] = profile_file
+    return response
+
+# A request failing before after_request is called still stops being profiled
+@server.teardown_request
+def teardown_request_profile(error):
+    profiling.stop_request_profile()
+
+# Starts, snapshots, or stops tracemalloc in the worker answering the request, which only works with the profiling token
+# e.g. /debug/tracemalloc?action=snapshot with the X-Profile header
+@server.route("/debug/tracemalloc")
+def debug_tracemalloc():
+    if not profiling.is_authorized(request.headers.get(profiling.profile_header)):
+        return {"error": "not found"}, 404
+    result = profiling.run_tracemalloc(request.args.get("action", "snapshot"))
+    return result, 400 if "error" in result else 200
+
+# Profiles and tracemalloc snapshots written to disk, from newest to oldest, or the content of one of them
+# e.g. /debug/profiles or /debug/profiles/20261019-101500-update_stop_callback-84ms-12.collapsed with the X-Profile header
+@server.route("/debug/profiles")
+@server.route("/debug/profiles/<file_name>")
+def debug_profiles(file_name=None):
+    if not profiling.is_authorized(request.headers.get(profiling.profile_header)):
+        return {"error": "not found"}, 404
+    if file_name is None:
+        return {"profiles": profiling.list_profiles()}
+    return send_from_directory(os.path.abspath(profiling.profile_dir), file_name, mimetype="text/plain")
+
 app = dash.Dash(
     __name__, 
     server=server, 
@@ -60,6 +243,9 @@ home_layout = html.Div([
             dcc.Link("Home", href="/", className="nav-link"),
             dcc.Link("Bus Tracker", href="/bus_tracker", className="nav-link"),
             dcc.Link("Next Buses", href="/next_buses", className="nav-link"),
+            dcc.Link("On-Time Performance", href="/on_time", className="nav-link"),
+            dcc.Link("Fleet Map", href="/fleet_map", className="nav-link"),
+            dcc.Link("Headways", href="/headways", className="nav-link"),
         ]
     ),
     html.H1("Welcome to BCTVicTracker"),
@@ -106,6 +292,9 @@ bus_tracker_layout = html.Div([
             dcc.Link("Home", href="/", className="nav-link"),
             dcc.Link("Bus Tracker", href="/bus_tracker", className="nav-link"),
             dcc.Link("Next Buses", href="/next_buses", className="nav-link"),
+            dcc.Link("On-Time Performance", href="/on_time", className="nav-link"),
+            dcc.Link("Fleet Map", href="/fleet_map", className="nav-link"),
+            dcc.Link("Headways", href="/headways", className="nav-link"),
         ]
     ),
     html.H2("Bus Tracker Page", className="h2-bus-page-title"),
@@ -184,6 +373,20 @@ bus_tracker_layout = html.Div([
         interval=60*10000,
         n_intervals=0
     ),
+
+    # Interval moving the bus marker to its dead-reckoned position between refreshes in the browser, interval checking for the motion
+    # model of the next realtime snapshot, and the motion model of the bus currently shown on the map
+    dcc.Interval(
+        id="interpolation-interval",
+        interval=1000,
+        n_intervals=0
+    ),
+    dcc.Interval(
+        id="motion-interval",
+        interval=data_plane.realtime_refresh_seconds*1000,
+        n_intervals=0
+    ),
+    dcc.Store(id="tracked-bus"),
     
 ])
 
@@ -197,6 +400,9 @@ next_buses_layout = html.Div([
             dcc.Link("Home", href="/", className="nav-link"),
             dcc.Link("Bus Tracker", href="/bus_tracker", className="nav-link"),
             dcc.Link("Next Buses", href="/next_buses", className="nav-link"),
+            dcc.Link("On-Time Performance", href="/on_time", className="nav-link"),
+            dcc.Link("Fleet Map", href="/fleet_map", className="nav-link"),
+            dcc.Link("Headways", href="/headways", className="nav-link"),
         ]
     ),
 
@@ -270,38 +476,159 @@ next_buses_layout = html.Div([
     ),
 ])
 
+# Layout of the on-time performance page where users can see how early/late buses have been by route, hour, and stop
+on_time_layout = html.Div([
+    # Navbar which appears on the top of every page and has links to every page
+    html.Div(
+        className="navbar",
+        children=[
+            dcc.Link("Home", href="/", className="nav-link"),
+            dcc.Link("Bus Tracker", href="/bus_tracker", className="nav-link"),
+            dcc.Link("Next Buses", href="/next_buses", className="nav-link"),
+            dcc.Link("On-Time Performance", href="/on_time", className="nav-link"),
+            dcc.Link("Fleet Map", href="/fleet_map", className="nav-link"),
+            dcc.Link("Headways", href="/headways", className="nav-link"),
+        ]
+    ),
+
+    html.H1("On-Time Performance Page"),
+
+    html.H4(f"This is the On-Time Performance Page where you can see how many stops were served early (more than {-on_time.early_threshold_seconds // 60} minute early), on time, or late (more than {on_time.late_threshold_seconds // 60} minutes late) for every route, direction, and hour of the day.", className="h4-stop-page-instruction"),
+
+    html.Div([
+        dcc.Loading(
+            id="loading-component-on-time",
+            type="circle",
+            children=[
+                html.Div(
+                    # Dropdown where the user selects which service day they want to see
+                    dcc.Dropdown(
+                        id="on-time-date-dropdown",
+                        className="next-buses-dropdown",
+                        options=[],
+                        placeholder="Select a day (defaults to today)",
+                        searchable=False
+                    ),
+                ),
+                html.Div(id="on-time-output"),
+            ]
+        )
+    ]),
+
+    # Auto-refresh interval
+    dcc.Interval(
+        id="on-time-interval-component",
+        interval=60*1000,
+        n_intervals=0
+    ),
+])
+
+# Layout of the fleet map page where users can see every bus currently running on a single map
+fleet_map_layout = html.Div([
+    # Navbar which appears on the top of every page and has links to every page
+    html.Div(
+        className="navbar",
+        children=[
+            dcc.Link("Home", href="/", className="nav-link"),
+            dcc.Link("Bus Tracker", href="/bus_tracker", className="nav-link"),
+            dcc.Link("Next Buses", href="/next_buses", className="nav-link"),
+            dcc.Link("On-Time Performance", href="/on_time", className="nav-link"),
+            dcc.Link("Fleet Map", href="/fleet_map", className="nav-link"),
+            dcc.Link("Headways", href="/headways", className="nav-link"),
+        ]
+    ),
+
+    html.H1("Fleet Map Page"),
+
+    html.H4("This is the Fleet Map Page where you can see every bus currently running. Zoom in to see individual buses and hover over a bus to see the route it is running and how early or late it is.", className="h4-stop-page-instruction"),
+
+    html.Div([
+        # Radio buttons where the user selects whether buses are coloured by route or by how early or late they are
+        dcc.RadioItems(
+            id="fleet-color-by",
+            options=[
+                {"label": "Colour by route", "value": "route"},
+                {"label": "Colour by delay (orange: early, green: on time, red: late, grey: unknown)", "value": "delay"},
+            ],
+            value="route",
+            inline=True
+        ),
+        html.H3(id="fleet-map-text"),
+        html.Div(
+            dcc.Graph(
+                id="fleet-map",
+                style={"height": f"{fleet_map.default_map_size[1]}px"}
+            ),
+            className="map-container"
+        ),
+    ]),
+
+    # Auto-refresh interval
+    dcc.Interval(
+        id="fleet-interval-component",
+        interval=15*1000,
+        n_intervals=0
+    ),
+    # View of the map and markers last sent to the browser, used to only send what changed
+    dcc.Store(id="fleet-map-state"),
+])
+
+# Layout of the headways page where users can see which buses are bunched together or running behind a gap in service
+headways_layout = html.Div([
+    # Navbar which appears on the top of every page and has links to every page
+    html.Div(
+        className="navbar",
+        children=[
+            dcc.Link("Home", href="/", className="nav-link"),
+            dcc.Link("Bus Tracker", href="/bus_tracker", className="nav-link"),
+            dcc.Link("Next Buses", href="/next_buses", className="nav-link"),
+            dcc.Link("On-Time Performance", href="/on_time", className="nav-link"),
+            dcc.Link("Fleet Map", href="/fleet_map", className="nav-link"),
+            dcc.Link("Headways", href="/headways", className="nav-link"),
+        ]
+    ),
+
+    html.H1("Headways Page"),
+
+    html.H4(f"This is the Headways Page where you can see how far apart the buses of every route are. A bus is bunched when it is less than {headways.bunched_ratio:.0%} of its scheduled headway behind the bus ahead, and behind a gap when it is more than {headways.gap_ratio:g} times its scheduled headway behind.", className="h4-stop-page-instruction"),
+
+    html.Div(id="headways-output"),
+
+    # Auto-refresh interval
+    dcc.Interval(
+        id="headways-interval-component",
+        interval=30*1000,
+        n_intervals=0
+    ),
+])
+
 # --- Helper functions ---
 # Returns dictionary containing data from bus_updates.json, the realtime update file for buses
 def load_buses():
-    """Load latest bus_updates.json safely."""
-    data_file = os.path.join("data", "bus_updates.json")
-    if os.path.exists(data_file):
-        with open(data_file, "r") as f:
-            return json.load(f)
-    # fallback to GitHub JSON if file missing
-    try:
-        response = requests.get(bus_updates, timeout=10)
-        return response.json()
-    except:
-        return []
+    """Load the last good snapshot of bus_updates.json without waiting on BC Transit or GitHub."""
+    return realtime_cache.load_snapshot("bus_updates")
 
 # Returns dictionary containing data trip_updates.json, the realtime update file for trips
 def load_current_trips():
-    data_file = os.path.join("data", "trip_updates.json")
-    if os.path.exists(data_file):
-        with open(data_file, "r") as f:
-            return json.load(f)
-    try:
-        response = requests.get(trip_updates, timeout=10)
-        return response.json()
-    except:
-        return []
+    return realtime_cache.load_snapshot("trip_updates")
+
+# Returns a warning stating the age of the realtime data if it is stale, or an empty string otherwise
+def get_staleness_text(buses):
+    age = realtime_cache.get_snapshot_age(buses)
+    if age is None or age < realtime_cache.stale_after_seconds:
+        return ""
+    if age < 7200:
+        return f"Realtime data is {int(age // 60)} minutes old as BC Transit's data is currently unavailable"
+    return f"Realtime data is over {int(age // 3600)} hours old as BC Transit's data is currently unavailable"
 
 # Returns the service_ids for today denoting which trips are being run today
 def get_service_id():
-    calendar_file = os.path.join("data", "calendar_dates.csv")
-    if os.path.exists(calendar_file):
+    calendar_file = static_dataset.get_static_file("calendar_dates")
+    calendar_dates = data_plane.load_table("calendar_dates")
+    if calendar_dates is None and os.path.exists(calendar_file):
         calendar_dates = pd.read_csv(calendar_file, dtype=str)
+    if calendar_dates is not None:
+        calendar_dates = calendar_dates.astype(str)
         today = date.today().strftime("%Y%m%d")
         today_service_ids = calendar_dates.loc[calendar_dates["date"] == today]
         service_id_list = today_service_ids["service_id"]  
@@ -309,30 +636,42 @@ def get_service_id():
 
 # Returns dataframe of trips.csv, the static file containing info on all trips
 def load_trips():
-    trips_file = os.path.join("data", "trips.csv")
+    trips_df = data_plane.load_table("trips")
+    if trips_df is not None:
+        return trips_df
+    trips_file = static_dataset.get_static_file("trips")
     if os.path.exists(trips_file):
         trips_df = pd.read_csv(trips_file)
         return trips_df
 
 # Returns dataframe of stops.csv, the static file containing info on all stops
 def load_stops():
-    stops_file = os.path.join("data", "stops.csv")
+    stops_df = data_plane.load_table("stops")
+    if stops_df is not None:
+        return stops_df
+    stops_file = static_dataset.get_static_file("stops")
     if os.path.exists(stops_file):
         stops_df = pd.read_csv(stops_file)
         return stops_df
 
 # Returns dataframe of routes.csv, the static file containing info on all routes
 def load_routes():
-    routes_file = os.path.join("data", "routes.csv")
+    routes_df = data_plane.load_table("routes")
+    if routes_df is not None:
+        return routes_df
+    routes_file = static_dataset.get_static_file("routes")
     if os.path.exists(routes_file):
         routes_df = pd.read_csv(routes_file)
         return routes_df
 
 # Finds all the stops that are served by at current_trip_id and returns a dataframe containing them along with all other info from stop_times.csv
 def load_stop_times(current_trip_id):
+    stop_times_df = data_plane.load_trip_stop_times(current_trip_id)
+    if stop_times_df is not None:
+        return stop_times_df
     stop_times_list = []
 
-    for file in sorted(glob.glob(os.path.join("data", "stop_times_part_*.csv"))):
+    for file in static_dataset.get_stop_times_files():
         stop_times_chunks = pd.read_csv(file, chunksize=10000)
         for stop_times_chunk in stop_times_chunks:
             current_trip_stops = stop_times_chunk[stop_times_chunk["trip_id"] == current_trip_id]
@@ -359,38 +698,17 @@ def get_capacity(capacity):
         capacity_text = "Occupancy Status: Full"
     return capacity_text
 
-# Gets all the scheduled arrival times for a specific stop for today by searching for them in the stop_time_part_0, 1, etc csv files and returning a dataframe
-# ----------------------------------------------------------------------------------
-# current_stop_id is the id for the stop that the user wants to see the next arrivals
-# today_trips_df is a dataframe containing all the trips being run today
-# ----------------------------------------------------------------------------------
-def load_today_scheduled_bus_times(current_stop_id, today_trips_df):
-    today_trip_ids = set(today_trips_df["trip_id"].unique())
-    current_stop_id = int(current_stop_id)
-    current_stop_id = np.int64(current_stop_id)
-    
-    bus_times_df_list = []
-    for file in sorted(glob.glob(os.path.join("data", "stop_times_part_*.csv"))):
-        bus_times_chunks = pd.read_csv(file, chunksize=10000)
-        for bus_times_chunk in bus_times_chunks:
-            next_buses = bus_times_chunk[bus_times_chunk["stop_id"] == current_stop_id]
-            if not next_buses.empty:
-                today_next_buses = next_buses[next_buses["trip_id"].isin(today_trip_ids)]
-                if not today_next_buses.empty:
-                    bus_times_df_list.append(today_next_buses)
-
-    if bus_times_df_list:
-        return pd.concat(bus_times_df_list, ignore_index=True) 
-    return pd.DataFrame()
-
 # Loads all the stop times of the first stop for all the trips in trip_ids
 # ----------------------------------------------------------------------------------
 # trips_ids is a list of trip ids that a specific bus is running
 # ----------------------------------------------------------------------------------
 def load_block_departure_times(trip_ids):
+    departure_times_df = data_plane.load_first_departures(trip_ids)
+    if departure_times_df is not None:
+        return departure_times_df
     departure_times_list = []
 
-    for file in sorted(glob.glob(os.path.join("data", "stop_times_part_*.csv"))):
+    for file in static_dataset.get_stop_times_files():
         departure_times_chunks = pd.read_csv(file, chunksize=10000, usecols=["trip_id", "stop_sequence", "departure_time"])
         for departure_times_chunk in departure_times_chunks:
             departure_times = departure_times_chunk[departure_times_chunk["trip_id"].isin(trip_ids) & (departure_times_chunk["stop_sequence"] == 1)]
@@ -403,7 +721,7 @@ def load_block_departure_times(trip_ids):
 
 # Makes a table with the estimated next arrival times, the route, and bus from the dictionaries in next_buses
 # ----------------------------------------------------------------------------------
-# next_buses which is a list of dictonaries, each containing the estimated next arrival times, the route, and bus
+# next_buses which is a list of dictonaries, each containing the estimated next arrival times, the route, the bus, and how far away the bus is
 # ----------------------------------------------------------------------------------
 def make_next_buses_table(next_buses):
     return html.Table([
@@ -411,6 +729,7 @@ def make_next_buses_table(next_buses):
             html.Th("Estimated Arrival Time", style={"border": "1px solid black"}),
             html.Th("Trip Headsign", style={"border": "1px solid black"}),
             html.Th("Assigned Bus", style={"border": "1px solid black"}),
+            html.Th("Distance Away", style={"border": "1px solid black"}),
         ])),
         html.Tbody([
             html.Tr([
@@ -421,7 +740,8 @@ def make_next_buses_table(next_buses):
                     html.A(bus["bus"], href=f"/bus_tracker?bus={bus['bus'][:4]}", style={"textDecoration": "none", "color": "blue"})
                     if bus["bus"] != "Unknown" else bus["bus"],
                     style={"border": "1px solid black", "textAlign": "center"}
-                )
+                ),
+                html.Td(bus["distance"], style={"border": "1px solid black", "textAlign": "center"}),
             ])
             for bus in next_buses
         ])
@@ -434,14 +754,13 @@ def make_next_buses_table(next_buses):
 # stop_number_input is the stop number selected by the user
 # route_number_input is the route number selected by the user
 # stops_df dataframe containing all the data from stops.json
-# trips_df dataframe containing all the data from trips.json
 # current_trips dictionary containing all the realtime data from trip_updates.json
 # buses is the dictionary containing all the realtime data from bus_updates.json
 # toggle_future_buses_clicks is the number of times the "Show Up To Next 10 Buses"/"Show Up To Next 20 Buses" button has been clicked
 # include_variants is the value determining if the user wants to include variants of the selected route or not
+# service_id_list is the list of service ids running today
 # ----------------------------------------------------------------------------------
-def get_next_buses(stop_number_input, route_number_input, stops_df, trips_df, current_trips, buses, toggle_future_buses_clicks, include_variants, today_trips_df):
-    next_buses = []
+def get_next_buses(stop_number_input, route_number_input, stops_df, current_trips, buses, toggle_future_buses_clicks, include_variants, service_id_list):
     # If no stop number is selected, return the following line of text
     if not stop_number_input:
         return html.Div("Please Select A Stop")
@@ -477,155 +796,42 @@ def get_next_buses(stop_number_input, route_number_input, stops_df, trips_df, cu
     
     stop_name_text = f"Next Estimated Arrivals At Stop {stop_number_input:d} ({stop_name}), (Click on a bus number to see info about that specific bus)"
 
-    stop_number_input = str(stop_number_input)
-    # Get current time to determine the next arrivals
-    current_time = int(datetime.now().timestamp())
-
-
-    current_pst = datetime.now(ZoneInfo("America/Los_Angeles"))
-    current_pst_hms = current_pst.strftime("%H:%M:%S")
-    today_all_arrival_times = load_today_scheduled_bus_times(stop_number_input, today_trips_df)
-    # Filter the next trips arriving based on the current time
-    upcoming_arrival_times = [bus for _, bus in today_all_arrival_times.iterrows() if bus["arrival_time"] >= current_pst_hms]
+    # If a route is selected, only show its arrivals, and those of every route in the same family (e.g. 6A and 6B for the 6) if the
+    # user wants to include variants
+    route_numbers = None
+    variants_included = bool(include_variants) and include_variants[0] == "include_variants"
     if route_number_input:
-        route_number_input = str(route_number_input)
-        # If the user wants to include variants, include any trips for that route number which also ends with A, B, N, or X
-        if include_variants:
-            if include_variants[0] == "include_variants":
-                route_variants = [f"{route_number_input}-VIC", f"{route_number_input}A-VIC", f"{route_number_input}B-VIC", f"{route_number_input}N-VIC", f"{route_number_input}X-VIC"]
-                all_variant_trips = trips_df[trips_df["route_id"].isin(route_variants)]
-                upcoming_trip_ids = {bus.trip_id for bus in upcoming_arrival_times}
-                all_variant_trips_ids = set(all_variant_trips["trip_id"])
-                valid_trip_ids = all_variant_trips_ids & upcoming_trip_ids
-                upcoming_arrival_times = today_all_arrival_times[today_all_arrival_times["trip_id"].isin(valid_trip_ids)]
-                upcoming_arrival_times = upcoming_arrival_times.sort_values("arrival_time")
-        else:
-            route_number_input = f"{route_number_input}-VIC"
-            all_route_trip_ids = set(trips_df.loc[trips_df["route_id"] == route_number_input, "trip_id"])
-            upcoming_trip_ids = {bus.trip_id for bus in upcoming_arrival_times}
-            valid_trip_ids = all_route_trip_ids & upcoming_trip_ids
-            upcoming_arrival_times = today_all_arrival_times[today_all_arrival_times["trip_id"].isin(valid_trip_ids)]
-            upcoming_arrival_times = upcoming_arrival_times.sort_values("arrival_time")
-
-        route_number_input = route_number_input.split('-')[0] 
+        route_numbers = [str(route_number_input)]
         stop_name_text = f"Next Estimated Arrivals For Route {route_number_input} At Stop {stop_number_input} ({stop_name}), (Click on a bus number to see info about that specific bus)"
 
-    else:    
-        upcoming_arrival_times = sorted(upcoming_arrival_times, key=lambda x: x["arrival_time"])
-        
-
-    # Show only the next 10 arrivals if the "Show Up To Next 10 Buses"/"Show Up To Next 20 Buses" button has not been pressed or been pressed an even amount of times
-    if toggle_future_buses_clicks % 2 == 0:
-        upcoming_arrival_times = upcoming_arrival_times[:10]
-    # Show the next 20 arrivals if the Show Up To Next 10 Buses/Show Up To Next 20 Buses button has been pressed an odd amount of times
-    else:
-        upcoming_arrival_times = upcoming_arrival_times[:20]
+    # Show only the next 10 arrivals if the "Show Up To Next 10 Buses"/"Show Up To Next 20 Buses" button has not been pressed or been pressed
+    # an even amount of times, and the next 20 arrivals otherwise
+    limit = 10 if toggle_future_buses_clicks % 2 == 0 else 20
 
-    # Search up which bus is running each of the next trips in upcoming_arrival_times
-    bus_lat_list = []
-    bus_lon_list = []
-    bus_number_list = []
-    added_trips = []
-    if route_number_input:
-        for _, bus in upcoming_arrival_times.iterrows():
-            scheduled = False
-            current_bus = next((b for b in buses if b["trip_id"] == bus["trip_id"]), None)
-            # If there is no bus currently running that trip, check the blocks to see if one is scheduled. If not, set bus_number to "Unknown"
-            if not current_bus:
-                bus_number = "Unknown"
-                current_trip = trips_df[trips_df["trip_id"] == bus["trip_id"]]
-                if not current_trip.empty:
-                    current_trip = current_trip.iloc[0]
-                    block = current_trip["block_id"]
-                    full_block = trips_df[trips_df["block_id"] == block]
-                    for _, row in full_block.iterrows():
-                        current_bus = next((b for b in buses if b["trip_id"] == row["trip_id"]), None)
-                        if current_bus:
-                            # The bus number is only the final four digits of the its id
-                            bus_number = current_bus["id"]
-                            bus_number = bus_number[-4:]
-                            scheduled = True
-                            break
-            else:
-                # The bus number is only the final four digits of the its id
-                bus_number = current_bus["id"]
-                bus_number = bus_number[-4:]
-                bus_lat_list.append(current_bus["lat"])
-                bus_lon_list.append(current_bus["lon"])
-                bus_number_list.append(bus_number)
-            next_bus = trips_df[trips_df["trip_id"] == bus["trip_id"]]
-            if not next_bus.empty and bus["trip_id"] not in added_trips:
-                added_trips.append(bus["trip_id"])
-                next_bus = next_bus.iloc[0]
-                route = next_bus["route_id"]
-                route_number = route.split('-')[0] 
-                headsign = next_bus["trip_headsign"]
-                # Removing seconds from the arrival time
-                arrival_time = bus["arrival_time"]
-                arrival_time = arrival_time[:5]
-                if scheduled:
-                    next_buses.append({
-                        "arrival_time": arrival_time,
-                        "trip_headsign": f"{route_number} {headsign}",
-                        "bus": f"{bus_number} (Scheduled)"
-                    })
-                else:
-                    next_buses.append({
-                        "arrival_time": arrival_time,
-                        "trip_headsign": f"{route_number} {headsign}",
-                        "bus": f"{bus_number}"
-                    })
-    else:
-        for bus in upcoming_arrival_times:
-            scheduled = False
-            current_bus = next((b for b in buses if b["trip_id"] == bus["trip_id"]), None)
-            # If there is no bus currently running that trip, check the blocks to see if one is scheduled. If not, set bus_number to "Unknown"
-            if not current_bus:
-                bus_number = "Unknown"
-                current_trip = trips_df[trips_df["trip_id"] == bus["trip_id"]]
-                if not current_trip.empty:
-                    current_trip = current_trip.iloc[0]
-                    block = current_trip["block_id"]
-                    full_block = trips_df[trips_df["block_id"] == block]
-                    for _, row in full_block.iterrows():
-                        current_bus = next((b for b in buses if b["trip_id"] == row["trip_id"]), None)
-                        if current_bus:
-                            # The bus number is only the final four digits of the its id
-                            bus_number = current_bus["id"]
-                            bus_number = bus_number[-4:]
-                            scheduled = True
-                            break
-            else:
-                # The bus number is only the final four digits of the its id
-                bus_number = current_bus["id"]
-                bus_number = bus_number[-4:]
-                bus_lat_list.append(current_bus["lat"])
-                bus_lon_list.append(current_bus["lon"])
-                bus_number_list.append(bus_number)
-            next_bus = trips_df[trips_df["trip_id"] == bus["trip_id"]]
-            if not next_bus.empty and bus["trip_id"] not in added_trips:
-                added_trips.append(bus["trip_id"])
-                next_bus = next_bus.iloc[0]
-                route = next_bus["route_id"]
-                route_number = route.split('-')[0] 
-                headsign = next_bus["trip_headsign"]
-                
-                # Removing seconds from the arrival time
-                arrival_time = bus["arrival_time"]
-                arrival_time = arrival_time[:5]
-                if scheduled:
-                    next_buses.append({
-                        "arrival_time": arrival_time,
-                        "trip_headsign": f"{route_number} {headsign}",
-                        "bus": f"{bus_number} (Scheduled)"
-                    })
-                else:
-                    next_buses.append({
-                        "arrival_time": arrival_time,
-                        "trip_headsign": f"{route_number} {headsign}",
-                        "bus": f"{bus_number}"
-                    })
-                
+    # The next arrivals with their estimated times, trip attributes and assigned buses all come from the arrivals engine, so they are
+    # only formatted here
+    next_arrivals = departure_boards.get_departures([stop_number_input], service_id_list, buses, current_trips, route_numbers, variants_included, limit)
+    next_buses = []
+    for arrival in next_arrivals.itertuples():
+        # The bus number is only the final four digits of its id. A bus running another trip of the same block is only scheduled to run this one
+        if not arrival.bus:
+            bus_number = "Unknown"
+        elif arrival.bus_scheduled:
+            bus_number = f"{arrival.bus} (Scheduled)"
+        else:
+            bus_number = arrival.bus
+        next_buses.append({
+            "arrival_time": arrival.arrival_time,
+            "trip_headsign": f"{arrival.route_number} {arrival.trip_headsign}",
+            "bus": bus_number,
+            "distance": linear_referencing.get_stops_away_text(arrival.stops_away, arrival.km_away * 1000),
+        })
+
+    # Only the buses currently running the next trips are shown on the map
+    running = next_arrivals[next_arrivals["bus_lat"].notna()]
+    bus_lat_list = running["bus_lat"].tolist()
+    bus_lon_list = running["bus_lon"].tolist()
+    bus_number_list = running["bus"].tolist()
     if bus_lat_list:
         map_fig.add_trace(go.Scattermapbox(
             lat=bus_lat_list,
@@ -696,11 +902,12 @@ def get_bus_info(buses, bus_number, current_trips, trips_df, stops_df, toggle_fu
     # Get the text regarding how busy that bus currently is
     capacity_text = get_capacity(capacity)
 
-    # Convert the timestamp time to PST and only include hours, minutes, and seconds for the timestamp output
-    utc_time = datetime.fromisoformat(timestamp).replace(tzinfo=ZoneInfo("UTC"))
-    pst_time = utc_time.astimezone(ZoneInfo("America/Los_Angeles"))
-    pst_timestamp = pst_time.strftime("%H:%M:%S")
-    timestamp_text = f"Updated at {pst_timestamp}"
+    # Show when the bus reported its position in PST and how old it is, and record how long every stage took to get it here
+    freshness_trace = freshness.record_render(buses, bus)
+    timestamp_text = freshness.get_freshness_text(freshness_trace, "America/Los_Angeles")
+    staleness_text = get_staleness_text(buses)
+    if staleness_text:
+        timestamp_text = f"{timestamp_text}. {staleness_text}"
 
     # Converting speed from m/s to km/h
     speed = speed * 3.6
@@ -730,17 +937,26 @@ def get_bus_info(buses, bus_number, current_trips, trips_df, stops_df, toggle_fu
         # Allow departure_time to exceed 24:00:00 e.g. 25:00:00
         full_block["departure_time"] = pd.to_timedelta(full_block["departure_time"])
         full_block = full_block.sort_values(by="departure_time")
+        full_block["departure_seconds"] = full_block["departure_time"].dt.total_seconds()
         # Only keep hours and minutes
         full_block["departure_time"] = full_block["departure_time"].apply(
             lambda t: f"{int(t.total_seconds() // 3600):02d}:{int((t.total_seconds() % 3600) // 60):02d}"
         )
 
+        # Get the delay expected for every trip in the block based on how late the bus currently is
+        block_delays = eta_engine.get_trip_delays(full_block["trip_id"].tolist(), get_service_id(), buses, current_trips)
+
         # Create output detailing all the trips run by that bus
         for _, row in full_block.iterrows():
             departure_time = row["departure_time"]
             route_number = row["route_id"].split("-")[0]
             headsign = row["trip_headsign"]
             block_trip_text = f"{route_number} {headsign} leaving at {departure_time}"
+            # If the bus is expected to still be late when it starts a later trip, add its estimated departure time
+            trip_delay = block_delays.get(row["trip_id"])
+            if row["trip_id"] != trip_id and trip_delay is not None and trip_delay >= 60:
+                estimated_departure = row["departure_seconds"] + int(trip_delay)
+                block_trip_text = f"{block_trip_text} (Estimated {estimated_departure // 3600:02d}:{(estimated_departure % 3600) // 60:02d})"
             block_trips.append(block_trip_text)
         block_trips = [html.Div(text) for text in block_trips]
 
@@ -801,7 +1017,9 @@ def get_bus_info(buses, bus_number, current_trips, trips_df, stops_df, toggle_fu
         if future_stops:
             all_future_stops_eta = []
             all_future_stops_eta.append("Next Stop ETAs (click on a stop number to see the next departures at that stop)")
-            for stop in future_stops:
+            # How many stops and kilometers away the bus is from every upcoming stop, from its position along the line of its trip
+            stops_away_texts = linear_referencing.get_trip_stops_away_texts(buses, current_trips, trip_id, [stop["stop_sequence"] for stop in future_stops])
+            for stop, stops_away_text in zip(future_stops, stops_away_texts):
                 # If the next stop is the first one, get the start time as the eta and remove seconds
                 # Otherwise, get the eta time of the next stop and convert it to PST and only keep hours and minutes
                 if stop["time"] == 0:
@@ -821,7 +1039,7 @@ def get_bus_info(buses, bus_number, current_trips, trips_df, stops_df, toggle_fu
                         href=f"/next_buses?stop_id={future_stop_id}",
                         style={"textDecoration": "underline", "color": "blue"}
                     ),
-                    f"): {future_eta_time}"
+                    f"): {future_eta_time}" + (f" ({stops_away_text})" if stops_away_text else "")
                 ])
                 all_future_stops_eta.append(future_stops_text)
             # Only include the next 5 stops depending on if the "Show Next 5 stops" button has been clicked
@@ -843,14 +1061,11 @@ def get_bus_info(buses, bus_number, current_trips, trips_df, stops_df, toggle_fu
     route_number = route.split('-')[0] 
     trip_headsign = trips_df.loc[trips_df["trip_id"] == trip_id, "trip_headsign"]
 
-    # Load the routes.shp file get the lines for all routes and then select the one being currently run by that bus
-    fp_routes = os.path.join("data", "routes.shp")
-    route_data = gpd.read_file(fp_routes)
+    # Get the line of the route being currently run by that bus
     # Route map not shown for buses heading back to a transit yard
     if trip_headsign.empty:
         route = "0"
-    current_route = route_data[route_data["route_id"] == route]
-    route_geojson = json.loads(current_route.to_json())
+    route_geojson = route_shapes.get_route_geojson(route)
 
     # Add the route line to the map and have it centered on the bus' current position
     fig.update_layout(
@@ -947,6 +1162,206 @@ def get_bus_info(buses, bus_number, current_trips, trips_df, stops_df, toggle_fu
 
     return fig, desc_text, stop_text, capacity_text, speed_text, timestamp_text, future_stops_eta, toggle_future_stops_text, block_trips, reset_url, update_bus_input
 
+# Returns the outputs for the on-time performance page
+# ----------------------------------------------------------------------------------
+# rollup is the dictionary containing the on-time performance counters of a service day
+# ----------------------------------------------------------------------------------
+def get_on_time_performance(rollup):
+    route_totals = on_time.get_route_totals(rollup)
+    if not route_totals:
+        return html.Div(f"No on-time performance data is available yet for {rollup['date']}")
+
+    # Overall split of early, on time, and late stops
+    early = sum(total["early"] for total in route_totals)
+    on_time_count = sum(total["on_time"] for total in route_totals)
+    late = sum(total["late"] for total in route_totals)
+    served = early + on_time_count + late
+    summary_text = f"{served} stops served: {on_time_count / served:.0%} on time, {early / served:.0%} early, {late / served:.0%} late"
+
+    # Stacked bar chart of the number of early, on time, and late stops for every hour of the day
+    hour_totals = on_time.get_hour_totals(rollup)
+    hour_fig = go.Figure(layout=go.Layout(paper_bgcolor="#f8f9fa", barmode="stack", height=400))
+    for category, (name, color) in enumerate([("Early", "orange"), ("On Time", "green"), ("Late", "red")]):
+        hour_fig.add_trace(go.Bar(x=list(range(24)), y=hour_totals[:, category], name=name, marker_color=color))
+    hour_fig.update_layout(xaxis_title="Hour of the day", yaxis_title="Stops served", margin={"r": 10, "t": 10, "l": 10, "b": 10})
+
+    # Histogram of the delays of every stop served
+    histogram = np.sum([route["histogram"] for route in rollup["routes"].values()], axis=0)
+    delay_minutes = list(range(on_time.histogram_min_minutes, on_time.histogram_max_minutes + 1))
+    histogram_fig = go.Figure(layout=go.Layout(paper_bgcolor="#f8f9fa", height=300))
+    histogram_fig.add_trace(go.Bar(x=delay_minutes, y=histogram, name="Stops served"))
+    histogram_fig.update_layout(xaxis_title="Delay (minutes, negative is early)", yaxis_title="Stops served", margin={"r": 10, "t": 10, "l": 10, "b": 10})
+
+    # Table with the split of early, on time, and late stops of every route and direction
+    route_table = html.Table([
+        html.Thead(html.Tr([
+            html.Th("Route", style={"border": "1px solid black"}),
+            html.Th("Direction", style={"border": "1px solid black"}),
+            html.Th("Early", style={"border": "1px solid black"}),
+            html.Th("On Time", style={"border": "1px solid black"}),
+            html.Th("Late", style={"border": "1px solid black"}),
+        ])),
+        html.Tbody([
+            html.Tr([
+                html.Td(total["route"], style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(total["direction"], style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(f"{total['early'] / max(total['early'] + total['on_time'] + total['late'], 1):.0%}", style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(f"{total['on_time'] / max(total['early'] + total['on_time'] + total['late'], 1):.0%}", style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(f"{total['late'] / max(total['early'] + total['on_time'] + total['late'], 1):.0%}", style={"border": "1px solid black", "textAlign": "center"}),
+            ])
+            for total in route_totals
+        ])
+    ],
+    style={"borderCollapse": "collapse", "border": "1px solid black", "width": "100%", "marginTop": "10px"}
+    )
+
+    return html.Div([
+        html.H3(summary_text),
+        html.H3("Stops served by hour"),
+        dcc.Graph(id="on-time-hour-graph", figure=hour_fig),
+        html.H3("Distribution of delays"),
+        dcc.Graph(id="on-time-histogram-graph", figure=histogram_fig),
+        html.H3("On-time performance by route and direction"),
+        route_table,
+    ])
+
+# Returns the table of the headways of every route and the buses which are bunched or behind a gap
+# ----------------------------------------------------------------------------------
+# route_headways is the dictionary returned by headways.get_route_headways
+# ----------------------------------------------------------------------------------
+def get_headways_tables(route_headways):
+    routes = route_headways["routes"]
+    if not routes:
+        return html.Div("No buses are currently running")
+
+    # Minutes of a headway e.g. 7.5 min, or Unknown
+    def get_minutes_text(seconds):
+        return "Unknown" if seconds is None else f"{seconds / 60:.1f} min"
+
+    bunched = sum(route["bunched"] for route in routes)
+    gaps = sum(route["gaps"] for route in routes)
+    summary_text = f"{sum(route['buses'] for route in routes)} buses running: {bunched} bunched, {gaps} behind a gap"
+
+    # Table with the number of buses, bunched buses, and gaps of every route and direction
+    route_table = html.Table([
+        html.Thead(html.Tr([
+            html.Th("Route", style={"border": "1px solid black"}),
+            html.Th("Destination", style={"border": "1px solid black"}),
+            html.Th("Buses", style={"border": "1px solid black"}),
+            html.Th("Bunched", style={"border": "1px solid black"}),
+            html.Th("Gaps", style={"border": "1px solid black"}),
+        ])),
+        html.Tbody([
+            html.Tr([
+                html.Td(route["route"], style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(route["headsign"], style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(route["buses"], style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(route["bunched"], style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(route["gaps"], style={"border": "1px solid black", "textAlign": "center"}),
+            ])
+            for route in routes
+        ])
+    ],
+    style={"borderCollapse": "collapse", "border": "1px solid black", "width": "100%", "marginTop": "10px"}
+    )
+
+    # Table with every bus which is bunched or behind a gap along with the bus ahead of it
+    flagged = [(route, vehicle) for route in routes for vehicle in route["vehicles"] if vehicle["status"]]
+    flagged_table = html.Table([
+        html.Thead(html.Tr([
+            html.Th("Route", style={"border": "1px solid black"}),
+            html.Th("Destination", style={"border": "1px solid black"}),
+            html.Th("Bus", style={"border": "1px solid black"}),
+            html.Th("Bus Ahead", style={"border": "1px solid black"}),
+            html.Th("Headway", style={"border": "1px solid black"}),
+            html.Th("Scheduled Headway", style={"border": "1px solid black"}),
+            html.Th("Status", style={"border": "1px solid black"}),
+        ])),
+        html.Tbody([
+            html.Tr([
+                html.Td(route["route"], style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(route["headsign"], style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(html.A(vehicle["id"], href=f"/bus_tracker?bus={vehicle['id']}", style={"textDecoration": "none", "color": "blue"}), style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(html.A(vehicle["leader"], href=f"/bus_tracker?bus={vehicle['leader']}", style={"textDecoration": "none", "color": "blue"}), style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(get_minutes_text(vehicle["actual"]), style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td(get_minutes_text(vehicle["scheduled"]), style={"border": "1px solid black", "textAlign": "center"}),
+                html.Td("Bunched" if vehicle["status"] == "bunched" else "Gap", style={"border": "1px solid black", "textAlign": "center", "color": "red" if vehicle["status"] == "bunched" else "orange"}),
+            ])
+            for route, vehicle in flagged
+        ])
+    ],
+    style={"borderCollapse": "collapse", "border": "1px solid black", "width": "100%", "marginTop": "10px"}
+    )
+
+    return html.Div([
+        html.H3(summary_text),
+        html.H3("Bunched buses and gaps"),
+        flagged_table if flagged else html.Div("No buses are currently bunched or behind a gap"),
+        html.H3("Headways by route and destination"),
+        route_table,
+    ])
+
+# Returns the figure of the fleet map with the markers of a viewport
+# ----------------------------------------------------------------------------------
+# traces is the list returned by fleet_map.get_trace_values
+# view is the dictionary returned by fleet_map.get_view
+# ----------------------------------------------------------------------------------
+def get_fleet_map_figure(traces, view):
+    fig = go.Figure(layout=go.Layout(paper_bgcolor="#f8f9fa"))
+    for name, values in zip(["Groups of buses", "Buses"], traces):
+        fig.add_trace(go.Scattermapbox(
+            lat=values["lat"],
+            lon=values["lon"],
+            mode="markers+text",
+            text=values["text"],
+            textposition="middle center" if name == "Groups of buses" else "top center",
+            marker=dict(size=values.get("marker.size", 12), color=values["marker.color"]),
+            hovertext=values["hovertext"],
+            customdata=values.get("customdata"),
+            hoverinfo="text",
+            name=name
+        ))
+    fig.update_layout(
+        mapbox=dict(
+            style="open-street-map",
+            center=view["center"],
+            zoom=view["zoom"],
+        ),
+        height=fleet_map.default_map_size[1],
+        margin={"r":0,"t":0,"l":0,"b":0},
+        showlegend=False,
+        # Keep the view of the user when the markers are updated
+        uirevision="fleet-map"
+    )
+    return fig
+
+# Returns patches of the fleet map figure and of the markers kept in the browser, changing only the markers which differ from the ones
+# last sent. When the same buses are shown, only the positions and colours which changed are sent, otherwise every value of the trace
+# is replaced
+# ----------------------------------------------------------------------------------
+# traces is the list returned by fleet_map.get_trace_values
+# previous_traces is the list of trace values last sent to the browser
+# ----------------------------------------------------------------------------------
+def get_fleet_map_patches(traces, previous_traces):
+    map_patch = dash.Patch()
+    state_patch = dash.Patch()
+    for trace, (values, previous_values) in enumerate(zip(traces, previous_traces)):
+        same_markers = len(values["lat"]) == len(previous_values["lat"]) and values.get("customdata") == previous_values.get("customdata")
+        for path, new in values.items():
+            *parents, key = path.split(".")
+            target = map_patch["data"][trace]
+            for parent in parents:
+                target = target[parent]
+            if not same_markers:
+                target[key] = new
+                state_patch["traces"][trace][path] = new
+                continue
+            for i, (value, previous_value) in enumerate(zip(new, previous_values[path])):
+                if value != previous_value:
+                    target[key][i] = value
+                    state_patch["traces"][trace][path][i] = value
+    return map_patch, state_patch
+
 app.layout = html.Div([
     dcc.Location(id="url", refresh=False),
     dcc.Store(id="tracker-url-request"),
@@ -969,6 +1384,18 @@ def display_page(pathname):
         page_flags["next_buses"] = True
         page_flags["bus_tracker"] = False
         return next_buses_layout
+    elif pathname == "/on_time":
+        page_flags["bus_tracker"] = False
+        page_flags["next_buses"] = False
+        return on_time_layout
+    elif pathname == "/fleet_map":
+        page_flags["bus_tracker"] = False
+        page_flags["next_buses"] = False
+        return fleet_map_layout
+    elif pathname == "/headways":
+        page_flags["bus_tracker"] = False
+        page_flags["next_buses"] = False
+        return headways_layout
     else:
         page_flags["bus_tracker"] = False
         page_flags["next_buses"] = False
@@ -986,7 +1413,8 @@ def display_page(pathname):
      Output("toggle-future-stops", "children"),
      Output("block-trips", "children"),
      Output("tracker-url-request", "data"),
-     Output("bus-search-user-input", "value")],
+     Output("bus-search-user-input", "value"),
+     Output("tracked-bus", "data")],
     [Input("bus-search-user-input", "n_submit"),
      Input("interval-component", "n_intervals"),
      Input("manual-update", "n_clicks"),
@@ -996,6 +1424,7 @@ def display_page(pathname):
      Input("clear-bus-input", "n_clicks")],
     [State("bus-search-user-input", "value")]
 )
+@profiling.sampled
 def update_bus_callback(n_submits, n_intervals, manual_update, search_for_bus, toggle_future_stops_clicks, href, clear_bus_input, bus_number):
 
     triggered_id = callback_context.triggered_id
@@ -1009,13 +1438,13 @@ def update_bus_callback(n_submits, n_intervals, manual_update, search_for_bus, t
                 page_flags["bus_tracker"] = True
                 page_flags["next_buses"] = False
             else:
-                return (no_update,) * 11
+                return (no_update,) * 12
         
     reset_url = no_update
 
     # If the Clear button on the bus tracker page is pressed, clear the input
     if triggered_id == "clear-bus-input":
-        return (no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, "")
+        return (no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, "", no_update)
         
 
     # Check if there is a bus number in the current url and if so, use it as the bus number input
@@ -1027,20 +1456,75 @@ def update_bus_callback(n_submits, n_intervals, manual_update, search_for_bus, t
         reset_url = {"url": "/bus_tracker"}
         
 
-    # Clicking the Manual Update or Search buttons or pressing the Enter key triggers a fetch for the most recent trip and bus realtime data
+    # Clicking the Manual Update or Search buttons or pressing the Enter key refreshes the trip and bus realtime data in the background
+    # and waits a few seconds for it, after which the last good snapshot is shown instead
     if triggered_id in ["manual-update", "search-for-bus", "bus-search-user-input"]:
-        try:
-            fetch_fleet_data.fetch()
-            fetch_trip_data.fetch()
-        except Exception as e:
-            print(f"Error fetching live fleet data: {e}", flush=True)
+        realtime_cache.revalidate(wait_seconds=realtime_cache.refresh_wait_seconds)
+
+    # Count the stops served since the last snapshot in the on-time performance counters
+    if not data_plane.is_enabled():
+        on_time.update_from_snapshot()
+        stop_events.update_from_snapshot()
 
     # Load the latest data in the /data folder from bus_updates.json, trip_updates.json, trips.csv, and stops.csv
     buses = load_buses()
     current_trips = load_current_trips()
     trips_df = load_trips()
     stops_df = load_stops()
-    return get_bus_info(buses, bus_number, current_trips, trips_df, stops_df, toggle_future_stops_clicks, reset_url, triggered_id, bus_number)
+    bus_info = get_bus_info(buses, bus_number, current_trips, trips_df, stops_df, toggle_future_stops_clicks, reset_url, triggered_id, bus_number)
+
+    # The bus marker is only moved between refreshes if the bus is shown on the map, in which case it is always the last trace
+    tracked_bus = interpolation.get_motion_model(buses, current_trips, bus_number) if bus_info[0].data else None
+    return bus_info + (tracked_bus,)
+
+# Callback which sends the motion model of the bus shown on the bus tracker map once per realtime snapshot
+@callback(
+    Output("tracked-bus", "data", allow_duplicate=True),
+    Input("motion-interval", "n_intervals"),
+    State("tracked-bus", "data"),
+    prevent_initial_call=True
+)
+def update_motion_model_callback(n_intervals, tracked_bus):
+    if not page_flags.get("bus_tracker", False) or not tracked_bus:
+        return no_update
+    if tracked_bus["signature"] == str(data_plane.get_realtime_signature()):
+        return no_update
+    motion = interpolation.get_motion_model(load_buses(), load_current_trips(), tracked_bus["bus"])
+    return motion if motion is not None else no_update
+
+# Clientside callback which moves the bus marker on the bus tracker map to its dead-reckoned position between refreshes, following
+# interpolation.get_model_position in the browser without asking the server
+dash.clientside_callback(
+    """
+    function(n_intervals, motion, figure) {
+        if (!motion || !figure || !figure.data || !figure.data.length) {
+            return window.dash_clientside.no_update;
+        }
+        var distance = motion.distance;
+        var elapsed = Math.min(Math.max(Date.now() / 1000 - motion.reported, 0), motion.max_extrapolation_seconds);
+        var travelled = Math.min(motion.speed * elapsed, distance[distance.length - 1]);
+        var segment = 0;
+        while (segment < distance.length - 2 && distance[segment + 1] < travelled) {
+            segment++;
+        }
+        var lat = motion.lat[segment];
+        var lon = motion.lon[segment];
+        if (distance.length > 1 && distance[segment + 1] > distance[segment]) {
+            var fraction = Math.min(Math.max((travelled - distance[segment]) / (distance[segment + 1] - distance[segment]), 0), 1);
+            lat += fraction * (motion.lat[segment + 1] - motion.lat[segment]);
+            lon += fraction * (motion.lon[segment + 1] - motion.lon[segment]);
+        }
+        var data = figure.data.slice();
+        data[data.length - 1] = Object.assign({}, data[data.length - 1], {lat: [lat], lon: [lon]});
+        return Object.assign({}, figure, {data: data});
+    }
+    """,
+    Output("live-map", "figure", allow_duplicate=True),
+    Input("interpolation-interval", "n_intervals"),
+    State("tracked-bus", "data"),
+    State("live-map", "figure"),
+    prevent_initial_call=True
+)
 
 # Callback which sets the outputs of the next buses page
 @callback(
@@ -1057,6 +1541,7 @@ def update_bus_callback(n_submits, n_intervals, manual_update, search_for_bus, t
      State("route-dropdown", "value"),
      State("variant-checklist", "value")]
 )
+@profiling.sampled
 def update_stop_callback(n_intervals, stop_search, toggle_future_buses_clicks, href, stop_number_input, route_number_input, include_variants):
 
     triggered_id = callback_context.triggered_id  
@@ -1082,20 +1567,20 @@ def update_stop_callback(n_intervals, stop_search, toggle_future_buses_clicks, h
             stop_number_input = query_params["stop_id"][0]
         reset_url = {"url": "/next_buses"}
 
-    # Get the most up-to-date realtime data for trip_updates.json and bus_updates.json
-    try:
-        fetch_fleet_data.fetch()
-        fetch_trip_data.fetch()
-    except Exception as e:
-        print(f"Error fetching live fleet data: {e}", flush=True)
+    # Refresh the realtime data for trip_updates.json and bus_updates.json in the background if it isn't fresh. A new search waits a few
+    # seconds for it, after which the last good snapshot is shown instead
+    realtime_cache.revalidate(wait_seconds=realtime_cache.refresh_wait_seconds if triggered_id == "stop-search" else 0)
+
+    # Count the stops served since the last snapshot in the on-time performance counters
+    if not data_plane.is_enabled():
+        on_time.update_from_snapshot()
+        stop_events.update_from_snapshot()
 
-    # Load the latest bus data in the /data folder from bus_updates.json, trip_updates.json, trips.csv, and stops.csv
+    # Load the latest bus data in the /data folder from bus_updates.json, trip_updates.json, and stops.csv
     buses = load_buses()
     current_trips = load_current_trips()
-    trips_df = load_trips()
     service_id_list = get_service_id()
     service_id_list = [np.int64(x) for x in service_id_list]
-    today_trips_df = trips_df[trips_df["service_id"].isin(service_id_list)]
     stops_df = load_stops()
     routes_df = load_routes()
     
@@ -1105,21 +1590,92 @@ def update_stop_callback(n_intervals, stop_search, toggle_future_buses_clicks, h
         {"label": f"{row['stop_name']} (Stop {int(row['stop_id'])})", "value": int(row['stop_id'])}
         for _, row in stops_df.iterrows()
     ]
-    # Populate the route dropdown with the values being the route numbers and the labels having both the route numbers and the destinations
-    route_options = [
-    {"label": f"{row['route_short_name']} {row['route_long_name']}", "value": row['route_short_name']}
-        for _, row in routes_df.iterrows()
-    ]    
+    # Populate the route dropdown with the values being the route numbers and the labels having both the route numbers and the destinations.
+    # Once a stop has been selected, only the routes serving that stop today are offered
+    route_options = route_index.get_stop_route_options(stop_number_input, service_id_list) if stop_number_input else []
+    if not route_options:
+        route_options = [
+        {"label": f"{row['route_short_name']} {row['route_long_name']}", "value": row['route_short_name']}
+            for _, row in routes_df.iterrows()
+        ]
     # Change the text of the "Show Up To Next 10 Buses"/"Show Up To Next 20 Buses" button depending on how many times it has been clicked
     if toggle_future_buses_clicks % 2:
         toggle_future_buses_text = "Show Up To Next 10 Buses"
     else:
         toggle_future_buses_text = "Show Up To Next 20 Buses"
     # Get the main output for the next buses page containing the table with the next bus arrivals as well as the text stating the user inputs
-    next_buses_html = get_next_buses(stop_number_input, route_number_input, stops_df, today_trips_df, current_trips, buses, toggle_future_buses_clicks, include_variants, today_trips_df)
+    next_buses_html = get_next_buses(stop_number_input, route_number_input, stops_df, current_trips, buses, toggle_future_buses_clicks, include_variants, service_id_list)
+    staleness_text = get_staleness_text(buses)
+    freshness.record_render(buses)
+    if staleness_text:
+        next_buses_html = html.Div([html.H3(staleness_text), next_buses_html])
     # Returns the above outputs, populate the dropdowns, and set the text for the "Show Up To Next 10 Buses"/"Show Up To Next 20 Buses" button
     return next_buses_html, toggle_future_buses_text, stop_options, route_options, reset_url
 
+# Callback which sets the outputs of the on-time performance page
+@callback(
+    [Output("on-time-output", "children"),
+     Output("on-time-date-dropdown", "options")],
+    [Input("on-time-interval-component", "n_intervals"),
+     Input("on-time-date-dropdown", "value")]
+)
+def update_on_time_callback(n_intervals, service_date):
+    # When the data plane is disabled, this process is the one keeping the on-time performance counters up-to-date
+    if not data_plane.is_enabled():
+        on_time.update_from_snapshot()
+        stop_events.update_from_snapshot()
+
+    today = datetime.now(ZoneInfo("America/Los_Angeles")).strftime("%Y%m%d")
+    service_dates = on_time.get_rollup_dates()
+    if today not in service_dates:
+        service_dates.insert(0, today)
+    date_options = [{"label": f"{d[:4]}-{d[4:6]}-{d[6:]}", "value": d} for d in service_dates]
+    rollup = on_time.get_rollup(service_date or today)
+    return get_on_time_performance(rollup), date_options
+
+# Callback which sets the outputs of the headways page
+@callback(
+    Output("headways-output", "children"),
+    Input("headways-interval-component", "n_intervals")
+)
+def update_headways_callback(n_intervals):
+    return get_headways_tables(headways.get_route_headways(load_buses(), load_current_trips()))
+
+# Callback which sets the markers of the fleet map page. The whole figure is only sent on the first update, after which only the markers
+# in the viewport which changed since the last update are sent
+@callback(
+    [Output("fleet-map", "figure"),
+     Output("fleet-map-text", "children"),
+     Output("fleet-map-state", "data")],
+    [Input("fleet-interval-component", "n_intervals"),
+     Input("fleet-map", "relayoutData"),
+     Input("fleet-color-by", "value")],
+    State("fleet-map-state", "data")
+)
+def update_fleet_map_callback(n_intervals, relayout_data, color_by, map_state):
+    # Refresh the realtime data in the background if it isn't fresh
+    realtime_cache.revalidate(wait_seconds=0)
+    buses = load_buses()
+    current_trips = load_current_trips()
+
+    view = fleet_map.get_view(relayout_data, map_state["view"] if map_state else None)
+    index = fleet_map.get_fleet_index(buses, current_trips, get_service_id())
+    markers = fleet_map.get_fleet_markers(index, view["bounds"], view["zoom"], color_by)
+    traces = fleet_map.get_trace_values(markers)
+    if map_state:
+        figure, map_state = get_fleet_map_patches(traces, map_state["traces"])
+        map_state["view"] = view
+    else:
+        figure = get_fleet_map_figure(traces, view)
+        map_state = {"view": view, "traces": traces}
+
+    map_text = f"{markers['total']} of {len(index['ids'])} buses currently shown on the map"
+    staleness_text = get_staleness_text(buses)
+    if staleness_text:
+        map_text = f"{map_text}. {staleness_text}"
+    freshness.record_render(buses)
+    return figure, map_text, map_state
+
 @callback(Output("url", "href"), [Input("tracker-url-request", "data"),  Input("next-buses-url-request", "data")])
 def set_url(tracker_request, next_buses_request):
     if page_flags.get("bus_tracker", True):
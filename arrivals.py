@@ -0,0 +1,151 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+import data_plane
+import eta_engine
+import linear_referencing
+import route_index
+
+# Batch arrivals engine used by the next buses page, for exchanges with several bays and for display walls showing many stops at once.
+# Instead of running the next buses query once per stop, the stop times of every requested stop are gathered from the stop index
+# in one go and the service day filter, estimated arrival times, route filter, trip attributes and assigned buses are all computed
+# for every row at once with numpy, so asking for N stops costs about as much as asking for one.
+
+# Columns of the table returned by get_arrivals and their dtypes. scheduled_arrival and eta are in seconds since the start of the
+# service day, bus is empty when no bus is known, and stops_away is -1 and km_away, bus_lat and bus_lon are nan unless a bus is running the trip
+arrival_dtypes = {
+    "stop_id": np.int64, "trip_id": object, "route_id": object, "route_number": object, "trip_headsign": object, "block_id": np.int64,
+    "stop_sequence": np.int64, "scheduled_arrival": np.int64, "eta": np.int64, "eta_source": object, "arrival_time": object,
+    "bus": object, "bus_scheduled": bool, "bus_lat": np.float64, "bus_lon": np.float64, "stops_away": np.int64, "km_away": np.float64,
+}
+arrival_columns = list(arrival_dtypes)
+
+# Returns the position in keys of the first key equal to each value, or -1 if there is none
+def find_first(keys, values):
+    keys = pd.Index(keys)
+    first = ~keys.duplicated()
+    positions = pd.Index(keys[first]).get_indexer(values)
+    return np.where(positions >= 0, np.flatnonzero(first)[np.maximum(positions, 0)], -1)
+
+# Returns the row in buses of the bus running each trip, or of the bus running another trip of the same block if no bus is running it yet
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# trip is a numpy array of rows in trips
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# Returns the row in buses (or -1 if no bus is known) and whether that bus is only scheduled to run the trip
+# ----------------------------------------------------------------------------------
+def assign_buses(static, trip, buses):
+    bus_trips = data_plane.get_realtime_codes(static, "bus_updates", buses)["trip"]
+    running_buses = np.flatnonzero(bus_trips >= 0)
+    if len(running_buses) == 0 or len(trip) == 0:
+        return np.full(len(trip), -1, dtype=np.int64), np.zeros(len(trip), dtype=bool)
+    blocks = np.asarray(static["tables"]["trips"]["block"])
+
+    trip_bus = find_first(bus_trips[running_buses], trip)
+    # Only the first bus found in each block is used, just like the next buses page did before
+    block_bus = find_first(blocks[bus_trips[running_buses]], blocks[trip])
+    bus_scheduled = (trip_bus < 0) & (block_bus >= 0)
+    assigned = np.where(trip_bus >= 0, trip_bus, block_bus)
+    return np.where(assigned >= 0, running_buses[np.maximum(assigned, 0)], -1), bus_scheduled
+
+# Returns the upcoming arrivals at several stops at once
+# ----------------------------------------------------------------------------------
+# stop_ids is a list of stop ids e.g. [100002, 100003]
+# service_ids is the list of service ids running today
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# route_short_names is an optional list of route numbers to only include arrivals of those routes
+# include_variants is True if the variants of the routes in route_short_names should also be included
+# limit is the maximum number of arrivals returned per stop, or in total if merge is True
+# merge is True to return a single board for all the stops instead of up to limit arrivals for each stop
+# Returns a dataframe with the arrival_columns sorted by stop and then estimated arrival time (or only by estimated arrival time if merge is True)
+# ----------------------------------------------------------------------------------
+def get_arrivals(stop_ids, service_ids, buses, current_trips, route_short_names=None, include_variants=False, limit=10, merge=False):
+    static, state = eta_engine.get_engine_state(service_ids, buses, current_trips)
+    trips = static["tables"]["trips"]
+
+    # Gather the stop times of every requested stop from the stop patterns serving it
+    stop_ids = np.unique(np.asarray([int(stop_id) for stop_id in stop_ids], dtype=np.int64))
+    trip, positions = data_plane.get_stop_trip_positions(static, stop_ids)
+    trip = trip.astype(np.int64)
+
+    # Only keep the trips running today and, if asked, on the selected routes
+    keep = np.isin(np.asarray(trips["service_id"])[trip], np.asarray(service_ids, dtype=np.int64))
+    if route_short_names:
+        route_mask = np.zeros(len(trips["route"]), dtype=bool)
+        for route_short_name in route_short_names:
+            route_mask |= route_index.get_route_trip_mask(route_short_name, include_variants)
+        keep &= route_mask[trip]
+    positions = positions[keep]
+    trip = trip[keep]
+
+    # Estimate the arrival times and only keep the ones that haven't happened yet
+    def get_values(column):
+        return data_plane.get_stop_time_values(static["tables"], trip, positions, column)
+
+    stop_sequence = get_values("stop_sequence").astype(np.int64)
+    scheduled = get_values("arrival").astype(np.int64)
+    eta, source, passed = eta_engine.estimate_arrivals(state, trip, stop_sequence, scheduled)
+    now = int(time.time()) - state["service_day_start"]
+    upcoming = ~passed & (eta >= now)
+
+    arrivals = pd.DataFrame({
+        "stop_id": get_values("stop_id")[upcoming],
+        "trip": trip[upcoming],
+        "position": positions[upcoming],
+        "stop_sequence": stop_sequence[upcoming],
+        "scheduled_arrival": scheduled[upcoming],
+        "eta": eta[upcoming],
+        "eta_source": np.asarray(eta_engine.eta_sources)[source[upcoming]],
+    })
+    # Loop trips serve some stops twice, and each visit is an arrival of its own
+    arrivals = arrivals.drop_duplicates(["stop_id", "trip", "stop_sequence"])
+    if merge:
+        arrivals = arrivals.sort_values(["eta", "stop_id"], kind="stable").head(limit)
+    else:
+        arrivals = arrivals.sort_values(["stop_id", "eta"], kind="stable").groupby("stop_id", sort=False).head(limit)
+
+    # Add the trip attributes and the bus assigned to each arrival
+    trip = arrivals["trip"].to_numpy()
+    arrivals["trip_id"] = data_plane.decode_ids(static, "trip", trip)
+    arrivals["route_id"] = np.asarray(trips["route_id"])[trip]
+    arrivals["route_number"] = arrivals["route_id"].astype(str).str.split("-").str[0]
+    arrivals["trip_headsign"] = np.asarray(trips["trip_headsign"])[trip]
+    arrivals["block_id"] = np.asarray(trips["block_id"])[trip]
+    arrivals["arrival_time"] = [gtfs_time[:5] for gtfs_time in data_plane.seconds_to_gtfs_time(arrivals["eta"].to_numpy())]
+    bus_rows, bus_scheduled = assign_buses(static, trip, buses)
+    has_bus = bus_rows >= 0
+    arrivals["bus"] = [buses[row]["id"][-4:] if row >= 0 else "" for row in bus_rows]
+    arrivals["bus_scheduled"] = bus_scheduled
+    arrivals["bus_lat"] = [buses[row]["lat"] if running else np.nan for row, running in zip(bus_rows, has_bus & ~bus_scheduled)]
+    arrivals["bus_lon"] = [buses[row]["lon"] if running else np.nan for row, running in zip(bus_rows, has_bus & ~bus_scheduled)]
+    # How many stops and kilometers away the bus running each trip is, from its position along the line of the trip
+    stops_away, meters_away = linear_referencing.get_stops_away(static, linear_referencing.get_fleet_progress(buses, current_trips), trip, arrivals["position"].to_numpy())
+    arrivals["stops_away"] = stops_away
+    arrivals["km_away"] = np.round(meters_away / 1000, 2)
+    return arrivals[arrival_columns].astype(arrival_dtypes).reset_index(drop=True)
+
+# Returns the arrivals returned by get_arrivals as a dictionary that can be sent as json, either as one board per stop or a single merged board
+# ----------------------------------------------------------------------------------
+# arrivals is the dataframe returned by get_arrivals
+# merge is True if get_arrivals was called with merge=True
+# ----------------------------------------------------------------------------------
+def arrivals_to_json(arrivals, merge):
+    arrivals = arrivals.drop(columns=["bus_lat", "bus_lon"]).astype(object).where(arrivals.notna(), None)
+    records = arrivals.to_dict("records")
+    for record in records:
+        record["stop_id"] = int(record["stop_id"])
+        record["block_id"] = int(record["block_id"])
+        record["stop_sequence"] = int(record["stop_sequence"])
+        record["scheduled_arrival"] = int(record["scheduled_arrival"])
+        record["eta"] = int(record["eta"])
+        record["bus_scheduled"] = bool(record["bus_scheduled"])
+        record["stops_away"] = int(record["stops_away"]) if record["stops_away"] > 0 else None
+    if merge:
+        return {"arrivals": records}
+    boards = {}
+    for record in records:
+        boards.setdefault(str(record["stop_id"]), []).append(record)
+    return {"stops": boards}
@@ -0,0 +1,746 @@
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import static_dataset
+
+# Shared data plane used when the website runs with several gunicorn workers.
+# A single refresher process (started by gunicorn.conf.py) parses the static csv files and the realtime json files once and
+# publishes them as columns of .npy files inside a new versioned directory in data/plane. Once a version is completely written,
+# it is activated by atomically replacing a small pointer file (static.current or realtime.current). Workers never parse the
+# csv or json files themselves. They memory map the columns of the active version read-only, so the pages holding the static
+# indexes are shared by every worker through the page cache instead of being duplicated, and only the refresher ever calls BC Transit.
+# The stop_times are stored sorted by trip with an offset index per trip plus a permutation sorted by stop with an offset index
+# per stop, so finding all the stops of a trip or all the arrivals at a stop is a slice instead of a scan of every csv file.
+
+plane_dir = os.path.join("data", "plane")
+static_tables = static_dataset.static_tables
+
+# How often the refresher downloads the realtime data, how often workers check for a new version, and how many old versions are kept
+# on disk so that workers which are still reading an older version are not affected when it is replaced
+realtime_refresh_seconds = int(os.environ.get("REALTIME_REFRESH_SECONDS", "30"))
+attach_check_seconds = 1
+kept_versions = 3
+
+# The versions currently attached by this worker along with anything derived from them
+attached = {
+    "static": {"version": None, "checked": 0, "data": None},
+    "realtime": {"version": None, "checked": 0, "data": None},
+}
+attach_lock = threading.Lock()
+
+# Static tables built in this process when the data plane is disabled, and how often the static dataset is checked for a new version
+local_static = {"signature": None, "checked": 0, "data": None, "rebuilding": False}
+local_check_seconds = 5
+
+# Ids encoded as dense integers when the static data is built. The code of a trip, stop or route is its row in trips, stops or routes,
+# and blocks, shapes and services are numbered in sorted order. Every table then joins and filters on these small integers instead of
+# comparing long strings such as 12286246:14824057:14828025, and the original ids are only looked up in the dictionary for display
+id_kinds = ["trip", "stop", "route", "block", "shape", "service"]
+
+# Columns of the realtime json files encoded with the id dictionary of the static data
+realtime_id_columns = {
+    "bus_updates": {"trip": "trip_id", "stop": "stop_id", "route": "route"},
+    "trip_updates": {"trip": "trip_id", "stop": "stop_id", "route": "route_id"},
+}
+
+# Realtime id codes computed in this process, for the realtime snapshot and static version they were computed with
+local_realtime_codes = {"key": None, "codes": {}}
+local_realtime_lock = threading.Lock()
+
+# Columns of the realtime json files and the dtype they are stored with
+bus_columns = {"id": str, "lat": np.float64, "lon": np.float64, "speed": np.float64, "route": str, "capacity": np.int64,
+               "trip_id": str, "stop_id": str, "bearing": np.float64, "timestamp": str, "reported": np.int64, "feed_timestamp": np.int64}
+trip_update_columns = {"trip_id": str, "route_id": str, "start_time": str, "stop_id": str, "delay": np.int64,
+                       "stop_sequence": np.int64, "time": np.int64}
+
+# Returns True if the website should read its data from the data plane instead of reading the files in /data itself
+def is_enabled():
+    return os.environ.get("DATA_PLANE") == "1"
+
+# Converts GTFS times such as 25:03:00 into the number of seconds after the start of the service day. Missing times become -1
+# ----------------------------------------------------------------------------------
+# times is a pandas Series of strings in the HH:MM:SS format
+# ----------------------------------------------------------------------------------
+def gtfs_time_to_seconds(times):
+    parts = times.fillna("-1:00:00").str.split(":", expand=True).astype(np.int32)
+    seconds = parts[0] * 3600 + parts[1] * 60 + parts[2]
+    return np.where(parts[0] < 0, -1, seconds).astype(np.int32)
+
+# Converts seconds after the start of the service day back into GTFS times such as 25:03:00
+# ----------------------------------------------------------------------------------
+# seconds is a numpy array of ints
+# ----------------------------------------------------------------------------------
+def seconds_to_gtfs_time(seconds):
+    return [f"{s // 3600:02d}:{(s % 3600) // 60:02d}:{s % 60:02d}" for s in np.asarray(seconds).tolist()]
+
+# Returns a numpy array that can be saved as a .npy file and memory mapped. Text columns are stored as fixed width unicode
+def to_column_array(column):
+    if pd.api.types.is_numeric_dtype(column):
+        return column.to_numpy()
+    return column.fillna("").astype(str).to_numpy(dtype=str)
+
+# Returns ids as strings so that ids read as ints, floats or strings all encode the same way e.g. 100002, 100002.0 and "100002"
+def ids_to_strings(values):
+    values = pd.Series(np.asarray(values))
+    if pd.api.types.is_float_dtype(values):
+        return np.where(values.isna(), "", values.fillna(-1).astype(np.int64).astype(str)).astype(str)
+    return values.fillna("").astype(str).to_numpy(dtype=str)
+
+# Returns codes with the smallest signed integer dtype holding every code of a dictionary with size ids. Unknown ids stay -1
+def to_code_array(codes, size):
+    return np.asarray(codes).astype(np.int16 if size < np.iinfo(np.int16).max else np.int32)
+
+# Returns the id dictionary of the static tables: for each of the id_kinds, the array of ids whose positions are their codes
+def build_id_dictionary(tables):
+    return {
+        "trip": ids_to_strings(tables["trips"]["trip_id"]),
+        "stop": ids_to_strings(tables["stops"]["stop_id"]),
+        "route": ids_to_strings(tables["routes"]["route_id"]),
+        "block": np.unique(ids_to_strings(tables["trips"]["block_id"])),
+        "shape": np.unique(ids_to_strings(tables["trips"]["shape_id"])),
+        "service": np.unique(np.concatenate([ids_to_strings(tables["trips"]["service_id"]), ids_to_strings(tables["calendar_dates"]["service_id"])])),
+    }
+
+# Writes every column of a dataframe into its own .npy file inside directory
+def save_table(df, directory):
+    os.makedirs(directory, exist_ok=True)
+    for column in df.columns:
+        np.save(os.path.join(directory, f"{column}.npy"), to_column_array(df[column]))
+    return list(df.columns)
+
+# Returns a signature of the static csv files that changes whenever the GitHub Workflow writes a new version of them
+def get_static_signature():
+    return static_dataset.get_signature()
+
+# Atomically makes version the active version of kind (static or realtime) and removes the older versions no longer kept
+def activate_version(kind, version):
+    pointer_file = os.path.join(plane_dir, f"{kind}.current")
+    temp_pointer_file = f"{pointer_file}.{os.getpid()}.tmp"
+    with open(temp_pointer_file, "w") as f:
+        f.write(version)
+    os.replace(temp_pointer_file, pointer_file)
+
+    versions = sorted(d for d in os.listdir(plane_dir) if d.startswith(f"{kind}-") and os.path.isdir(os.path.join(plane_dir, d)))
+    for old_version in versions[:-kept_versions]:
+        if old_version != version:
+            shutil.rmtree(os.path.join(plane_dir, old_version), ignore_errors=True)
+
+# Returns a new unique version name for kind. Version names sort in the order they were published
+def new_version(kind):
+    return f"{kind}-{time.time_ns():020d}"
+
+# Parses the static csv files of the active static dataset version and returns every static table as a dataframe along with the stop_times indexes
+def build_static_tables():
+    # Every file is read from the same version even if a new version is activated while they are being read
+    static_dir = static_dataset.get_static_dir()
+    tables = {}
+    for name in static_tables:
+        tables[name] = pd.read_csv(static_dataset.get_static_file(name, static_dir))
+
+    # Encode every id of the static tables with the id dictionary, and store small numbers with the smallest dtype holding them
+    ids = build_id_dictionary(tables)
+    id_lookups = {kind: pd.Index(ids[kind]) for kind in id_kinds}
+    trips = tables["trips"]
+    for kind, column in [("route", "route_id"), ("block", "block_id"), ("shape", "shape_id"), ("service", "service_id")]:
+        trips[kind] = to_code_array(id_lookups[kind].get_indexer(ids_to_strings(trips[column])), len(ids[kind]))
+    trips["direction_id"] = trips["direction_id"].fillna(0).astype(np.int8)
+    tables["calendar_dates"]["service"] = to_code_array(id_lookups["service"].get_indexer(ids_to_strings(tables["calendar_dates"]["service_id"])), len(ids["service"]))
+
+    # The points of the line followed by the trips of every shape, sorted by shape and shape_pt_sequence. Versions ingested before
+    # shapes.txt was saved have no points, and the trips of shapes without points follow the straight lines between their stops
+    shapes_file = static_dataset.get_static_file("shapes", static_dir)
+    shapes = pd.read_csv(shapes_file) if os.path.exists(shapes_file) else pd.DataFrame(
+        {"shape_id": [], "shape_pt_lat": [], "shape_pt_lon": [], "shape_pt_sequence": []})
+    shape_points = pd.DataFrame({
+        "shape": to_code_array(id_lookups["shape"].get_indexer(ids_to_strings(shapes["shape_id"])), len(ids["shape"])),
+        "shape_pt_sequence": shapes["shape_pt_sequence"].to_numpy(),
+        "lat": shapes["shape_pt_lat"].to_numpy(dtype=np.float64),
+        "lon": shapes["shape_pt_lon"].to_numpy(dtype=np.float64),
+        "shape_dist_traveled": (shapes["shape_dist_traveled"] if "shape_dist_traveled" in shapes else pd.Series(np.nan, index=shapes.index)).to_numpy(dtype=np.float32),
+    })
+    shape_points = shape_points[shape_points["shape"] >= 0].sort_values(["shape", "shape_pt_sequence"], kind="stable")
+    tables["shape_points"] = shape_points.drop(columns=["shape_pt_sequence"]).reset_index(drop=True)
+
+    # The trip_id of every stop time is encoded as the row of that trip in trips so that stop_times only contains numbers
+    trip_ids = id_lookups["trip"]
+    stop_times_list = []
+    for file in static_dataset.get_stop_times_files(static_dir):
+        stop_times_chunk = pd.read_csv(file, usecols=["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence", "shape_dist_traveled"],
+                                       dtype={"trip_id": str, "arrival_time": str, "departure_time": str})
+        stop_times_list.append(pd.DataFrame({
+            "trip": trip_ids.get_indexer(stop_times_chunk["trip_id"]).astype(np.int32),
+            "arrival": gtfs_time_to_seconds(stop_times_chunk["arrival_time"]),
+            "departure": gtfs_time_to_seconds(stop_times_chunk["departure_time"]),
+            "stop": to_code_array(id_lookups["stop"].get_indexer(ids_to_strings(stop_times_chunk["stop_id"])), len(ids["stop"])),
+            "stop_id": stop_times_chunk["stop_id"].astype(np.int32),
+            "stop_sequence": stop_times_chunk["stop_sequence"].astype(np.int16),
+            "shape_dist_traveled": stop_times_chunk["shape_dist_traveled"].astype(np.float32),
+        }))
+    stop_times = pd.concat(stop_times_list, ignore_index=True) if stop_times_list else pd.DataFrame(
+        {"trip": [], "arrival": [], "departure": [], "stop": [], "stop_id": [], "stop_sequence": [], "shape_dist_traveled": []})
+    stop_times = stop_times[stop_times["trip"] >= 0].sort_values(["trip", "stop_sequence"], kind="stable").reset_index(drop=True)
+
+    # Index used to get all the stop times of a trip: the stop times of trip i are the rows trip_offsets[i] to trip_offsets[i + 1]
+    trip_offsets = np.searchsorted(stop_times["trip"].to_numpy(), np.arange(len(trip_ids) + 1)).astype(np.int64)
+    tables["indexes"] = {"trip_offsets": trip_offsets}
+    tables["indexes"].update({f"ids_{kind}": ids[kind] for kind in id_kinds})
+    # Index used to get the line of a shape: the points of shape i are the rows shape_offsets[i] to shape_offsets[i + 1] of shape_points
+    tables["indexes"]["shape_offsets"] = np.searchsorted(tables["shape_points"]["shape"].to_numpy(), np.arange(len(ids["shape"]) + 1)).astype(np.int64)
+    # Only the deduplicated patterns and timings of the stop times are kept (see build_patterns)
+    build_patterns(tables, stop_times, trip_offsets)
+    # The trip ids are only kept in the id dictionary since the code of a trip is its row in trips
+    tables["trips"] = tables["trips"].drop(columns=["trip_id"])
+
+    # Family of every route such as 6 for the 6, 6A and 6B, used to include the variants of a route
+    route_short_names = tables["routes"]["route_short_name"].astype(str)
+    tables["routes"]["route_family"] = route_short_names.str.extract(r"^(\d+)", expand=False).fillna(route_short_names)
+
+    # Every route served at each stop on each service day, stored as the row of the route in routes. The routes served at the stop
+    # stop_routes_ids[i] are the rows stop_routes_offsets[i] to stop_routes_offsets[i + 1] of stop_routes
+    stop_times_trips = stop_times["trip"].to_numpy()
+    stop_routes = pd.DataFrame({
+        "stop_id": stop_times["stop_id"].to_numpy(),
+        "service_id": tables["trips"]["service_id"].to_numpy()[stop_times_trips],
+        "route": tables["trips"]["route"].to_numpy()[stop_times_trips],
+    }).drop_duplicates().sort_values(["stop_id", "service_id", "route"]).reset_index(drop=True)
+    tables["stop_routes"] = stop_routes
+    stop_routes_ids, stop_routes_offsets = np.unique(stop_routes["stop_id"].to_numpy(), return_index=True)
+    tables["indexes"]["stop_routes_ids"] = stop_routes_ids
+    tables["indexes"]["stop_routes_offsets"] = np.append(stop_routes_offsets, len(stop_routes)).astype(np.int64)
+    return tables
+
+# Deduplicates the stop times into stop patterns and timings, and adds them to tables along with their indexes.
+# Most trips stop at the same stops as many other trips with the same running times, only starting at a different time. Every
+# distinct sequence of stops (with their stop_sequence and shape_dist_traveled) is stored once as a pattern in the patterns table,
+# every distinct sequence of arrival and departure times relative to the first arrival of the trip is stored once as a timing in
+# the timings table, and every trip only has the pattern, timing and start time it runs with. The stop time at position k of trip t
+# is row pattern_offsets[pattern[t]] + k of patterns and row timing_offsets[timing[t]] + k of timings, plus start[t].
+# ----------------------------------------------------------------------------------
+# tables is the dictionary of static tables being built, which must already contain trips and indexes
+# stop_times is the dataframe of every stop time sorted by trip and stop_sequence
+# trip_offsets is the index of the stop times of every trip in stop_times
+# ----------------------------------------------------------------------------------
+def build_patterns(tables, stop_times, trip_offsets):
+    trip_count = len(trip_offsets) - 1
+    lengths = np.diff(trip_offsets)
+    has_stop_times = lengths > 0
+    arrivals = stop_times["arrival"].to_numpy().astype(np.int32)
+    departures = stop_times["departure"].to_numpy().astype(np.int32)
+    start = np.full(trip_count, -1, dtype=np.int32)
+    start[has_stop_times] = arrivals[trip_offsets[:-1][has_stop_times]]
+    # Times relative to the first arrival, which are the same for trips with the same running times. Missing times stay -1 once the
+    # start time is added back
+    row_starts = np.repeat(start, lengths)
+    time_keys = np.column_stack([arrivals - row_starts, departures - row_starts]).astype(np.int32)
+    stop_keys = np.column_stack([
+        stop_times["stop"].to_numpy().astype(np.int32),
+        stop_times["stop_sequence"].to_numpy().astype(np.int32),
+        stop_times["shape_dist_traveled"].to_numpy().astype(np.float32).view(np.int32),
+    ])
+
+    pattern = np.full(trip_count, -1, dtype=np.int32)
+    timing = np.full(trip_count, -1, dtype=np.int32)
+    pattern_ids = {}
+    timing_ids = {}
+    pattern_trips = []
+    timing_trips = []
+    for trip in np.flatnonzero(has_stop_times):
+        rows = slice(trip_offsets[trip], trip_offsets[trip + 1])
+        pattern[trip] = pattern_ids.setdefault(stop_keys[rows].tobytes(), len(pattern_ids))
+        if pattern[trip] == len(pattern_trips):
+            pattern_trips.append(trip)
+        timing[trip] = timing_ids.setdefault((pattern[trip], time_keys[rows].tobytes()), len(timing_ids))
+        if timing[trip] == len(timing_trips):
+            timing_trips.append(trip)
+
+    # The stop times of the first trip running each pattern and timing
+    def get_first_trip_rows(first_trips):
+        first_trips = np.asarray(first_trips, dtype=np.int64)
+        first_lengths = lengths[first_trips]
+        offsets = np.concatenate([[0], np.cumsum(first_lengths)]).astype(np.int64)
+        rows = np.repeat(trip_offsets[first_trips] - offsets[:-1], first_lengths) + np.arange(offsets[-1])
+        return rows, offsets
+
+    pattern_rows, pattern_offsets = get_first_trip_rows(pattern_trips)
+    timing_rows, timing_offsets = get_first_trip_rows(timing_trips)
+    tables["patterns"] = stop_times.iloc[pattern_rows][["stop", "stop_id", "stop_sequence", "shape_dist_traveled"]].reset_index(drop=True)
+    tables["timings"] = pd.DataFrame({"arrival": time_keys[timing_rows, 0], "departure": time_keys[timing_rows, 1]})
+    tables["trips"]["pattern"] = pattern
+    tables["trips"]["timing"] = timing
+    tables["trips"]["start"] = start
+
+    # Index used to get all the trips of a pattern: the trips of pattern i are pattern_trips[pattern_trip_offsets[i]:pattern_trip_offsets[i + 1]]
+    # sorted by start time
+    trip_order = np.lexsort((start, pattern))
+    trip_order = trip_order[pattern[trip_order] >= 0]
+    # Index used to get all the patterns serving a stop: the rows stop_pattern_rows[stop_offsets[i]:stop_offsets[i + 1]] of patterns
+    # are the stop times of the stop stop_index_ids[i] in every pattern
+    pattern_stop_ids = tables["patterns"]["stop_id"].to_numpy()
+    stop_pattern_rows = np.argsort(pattern_stop_ids, kind="stable").astype(np.int64)
+    stop_index_ids, stop_offsets = np.unique(pattern_stop_ids[stop_pattern_rows], return_index=True)
+    tables["indexes"].update({
+        "pattern_offsets": pattern_offsets,
+        "timing_offsets": timing_offsets,
+        "pattern_trips": trip_order.astype(np.int64),
+        "pattern_trip_offsets": np.searchsorted(pattern[trip_order], np.arange(len(pattern_trips) + 1)).astype(np.int64),
+        "stop_pattern_rows": stop_pattern_rows,
+        "stop_index_ids": stop_index_ids,
+        "stop_offsets": np.append(stop_offsets, len(stop_pattern_rows)).astype(np.int64),
+    })
+
+# Columns of the stop_times table, which is rebuilt from the patterns and timings (see StopTimes)
+stop_times_columns = ["trip", "arrival", "departure", "stop", "stop_id", "stop_sequence", "shape_dist_traveled"]
+
+# Returns a column of the stop times at some positions of some trips, read directly from the patterns and timings
+# ----------------------------------------------------------------------------------
+# tables is the dictionary of tables of a static version
+# trips is a numpy array with the row in trips of every stop time
+# positions is a numpy array with the position of every stop time in its trip, starting at 0
+# column is one of stop_times_columns
+# ----------------------------------------------------------------------------------
+def get_stop_time_values(tables, trips, positions, column):
+    trips = np.asarray(trips, dtype=np.int64)
+    if column == "trip":
+        return trips.astype(np.int32)
+    if column in ["arrival", "departure"]:
+        rows = np.asarray(tables["indexes"]["timing_offsets"])[np.asarray(tables["trips"]["timing"])[trips]] + positions
+        return (np.asarray(tables["trips"]["start"])[trips] + np.asarray(tables["timings"][column])[rows]).astype(np.int32)
+    rows = np.asarray(tables["indexes"]["pattern_offsets"])[np.asarray(tables["trips"]["pattern"])[trips]] + positions
+    return np.asarray(tables["patterns"][column])[rows]
+
+# The stop_times table of a static version with one row per stop time sorted by trip and stop_sequence, where the stop times of trip
+# i are the rows trip_offsets[i] to trip_offsets[i + 1]. Each column is only expanded from the patterns and timings the first time it
+# is used, so that code going through every stop time keeps working while only the deduplicated timetable is stored
+class StopTimes(dict):
+    def __init__(self, tables):
+        super().__init__()
+        self.tables = tables
+        self.lock = threading.Lock()
+        self.positions = None
+
+    # Returns the trip and the position in that trip of every row
+    def get_positions(self):
+        with self.lock:
+            if self.positions is None:
+                trip_offsets = np.asarray(self.tables["indexes"]["trip_offsets"])
+                lengths = np.diff(trip_offsets)
+                trips = np.repeat(np.arange(len(lengths)), lengths)
+                self.positions = (trips, np.arange(trip_offsets[-1]) - np.repeat(trip_offsets[:-1], lengths))
+            return self.positions
+
+    def __missing__(self, column):
+        if column not in stop_times_columns:
+            raise KeyError(column)
+        trips, positions = self.get_positions()
+        values = get_stop_time_values(self.tables, trips, positions, column)
+        self[column] = values
+        return values
+
+# Returns the trips and positions in their trips of every stop time at several stops, sorted by stop_id and then arrival time
+# ----------------------------------------------------------------------------------
+# static is the static data returned by get_static()
+# stop_ids is a numpy array of stop ids
+# ----------------------------------------------------------------------------------
+def get_stop_trip_positions(static, stop_ids):
+    tables = static["tables"]
+    indexes = tables["indexes"]
+    stop_ids = np.asarray(stop_ids, dtype=np.int64)
+    stop_index_ids = np.asarray(indexes["stop_index_ids"])
+    found = np.searchsorted(stop_index_ids, stop_ids)
+    known = found < len(stop_index_ids)
+    known[known] = stop_index_ids[found[known]] == stop_ids[known]
+    found = found[known]
+
+    # Every row of patterns at those stops, and then every trip of each of those patterns
+    stop_offsets = np.asarray(indexes["stop_offsets"])
+    stop_counts = stop_offsets[found + 1] - stop_offsets[found]
+    pattern_rows = np.asarray(indexes["stop_pattern_rows"])[np.repeat(stop_offsets[found] - np.cumsum(stop_counts) + stop_counts, stop_counts) + np.arange(stop_counts.sum())]
+    pattern_offsets = np.asarray(indexes["pattern_offsets"])
+    patterns = np.searchsorted(pattern_offsets, pattern_rows, side="right") - 1
+    pattern_trip_offsets = np.asarray(indexes["pattern_trip_offsets"])
+    trip_counts = pattern_trip_offsets[patterns + 1] - pattern_trip_offsets[patterns]
+    trips = np.asarray(indexes["pattern_trips"])[np.repeat(pattern_trip_offsets[patterns] - np.cumsum(trip_counts) + trip_counts, trip_counts) + np.arange(trip_counts.sum())]
+    positions = np.repeat(pattern_rows - pattern_offsets[patterns], trip_counts)
+
+    order = np.lexsort((get_stop_time_values(tables, trips, positions, "arrival"), get_stop_time_values(tables, trips, positions, "stop_id")))
+    return trips[order], positions[order]
+
+# Parses the static csv files and publishes them along with the stop_times indexes as a new static version
+def publish_static():
+    # The signature is taken before parsing so that a static version activated in the meantime is published on the next check
+    signature = get_static_signature()
+    return write_static_version(build_static_tables(), signature)
+
+# Writes the tables returned by build_static_tables as a new static version and activates it
+# ----------------------------------------------------------------------------------
+# tables is the dictionary returned by build_static_tables
+# signature is the signature of the static csv files the tables were parsed from
+# ----------------------------------------------------------------------------------
+def write_static_version(tables, signature):
+    version = new_version("static")
+    version_dir = os.path.join(plane_dir, version)
+    manifest = {"signature": signature, "tables": {}}
+
+    tables = dict(tables)
+    indexes = tables.pop("indexes")
+    for name, df in tables.items():
+        manifest["tables"][name] = save_table(df, os.path.join(version_dir, name))
+    indexes_dir = os.path.join(version_dir, "indexes")
+    os.makedirs(indexes_dir)
+    for name, index in indexes.items():
+        np.save(os.path.join(indexes_dir, f"{name}.npy"), index)
+
+    with open(os.path.join(version_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    activate_version("static", version)
+    return version
+
+# Publishes the content of bus_updates.json and trip_updates.json as a new realtime version
+def publish_realtime():
+    version = new_version("realtime")
+    version_dir = os.path.join(plane_dir, version)
+    # The ids of the realtime data are also saved encoded with the id dictionary of the active static version
+    static = get_static()
+    manifest = {"published": time.time(), "static_version": static["version"], "tables": {}}
+    for name, columns in [("bus_updates", bus_columns), ("trip_updates", trip_update_columns)]:
+        with open(os.path.join("data", f"{name}.json"), "r") as f:
+            records = json.load(f)
+        # Snapshots saved before a column was added don't have it, in which case it is saved as 0
+        df = pd.DataFrame(records, columns=list(columns))
+        df = df.fillna({column: 0 for column, dtype in columns.items() if dtype is np.int64}).astype(columns)
+        manifest["tables"][name] = save_table(df, os.path.join(version_dir, name))
+        codes = pd.DataFrame({kind: encode_ids(static, kind, df[column]) for kind, column in realtime_id_columns[name].items()})
+        manifest["tables"][f"{name}_ids"] = save_table(codes, os.path.join(version_dir, f"{name}_ids"))
+    with open(os.path.join(version_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    activate_version("realtime", version)
+    return version
+
+# Returns the signature of the static csv files used by the active static version or None if nothing has been published yet
+def get_published_static_signature():
+    version = get_active_version("static")
+    if version is None:
+        return None
+    try:
+        with open(os.path.join(plane_dir, version, "manifest.json"), "r") as f:
+            return json.load(f)["signature"]
+    except (OSError, ValueError):
+        return None
+
+# Loop run by the single refresher process. Publishes a new static version whenever the static csv files change and downloads
+# and publishes the realtime data every realtime_refresh_seconds
+def run_refresher():
+    os.makedirs(plane_dir, exist_ok=True)
+    static_signature = get_published_static_signature()
+    last_realtime_refresh = 0
+    # The timetables of every stop are built when the refresher starts and for every new static version, in their own process
+    build_timetables = True
+    while True:
+        try:
+            signature = get_static_signature()
+            if signature != static_signature:
+                publish_static()
+                attach_latest("static")
+                static_signature = signature
+                build_timetables = True
+        except Exception as e:
+            print(f"Error publishing static data: {e}", flush=True)
+        try:
+            import timetables
+            if build_timetables and get_active_version("static") is not None:
+                build_timetables = False
+                timetables.start_build()
+            timetables.check_build()
+        except Exception as e:
+            print(f"Error building timetables: {e}", flush=True)
+
+        if time.monotonic() - last_realtime_refresh >= realtime_refresh_seconds:
+            last_realtime_refresh = time.monotonic()
+            # BC Transit and the GitHub fallback are called through the circuit breakers of realtime_cache, and a new version is only
+            # published when new data was downloaded so workers keep serving the last good version otherwise
+            import realtime_cache
+            refreshed = realtime_cache.refresh()
+            if refreshed or get_active_version("realtime") is None:
+                try:
+                    publish_realtime()
+                    # The departure boards are built once here for every worker and published into the new realtime version
+                    try:
+                        import departure_boards
+                        attach_latest("realtime")
+                        departure_boards.publish_boards()
+                    except Exception as e:
+                        print(f"Error publishing departure boards: {e}", flush=True)
+                except Exception as e:
+                    print(f"Error publishing realtime data: {e}", flush=True)
+            # The refresher is the only process updating the on-time performance counters while the data plane is enabled
+            try:
+                import on_time
+                on_time.update_from_snapshot()
+            except Exception as e:
+                print(f"Error updating on-time performance: {e}", flush=True)
+            # and the only process archiving the vehicle positions the segment travel time model is trained on
+            try:
+                import segment_model
+                segment_model.archive_snapshot()
+            except Exception as e:
+                print(f"Error archiving vehicle positions: {e}", flush=True)
+            # and the only process extracting the stop arrival and departure events
+            try:
+                import stop_events
+                stop_events.update_from_snapshot()
+            except Exception as e:
+                print(f"Error extracting stop events: {e}", flush=True)
+        time.sleep(1)
+
+# Returns the name of the active version of kind or None if nothing has been published yet
+def get_active_version(kind):
+    try:
+        with open(os.path.join(plane_dir, f"{kind}.current"), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+# Memory maps every column of every table of a published version read-only
+def attach_version(version):
+    version_dir = os.path.join(plane_dir, version)
+    with open(os.path.join(version_dir, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    tables = {}
+    for name, columns in manifest["tables"].items():
+        tables[name] = {column: np.load(os.path.join(version_dir, name, f"{column}.npy"), mmap_mode="r") for column in columns}
+    indexes_dir = os.path.join(version_dir, "indexes")
+    if os.path.isdir(indexes_dir):
+        tables["indexes"] = {file[:-4]: np.load(os.path.join(indexes_dir, file), mmap_mode="r") for file in os.listdir(indexes_dir)}
+    if "patterns" in tables:
+        tables["stop_times"] = StopTimes(tables)
+    return {"version": version, "manifest": manifest, "tables": tables, "cache": {}}
+
+# Returns the attached active version of kind, attaching a newer version if one has been published since the last check.
+# Returns None if the data plane is disabled or nothing has been published yet
+def get_attached(kind):
+    if not is_enabled():
+        return None
+    state = attached[kind]
+    if time.monotonic() - state["checked"] < attach_check_seconds:
+        return state["data"]
+    with attach_lock:
+        if time.monotonic() - state["checked"] >= attach_check_seconds:
+            version = get_active_version(kind)
+            if version and version != state["version"]:
+                try:
+                    state["data"] = attach_version(version)
+                    state["version"] = version
+                except OSError as e:
+                    # The version was replaced while being attached so keep using the previous one until the next check
+                    print(f"Error attaching {version}: {e}", flush=True)
+            state["checked"] = time.monotonic()
+    return state["data"]
+
+# Attaches the active version of kind right away instead of at the next check, e.g. right after the refresher published it
+def attach_latest(kind):
+    with attach_lock:
+        attached[kind]["checked"] = 0
+    return get_attached(kind)
+
+# Returns a value derived from an attached version, computing it only once per version
+def get_cached(data, key, build):
+    if key not in data["cache"]:
+        data["cache"][key] = build()
+    return data["cache"][key]
+
+# Builds the static tables in this process in the same format as an attached static version
+def build_local_static(signature):
+    tables = build_static_tables()
+    indexes = tables.pop("indexes")
+    tables = {name: {column: to_column_array(df[column]) for column in df.columns} for name, df in tables.items()}
+    tables["indexes"] = indexes
+    tables["stop_times"] = StopTimes(tables)
+    return {"version": f"local-{time.time_ns()}", "manifest": {"signature": signature}, "tables": tables, "cache": {}}
+
+# Rebuilds the static tables of this process in a background thread. Requests keep using the previous tables until the new ones are ready
+def rebuild_local_static(signature):
+    try:
+        local_static["data"] = build_local_static(signature)
+        local_static["signature"] = signature
+    except Exception as e:
+        print(f"Error rebuilding static data: {e}", flush=True)
+    finally:
+        local_static["rebuilding"] = False
+
+# Returns the static tables in the same format as an attached static version. When the data plane is disabled, the tables are
+# built in this process instead and rebuilt in the background whenever a new static dataset version is activated
+def get_static():
+    static = get_attached("static")
+    if static is not None:
+        return static
+    if local_static["data"] is None:
+        with attach_lock:
+            if local_static["data"] is None:
+                signature = get_static_signature()
+                local_static["data"] = build_local_static(signature)
+                local_static["signature"] = signature
+                local_static["checked"] = time.monotonic()
+        return local_static["data"]
+    if time.monotonic() - local_static["checked"] >= local_check_seconds:
+        with attach_lock:
+            if time.monotonic() - local_static["checked"] >= local_check_seconds:
+                local_static["checked"] = time.monotonic()
+                signature = get_static_signature()
+                if signature != local_static["signature"] and not local_static["rebuilding"]:
+                    local_static["rebuilding"] = True
+                    threading.Thread(target=rebuild_local_static, args=(signature,), name="static-rebuild", daemon=True).start()
+    return local_static["data"]
+
+# Returns a value that changes whenever new realtime data is available: the active realtime version when the data plane is enabled,
+# or the modification times and sizes of bus_updates.json and trip_updates.json otherwise
+def get_realtime_signature():
+    if is_enabled():
+        return get_realtime_version()
+    signature = []
+    for data_file in [os.path.join("data", "bus_updates.json"), os.path.join("data", "trip_updates.json")]:
+        try:
+            file_stat = os.stat(data_file)
+            signature.append((file_stat.st_mtime_ns, file_stat.st_size))
+        except OSError:
+            signature.append(None)
+    return tuple(signature)
+
+# Returns a column of an attached table as a pandas Series. Text columns with many repeated values, such as headsigns, become categories
+def to_dataframe_column(values):
+    values = np.asarray(values)
+    if values.dtype.kind == "U" and len(values) and len(np.unique(values)) < len(values) // 2:
+        return pd.Categorical(values)
+    return values
+
+# Returns one of the static tables (trips, stops, routes or calendar_dates) as a dataframe or None if the data plane is not available
+def load_table(name):
+    static = get_attached("static")
+    if static is None:
+        return None
+    def build():
+        df = pd.DataFrame({column: to_dataframe_column(values) for column, values in static["tables"][name].items()})
+        if name == "trips":
+            df.insert(2, "trip_id", np.asarray(static["tables"]["indexes"]["ids_trip"]))
+        return df
+
+    return get_cached(static, name, build)
+
+# Returns the realtime data as the same list of dictionaries as bus_updates.json or trip_updates.json or None if the data plane is not available
+# ----------------------------------------------------------------------------------
+# name is either bus_updates or trip_updates
+# ----------------------------------------------------------------------------------
+def load_realtime(name):
+    realtime = get_attached("realtime")
+    if realtime is None:
+        return None
+
+    def build():
+        columns = {column: values.tolist() for column, values in realtime["tables"][name].items()}
+        return [dict(zip(columns, row)) for row in zip(*columns.values())]
+
+    return get_cached(realtime, name, build)
+
+# Returns the version of the active realtime data or None if the data plane is not available
+def get_realtime_version():
+    realtime = get_attached("realtime")
+    return realtime["version"] if realtime else None
+
+# Returns a dataframe in the same format as the stop_times csv files from the stop times at some positions of some trips
+# ----------------------------------------------------------------------------------
+# static is the attached static version
+# trips is a numpy array with the row in trips of every stop time to include
+# positions is a numpy array with the position of every stop time in its trip
+# ----------------------------------------------------------------------------------
+def build_stop_times_df(static, trips, positions):
+    def get_values(column):
+        return get_stop_time_values(static["tables"], trips, positions, column)
+
+    return pd.DataFrame({
+        "trip_id": decode_ids(static, "trip", trips),
+        "arrival_time": seconds_to_gtfs_time(get_values("arrival")),
+        "departure_time": seconds_to_gtfs_time(get_values("departure")),
+        "stop_id": get_values("stop_id"),
+        "stop_sequence": get_values("stop_sequence"),
+        "shape_dist_traveled": get_values("shape_dist_traveled"),
+    })
+
+# Returns the index of the id dictionary of kind (one of id_kinds) for this version. Built once per version and worker
+def get_id_lookup(static, kind):
+    return get_cached(static, ("id_lookup", kind), lambda: pd.Index(np.asarray(static["tables"]["indexes"][f"ids_{kind}"])))
+
+# Returns the code of every id in values, or -1 for ids which are not in the static data
+# ----------------------------------------------------------------------------------
+# static is the static data returned by get_static()
+# kind is one of id_kinds
+# values is a list, numpy array or pandas Series of ids
+# ----------------------------------------------------------------------------------
+def encode_ids(static, kind, values):
+    return to_code_array(get_id_lookup(static, kind).get_indexer(ids_to_strings(values)), len(get_id_lookup(static, kind)))
+
+# Returns the original ids of codes, with an empty string for -1
+def decode_ids(static, kind, codes):
+    ids = np.asarray(static["tables"]["indexes"][f"ids_{kind}"])
+    codes = np.asarray(codes)
+    return np.where(codes >= 0, ids[np.maximum(codes, 0)], "")
+
+# Returns the row of every trip in trips for this version, which is also its code
+def get_trip_lookup(static):
+    return get_id_lookup(static, "trip")
+
+# Returns the codes of the ids of a realtime snapshot, e.g. get_realtime_codes(static, "bus_updates", buses)["trip"] for the trip run by every bus.
+# The codes saved along with the attached realtime version are used when they were encoded with the same static version
+# ----------------------------------------------------------------------------------
+# static is the static data returned by get_static()
+# name is either bus_updates or trip_updates
+# records is the list of dictionaries of that snapshot
+# ----------------------------------------------------------------------------------
+def get_realtime_codes(static, name, records):
+    realtime = get_attached("realtime")
+    if realtime is not None and realtime["manifest"].get("static_version") == static["version"] and f"{name}_ids" in realtime["tables"]:
+        codes = realtime["tables"][f"{name}_ids"]
+        if all(len(codes[kind]) == len(records) for kind in codes):
+            return {kind: np.asarray(values) for kind, values in codes.items()}
+    key = (static["version"], get_realtime_signature(), name, len(records))
+    with local_realtime_lock:
+        if local_realtime_codes["key"] != (key[0], key[1]):
+            local_realtime_codes["key"] = (key[0], key[1])
+            local_realtime_codes["codes"] = {}
+        if key not in local_realtime_codes["codes"]:
+            local_realtime_codes["codes"][key] = {
+                kind: encode_ids(static, kind, [record[column] for record in records]) for kind, column in realtime_id_columns[name].items()
+            }
+        return local_realtime_codes["codes"][key]
+
+# Returns all the stop times of trip_id or None if the data plane is not available
+def load_trip_stop_times(trip_id):
+    static = get_attached("static")
+    if static is None:
+        return None
+    trip = get_trip_lookup(static).get_indexer([trip_id])[0]
+    if trip < 0:
+        return pd.DataFrame()
+    trip_offsets = static["tables"]["indexes"]["trip_offsets"]
+    stop_time_count = int(trip_offsets[trip + 1] - trip_offsets[trip])
+    return build_stop_times_df(static, np.full(stop_time_count, trip), np.arange(stop_time_count))
+
+# Returns the departure time from the first stop of every trip in trip_ids or None if the data plane is not available
+def load_first_departures(trip_ids):
+    static = get_attached("static")
+    if static is None:
+        return None
+    trips = get_trip_lookup(static).get_indexer(list(trip_ids))
+    trips = trips[trips >= 0]
+    trip_offsets = static["tables"]["indexes"]["trip_offsets"]
+    # Trips without any stop times have the same start and end offsets
+    trips = trips[trip_offsets[trips] < trip_offsets[trips + 1]]
+    first_stop_times = build_stop_times_df(static, trips, np.zeros(len(trips), dtype=np.int64))
+    return first_stop_times[["trip_id", "stop_sequence", "departure_time"]]
+
+if __name__ == "__main__":
+    run_refresher()
@@ -0,0 +1,175 @@
+import json
+import os
+import shutil
+import threading
+import time
+from datetime import date, datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+
+import arrivals
+import data_plane
+import eta_engine
+import route_index
+import timetables
+
+# Departure boards of every stop materialized once per realtime snapshot.
+# Instead of joining the schedule, trip updates and buses for one stop every time someone opens the next buses page, the arrivals
+# engine is run once for every stop at the same time whenever a new realtime snapshot comes in, keeping the next board_capacity
+# arrivals of every stop sorted by stop and estimated arrival time. Every board is then a slice of that table found with a dictionary
+# read, so serving a board costs the same whether one person or a thousand are looking at the next buses, and the work done per
+# snapshot doesn't depend on how many people are.
+# When the data plane is enabled the boards are built by the refresher right after it publishes a realtime version and written into
+# that version as columns of .npy files, so no request ever waits for them and they are built once instead of once per worker. Until
+# they have been written, or if they were built for another service day, the requested stops are computed on the spot instead. When
+# the data plane is disabled every process builds the boards itself on the first request after each snapshot.
+# Arrivals which happen before the next snapshot are dropped when a board is read, which is why boards keep board_slack more arrivals
+# than the most any page shows. A board filtered by route, or one asked for more arrivals than it holds, can run out of arrivals before
+# the ones it left out, in which case that stop is computed by the arrivals engine on the spot like before.
+
+# Most arrivals shown for a stop, and how many more are kept for the arrivals which happen before the next snapshot
+board_size = 20
+board_slack = 10
+board_capacity = board_size + board_slack
+
+# Name of the directory of the boards inside a realtime version of the data plane
+boards_dir_name = "departure_boards"
+
+# The boards of the latest realtime snapshot and the static version, snapshot, service day and service ids they were built for
+boards = {"key": None, "boards": None}
+boards_lock = threading.Lock()
+
+# Returns the departure boards of every stop, or None if the data plane is enabled and the refresher hasn't published the boards
+# of the active realtime version for this service day and these service ids yet
+# ----------------------------------------------------------------------------------
+# service_ids is the list of service ids running today
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# Returns the arrivals of every board as returned by arrivals.get_arrivals along with the trip and estimated arrival time of every
+# arrival as arrays, the slice of the arrivals of every stop, and the start of the service day they are for
+# ----------------------------------------------------------------------------------
+def get_boards(service_ids, buses, current_trips):
+    service_ids = [int(service_id) for service_id in service_ids]
+    if data_plane.is_enabled():
+        board = load_published_boards()
+        service_day_start = eta_engine.get_service_day_start(datetime.now(ZoneInfo(eta_engine.service_timezone)))
+        if board is None or board["static_version"] != data_plane.get_static()["version"] or board["service_day_start"] != service_day_start or board["service_ids"] != sorted(service_ids):
+            return None
+        return board
+
+    static, state = eta_engine.get_engine_state(service_ids, buses, current_trips)
+    key = (static["version"], data_plane.get_realtime_signature(), len(buses), state["service_day_start"], tuple(sorted(service_ids)))
+    with boards_lock:
+        if boards["key"] != key:
+            boards["boards"] = build_boards(static, state, service_ids, buses, current_trips)
+            boards["key"] = key
+        return boards["boards"]
+
+# Returns the departure boards of every stop (see get_boards)
+def build_boards(static, state, service_ids, buses, current_trips):
+    stop_ids = np.asarray(static["tables"]["stops"]["stop_id"])
+    board_arrivals = arrivals.get_arrivals(stop_ids, service_ids, buses, current_trips, limit=board_capacity)
+    return index_boards(static, board_arrivals, state["service_day_start"])
+
+# Returns the departure boards from the arrivals of every board sorted by stop and estimated arrival time (see get_boards)
+def index_boards(static, board_arrivals, service_day_start):
+    board_stop_ids = board_arrivals["stop_id"].to_numpy()
+    starts = np.flatnonzero(np.r_[True, board_stop_ids[1:] != board_stop_ids[:-1]]) if len(board_stop_ids) else np.array([], dtype=np.int64)
+    ends = np.r_[starts[1:], len(board_stop_ids)].astype(np.int64)
+    return {
+        "arrivals": board_arrivals,
+        "trip": data_plane.get_trip_lookup(static).get_indexer(board_arrivals["trip_id"]),
+        "eta": board_arrivals["eta"].to_numpy(),
+        "slices": {int(board_stop_ids[first]): (int(first), int(last)) for first, last in zip(starts, ends)},
+        "service_day_start": service_day_start,
+    }
+
+# Builds the departure boards of every stop for the active realtime version and writes them into that version. Called by the data
+# plane refresher right after publish_realtime, with the service ids running today like the website
+# Returns the number of arrivals written
+def publish_boards():
+    version = data_plane.get_realtime_version()
+    buses = data_plane.load_realtime("bus_updates")
+    current_trips = data_plane.load_realtime("trip_updates")
+    static = data_plane.get_static()
+    service_ids = timetables.get_service_days(static).get(date.today().strftime("%Y%m%d"), [])
+    static, state = eta_engine.get_engine_state(service_ids, buses, current_trips)
+    board = build_boards(static, state, service_ids, buses, current_trips)
+
+    # The boards are renamed into place once completely written so workers never read half of them
+    boards_dir = os.path.join(data_plane.plane_dir, version, boards_dir_name)
+    temp_dir = f"{boards_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    try:
+        columns = data_plane.save_table(board["arrivals"], temp_dir)
+        with open(os.path.join(temp_dir, "manifest.json"), "w") as f:
+            json.dump({"static_version": static["version"], "service_day_start": int(board["service_day_start"]),
+                       "service_ids": sorted(int(service_id) for service_id in service_ids), "columns": columns}, f)
+        os.replace(temp_dir, boards_dir)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    return len(board["arrivals"])
+
+# Returns the departure boards published by the refresher for the active realtime version, reading them only once per version,
+# along with the static version, service day and service ids they were built for. Returns None if they haven't been published yet
+def load_published_boards():
+    realtime = data_plane.get_attached("realtime")
+    if realtime is None:
+        return None
+    if "departure_boards" not in realtime["cache"]:
+        boards_dir = os.path.join(data_plane.plane_dir, realtime["version"], boards_dir_name)
+        try:
+            with open(os.path.join(boards_dir, "manifest.json"), "r") as f:
+                manifest = json.load(f)
+            board_arrivals = pd.DataFrame({column: np.load(os.path.join(boards_dir, f"{column}.npy")) for column in manifest["columns"]})
+        except (OSError, ValueError):
+            # Not published yet, so look again on the next request
+            return None
+        board_arrivals = board_arrivals.astype(arrivals.arrival_dtypes)
+        board = index_boards(data_plane.get_static(), board_arrivals, manifest["service_day_start"])
+        board.update({"static_version": manifest["static_version"], "service_ids": manifest["service_ids"]})
+        realtime["cache"]["departure_boards"] = board
+    return realtime["cache"]["departure_boards"]
+
+# Returns the upcoming arrivals at several stops from the departure boards, in the same format as arrivals.get_arrivals
+# ----------------------------------------------------------------------------------
+# stop_ids, service_ids, buses, current_trips, route_short_names, include_variants, limit and merge are the same as for
+# arrivals.get_arrivals
+# ----------------------------------------------------------------------------------
+def get_departures(stop_ids, service_ids, buses, current_trips, route_short_names=None, include_variants=False, limit=10, merge=False):
+    if limit > board_size:
+        return arrivals.get_arrivals(stop_ids, service_ids, buses, current_trips, route_short_names, include_variants, limit, merge)
+    board = get_boards(service_ids, buses, current_trips)
+    if board is None:
+        return arrivals.get_arrivals(stop_ids, service_ids, buses, current_trips, route_short_names, include_variants, limit, merge)
+    stop_ids = np.unique(np.asarray([int(stop_id) for stop_id in stop_ids], dtype=np.int64))
+    slices = np.array([board["slices"].get(int(stop_id), (0, 0)) for stop_id in stop_ids], dtype=np.int64).reshape(-1, 2)
+    lengths = slices[:, 1] - slices[:, 0]
+    rows = np.repeat(slices[:, 0] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    row_stops = np.repeat(np.arange(len(stop_ids)), lengths)
+
+    # Only keep the arrivals that haven't happened yet and, if asked, those of the selected routes
+    keep = board["eta"][rows] >= int(time.time()) - board["service_day_start"]
+    if route_short_names:
+        route_mask = np.zeros(len(data_plane.get_static()["tables"]["trips"]["route"]), dtype=bool)
+        for route_short_name in route_short_names:
+            route_mask |= route_index.get_route_trip_mask(route_short_name, include_variants)
+        trip = board["trip"][rows]
+        keep &= (trip >= 0) & route_mask[np.maximum(trip, 0)]
+    rows = rows[keep]
+    row_stops = row_stops[keep]
+
+    # A full board may have left out arrivals that are now needed, in which case its stop is computed from scratch
+    short = (lengths == board_capacity) & (np.bincount(row_stops, minlength=len(stop_ids)) < limit)
+    departures = board["arrivals"].iloc[rows[~short[row_stops]]]
+    departures = departures.groupby("stop_id", sort=False).head(limit)
+    if short.any():
+        computed = arrivals.get_arrivals(stop_ids[short], service_ids, buses, current_trips, route_short_names, include_variants, limit)
+        departures = pd.concat([departures, computed]).sort_values(["stop_id", "eta"], kind="stable")
+    if merge:
+        departures = departures.sort_values(["eta", "stop_id"], kind="stable").head(limit)
+    return departures.reset_index(drop=True)
+
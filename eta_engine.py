@@ -0,0 +1,221 @@
+import os
+import threading
+from datetime import datetime, time as dt_time
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+
+import data_plane
+import segment_model
+
+# Delay-propagated ETA engine.
+# trip_updates.json only contains predictions for trips running in the next 2 hours, so any later trip would otherwise only be
+# given its scheduled time even if the bus that will run it is already running late. Once per realtime snapshot, the current delay
+# of every running bus is taken from trip_updates.json and carried through the rest of its trip and then through every later trip of
+# its block. At each terminal, the scheduled layover between trips is used to recover the delay (minus a minimum layover the driver
+# takes anyway) and an early bus waits for its scheduled departure, so the delay carried into the next trip is
+# max(0, delay - (next departure - previous arrival - min_layover_seconds)).
+# The propagation works on integer second arrays for every trip running today and loops over the position of a trip inside its
+# block rather than over trips, so a whole service day is done in a handful of vectorized steps. The result is a single delay per trip
+# which is added to the scheduled arrival times of any stop when a request is made.
+# Once segment_model.py has been trained, the remaining stops of every trip with a bus running it are instead predicted from the
+# learned travel times of its segments, starting from the estimated arrival at its next stop.
+
+min_layover_seconds = int(os.environ.get("MIN_LAYOVER_SECONDS", "60"))
+service_timezone = "America/Los_Angeles"
+
+# ETA sources, also shown to users so they can tell how an arrival time was estimated
+eta_sources = ["scheduled", "realtime", "propagated", "learned"]
+
+# The propagated delays of the latest realtime snapshot
+engine_state = {"key": None, "state": None}
+engine_lock = threading.Lock()
+
+# Returns the unix timestamp of the start of today's service day, used to convert realtime unix timestamps into GTFS seconds
+# ----------------------------------------------------------------------------------
+# now is the current datetime in the service timezone
+# ----------------------------------------------------------------------------------
+def get_service_day_start(now):
+    return int(datetime.combine(now.date(), dt_time(0), now.tzinfo).timestamp())
+
+# Returns the propagated delay and realtime data for every trip of the static data
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# service_ids is the list of service ids running today
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# service_day_start is the unix timestamp of the start of today's service day
+# ----------------------------------------------------------------------------------
+def build_engine_state(static, service_ids, buses, current_trips, service_day_start):
+    trips = static["tables"]["trips"]
+    stop_times = static["tables"]["stop_times"]
+    trip_offsets = np.asarray(static["tables"]["indexes"]["trip_offsets"])
+    trip_lookup = data_plane.get_trip_lookup(static)
+    trip_count = len(trip_lookup)
+
+    # Scheduled first departure and last arrival of every trip
+    starts = trip_offsets[:-1]
+    ends = trip_offsets[1:]
+    has_stop_times = ends > starts
+    first_departure = np.full(trip_count, -1, dtype=np.int64)
+    last_arrival = np.full(trip_count, -1, dtype=np.int64)
+    running_trips = np.flatnonzero(has_stop_times)
+    first_departure[has_stop_times] = data_plane.get_stop_time_values(static["tables"], running_trips, 0, "departure")
+    last_arrival[has_stop_times] = data_plane.get_stop_time_values(static["tables"], running_trips, ends[has_stop_times] - starts[has_stop_times] - 1, "arrival")
+    today = has_stop_times & np.isin(trips["service_id"], np.asarray(service_ids, dtype=np.int64))
+
+    # Order today's trips by block and then by departure time and find the trip run right before each one by the same bus
+    blocks = np.asarray(trips["block"])
+    today_trips = np.flatnonzero(today)
+    block_order = today_trips[np.lexsort((first_departure[today_trips], blocks[today_trips]))]
+    same_block = blocks[block_order[1:]] == blocks[block_order[:-1]]
+    previous_trip = np.full(trip_count, -1, dtype=np.int64)
+    previous_trip[block_order[1:][same_block]] = block_order[:-1][same_block]
+    block_position = np.zeros(len(block_order), dtype=np.int64)
+    if len(block_order):
+        block_starts = np.flatnonzero(np.concatenate([[True], ~same_block]))
+        block_position = np.arange(len(block_order)) - np.repeat(block_starts, np.diff(np.append(block_starts, len(block_order))))
+    layover_recovery = np.zeros(trip_count, dtype=np.int64)
+    has_previous = previous_trip >= 0
+    layover_recovery[has_previous] = np.maximum(0, first_departure[has_previous] - last_arrival[previous_trip[has_previous]] - min_layover_seconds)
+
+    # Realtime predictions for every stop of every trip in trip_updates.json converted into GTFS seconds
+    realtime = pd.DataFrame(current_trips, columns=["delay", "stop_sequence", "time"])
+    realtime_codes = data_plane.get_realtime_codes(static, "trip_updates", current_trips)
+    realtime["trip"] = realtime_codes["trip"].astype(np.int64)
+    realtime["stop"] = realtime_codes["stop"]
+    realtime = realtime[realtime["trip"] >= 0]
+    realtime_etas = pd.Series(
+        np.where(realtime["time"] > 0, realtime["time"] - service_day_start, np.nan),
+        index=pd.MultiIndex.from_arrays([realtime["trip"].to_numpy(), realtime["stop_sequence"].astype(np.int64).to_numpy()]),
+    )
+    realtime_etas = realtime_etas[~realtime_etas.index.duplicated()].dropna()
+
+    # The current delay and next stop of every bus running a trip are the starting points of the propagation
+    delay = np.full(trip_count, np.nan)
+    current_sequence = np.full(trip_count, -1, dtype=np.int64)
+    has_vehicle = np.zeros(trip_count, dtype=bool)
+    if buses and len(realtime):
+        bus_codes = data_plane.get_realtime_codes(static, "bus_updates", buses)
+        vehicles = pd.DataFrame({"trip": bus_codes["trip"], "stop": bus_codes["stop"]})
+        vehicles = vehicles[vehicles["trip"] >= 0].merge(realtime, on=["trip", "stop"], how="inner").drop_duplicates("trip")
+        vehicle_trips = vehicles["trip"].to_numpy()
+        delay[vehicle_trips] = vehicles["delay"].to_numpy()
+        current_sequence[vehicle_trips] = vehicles["stop_sequence"].to_numpy()
+        has_vehicle[vehicle_trips] = True
+
+    # Predict the remaining stops of every trip with a bus running it from the learned segment travel times, starting from the
+    # realtime prediction for its next stop or its scheduled arrival plus its current delay
+    learned_etas = pd.Series(dtype=np.float64)
+    vehicle_trips = np.flatnonzero(has_vehicle)
+    if len(vehicle_trips) and segment_model.get_segment_seconds(static) is not None:
+        row_trips = np.asarray(stop_times["trip"]).astype(np.int64)
+        row_sequences = np.asarray(stop_times["stop_sequence"]).astype(np.int64)
+        sequence_keys = row_trips * 65536 + row_sequences
+        next_keys = vehicle_trips * 65536 + current_sequence[vehicle_trips]
+        next_rows = np.minimum(np.searchsorted(sequence_keys, next_keys), len(sequence_keys) - 1)
+        found = sequence_keys[next_rows] == next_keys
+        vehicle_trips, next_rows = vehicle_trips[found], next_rows[found]
+        next_etas = realtime_etas.reindex(pd.MultiIndex.from_arrays([vehicle_trips, current_sequence[vehicle_trips]])).to_numpy()
+        scheduled_etas = np.asarray(stop_times["arrival"])[next_rows] + delay[vehicle_trips]
+        rows, etas = segment_model.predict_arrivals(static, next_rows, np.where(np.isnan(next_etas), scheduled_etas, next_etas))
+        learned_etas = pd.Series(etas.astype(np.float64), index=pd.MultiIndex.from_arrays([row_trips[rows], row_sequences[rows]]))
+
+    # Carry the delay of each trip into the next trip of its block, one block position at a time for every block at once.
+    # Trips with a bus running them keep their own delay
+    for position in range(1, int(block_position.max(initial=0)) + 1):
+        position_trips = block_order[block_position == position]
+        position_trips = position_trips[~has_vehicle[position_trips]]
+        carried_delay = np.maximum(0, delay[previous_trip[position_trips]] - layover_recovery[position_trips])
+        delay[position_trips] = carried_delay
+
+    return {
+        "delay": delay,
+        "has_vehicle": has_vehicle,
+        "current_sequence": current_sequence,
+        "realtime_etas": realtime_etas,
+        "learned_etas": learned_etas,
+        "service_day_start": service_day_start,
+    }
+
+# Returns the engine state for the current static data, realtime snapshot and service day, rebuilding it only when one of them changes
+# ----------------------------------------------------------------------------------
+# service_ids is the list of service ids running today
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# ----------------------------------------------------------------------------------
+def get_engine_state(service_ids, buses, current_trips):
+    static = data_plane.get_static()
+    now = datetime.now(ZoneInfo(service_timezone))
+    service_day_start = get_service_day_start(now)
+    key = (static["version"], data_plane.get_realtime_signature(), service_day_start, tuple(sorted(int(s) for s in service_ids)))
+    with engine_lock:
+        if engine_state["key"] != key:
+            engine_state["state"] = build_engine_state(static, service_ids, buses, current_trips, service_day_start)
+            engine_state["key"] = key
+        return static, engine_state["state"]
+
+# Returns the estimated arrival time of stop times given as arrays of the static data
+# ----------------------------------------------------------------------------------
+# state is the engine state returned by get_engine_state
+# trip is a numpy array with the row in trips of the trip of every stop time, or -1 if the trip is unknown
+# stop_sequence is a numpy array with the stop_sequence of every stop time
+# scheduled is a numpy array with the scheduled arrival time of every stop time in GTFS seconds
+# Returns the estimated arrival times in GTFS seconds, the index in eta_sources of how they were estimated, and whether each
+# stop has already been passed by the bus running the trip
+# ----------------------------------------------------------------------------------
+def estimate_arrivals(state, trip, stop_sequence, scheduled):
+    known_trip = trip >= 0
+    trip = np.where(known_trip, trip, 0)
+    trip_delay = np.where(known_trip, state["delay"][trip], np.nan)
+    has_vehicle = known_trip & state["has_vehicle"][trip]
+    stop_keys = pd.MultiIndex.from_arrays([np.where(known_trip, trip, -1), stop_sequence])
+    realtime_eta = state["realtime_etas"].reindex(stop_keys).to_numpy()
+    learned_eta = state["learned_etas"].reindex(stop_keys).to_numpy() if len(state["learned_etas"]) else np.full(len(trip), np.nan)
+
+    # Learned predictions are used for the remaining stops of trips being run right now. Otherwise realtime predictions are used for
+    # trips being run right now and for trips whose bus isn't running yet, and the delay propagated from the bus running the block
+    # is added to the scheduled time of any other trip
+    use_learned = has_vehicle & ~np.isnan(learned_eta)
+    use_realtime = ~use_learned & ~np.isnan(realtime_eta) & (has_vehicle | np.isnan(trip_delay))
+    use_propagated = ~use_learned & ~use_realtime & ~np.isnan(trip_delay)
+    eta = np.where(use_learned, learned_eta, np.where(use_realtime, realtime_eta, np.where(use_propagated, scheduled + np.nan_to_num(trip_delay), scheduled)))
+    source = np.where(use_learned, 3, np.where(use_realtime, 1, np.where(use_propagated, 2, 0)))
+    passed = has_vehicle & (stop_sequence < state["current_sequence"][trip])
+    return np.maximum(eta, 0).astype(np.int64), source, passed
+
+# Replaces the scheduled arrival times of stop times with their estimated arrival times
+# ----------------------------------------------------------------------------------
+# stop_times_df is a dataframe in the same format as the stop_times csv files with at least trip_id, stop_sequence and arrival_time
+# service_ids is the list of service ids running today
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# Returns a copy of stop_times_df where arrival_time is the estimated arrival time, scheduled_arrival_time is the original arrival time,
+# and eta_source is how the arrival time was estimated. Stops which have already been passed by the bus running the trip are removed
+# ----------------------------------------------------------------------------------
+def add_etas(stop_times_df, service_ids, buses, current_trips):
+    if stop_times_df.empty:
+        return stop_times_df
+    static, state = get_engine_state(service_ids, buses, current_trips)
+    stop_times_df = stop_times_df.copy()
+
+    trip = data_plane.get_trip_lookup(static).get_indexer(stop_times_df["trip_id"].astype(str))
+    stop_sequence = stop_times_df["stop_sequence"].astype(np.int64).to_numpy()
+    scheduled = data_plane.gtfs_time_to_seconds(stop_times_df["arrival_time"].astype(str))
+    eta, source, passed = estimate_arrivals(state, trip, stop_sequence, scheduled)
+
+    stop_times_df["scheduled_arrival_time"] = stop_times_df["arrival_time"]
+    stop_times_df["arrival_time"] = data_plane.seconds_to_gtfs_time(eta)
+    stop_times_df["eta_source"] = np.asarray(eta_sources)[source]
+    return stop_times_df[~passed]
+
+# Returns the delay in seconds expected for each trip in trip_ids, or NaN if it is unknown
+# ----------------------------------------------------------------------------------
+# trip_ids is a list of trip ids
+# service_ids, buses and current_trips are the same as for add_etas
+# ----------------------------------------------------------------------------------
+def get_trip_delays(trip_ids, service_ids, buses, current_trips):
+    static, state = get_engine_state(service_ids, buses, current_trips)
+    trip = data_plane.get_trip_lookup(static).get_indexer([str(trip_id) for trip_id in trip_ids])
+    return pd.Series(np.where(trip >= 0, state["delay"][trip], np.nan), index=trip_ids)
@@ -1,139 +1,82 @@
 import requests
-from google.transit import gtfs_realtime_pb2
-import json
-from datetime import datetime
 import pandas as pd
 import zipfile
 import io
+import hashlib
+import fetch_fleet_data
+import fetch_trip_data
+import realtime_cache
+import static_dataset
 
 # Script used to download the vehicleupdates.pb and tripupdates.pb files from BC Transit's website 
 # respectfully containing realtime data of all BC Transit buses (excluding Handydart) 
 # currently running and trips currently being run or will be run in the next 2 hours in Victoria, BC. 
 # This data is then saved as json files in the /data folder. Static data containing information
-# such as trip and route information is also downloaded and stored in csv files in the /data folder.
+# such as trip and route information is also downloaded and stored in csv files in a new version directory in /data/static
+# whenever BC Transit publishes a new feed (see static_dataset.py).
 # Due to the large memory used when downloading the static data, this script is only used by the GitHub Workflow.
 # The website instead runs with fetch_fleet_data.py and fetch_trip_data.py and retrieves the static data
 # in /data from the last run of the GitHub Workflow
 
-def fetch():
-    # The urls from which the realtime and static data is dowanloaded
-    fleet_update_url = "https://bct.tmix.se/gtfs-realtime/vehicleupdates.pb?operatorIds=48"
-    trip_update_url = "https://bct.tmix.se/gtfs-realtime/tripupdates.pb?operatorIds=48"
-    static_url = "https://bct.tmix.se/Tmix.Cap.TdExport.WebApi/gtfs/?operatorIds=48"
-    
-    # --- Section of code where the static data is read and stored in csv files ---
-    # Downloading the zip file containing the static data
-    static_response = requests.get(static_url)
-    static_response.raise_for_status()
-    
-    # Opening the zip file containing all the static data files
-    z = zipfile.ZipFile(io.BytesIO(static_response.content))
-
-    # Reading the trips.txt file containing info on all trips and saving it to trips.csv
-    trips_df = pd.read_csv(z.open("trips.txt"))
-    trips_df.to_csv("data/trips.csv", index=False)
-
-    # Reading the trips.txt file containing info on all stops and saving it to stops.csv
-    stops_df = pd.read_csv(z.open("stops.txt"))
-    stops_df.to_csv("data/stops.csv", index=False)
+# The url from which the static data is dowanloaded. The realtime data is downloaded by fetch_fleet_data.py and fetch_trip_data.py
+static_url = "https://bct.tmix.se/Tmix.Cap.TdExport.WebApi/gtfs/?operatorIds=48"
 
-    # Reading the trips.txt file containing info on all routes and saving it to routes.csv
-    routes_df = pd.read_csv(z.open("routes.txt"))
-    routes_df.to_csv("data/routes.csv", index=False)
+# stop_times.txt is read and written in chunks of this many rows, each saved to its own stop_times_part csv file
+stop_times_chunksize = 100000
 
+# The static ingest is split in stages so that ingest_benchmark.py can measure each of them: the zip file is opened and checked
+# (unzip), its files are read into dataframes (parse), and the dataframes are written to a new static version (write). stop_times.txt
+# is only parsed one chunk at a time while the previous chunks are being written so that it is never in memory all at once.
 
-    # Reading the calendar_dates.txt file containing all calendar dates and saving it to calendar_dates.csv
-    calendar_df = pd.read_csv(z.open("calendar_dates.txt"))
-    calendar_df.to_csv("data/calendar_dates.csv", index=False)
-
-
-    
-
-    # Reading stop_times.txt in chunks and saving to multiple CSVs
-    stop_times_chunksize = 100000  # rows per file
-    stop_times_file_base = "data/stop_times_part"
-
-    # Use iterator with chunksize
+# Returns the content of the zip file containing the static data
+def download_static():
+    static_response = requests.get(static_url)
+    static_response.raise_for_status()
+    return static_response.content
+
+# Returns the zip file containing the static data opened from its content, after checking the crc of every file it contains so that
+# a corrupt download is never written as a new version
+def unzip_static(content):
+    z = zipfile.ZipFile(io.BytesIO(content))
+    corrupt_file = z.testzip()
+    if corrupt_file is not None:
+        raise zipfile.BadZipFile(f"{corrupt_file} is corrupt in the static data")
+    return z
+
+# Returns the static_tables dataframes read from the zip file and an iterator reading stop_times.txt in chunks
+def parse_static(z):
+    # Reading the trips.txt, stops.txt, routes.txt, and calendar_dates.txt files containing info on all trips, stops, routes, and calendar dates
+    tables = {name: pd.read_csv(z.open(f"{name}.txt")) for name in static_dataset.static_tables}
+    # Reading shapes.txt containing the line followed by every trip if the feed has it
+    for name in static_dataset.optional_static_tables:
+        if f"{name}.txt" in z.namelist():
+            tables[name] = pd.read_csv(z.open(f"{name}.txt"))
     stop_times_iter = pd.read_csv(z.open("stop_times.txt"), chunksize=stop_times_chunksize)
+    return tables, stop_times_iter
+
+# Writes the static data to a new version directory unless BC Transit hasn't published a new feed since the active version
+# ----------------------------------------------------------------------------------
+# content is the content of the zip file containing the static data
+# Returns the name of the new version or None if the feed hasn't changed
+# ----------------------------------------------------------------------------------
+def ingest_static(content):
+    feed_hash = hashlib.sha256(content).hexdigest()
+    active_version = static_dataset.get_active_version()
+    active_manifest = static_dataset.get_manifest(active_version) if active_version else None
+    if active_manifest and active_manifest["feed_hash"] == feed_hash:
+        return None
+    tables, stop_times_iter = parse_static(unzip_static(content))
+    # Every file is written to a new version directory which is only made the active version once all of them have been written
+    return static_dataset.write_version(feed_hash, tables, stop_times_iter)
 
-    for i, chunk in enumerate(stop_times_iter):
-        chunk.to_csv(f"{stop_times_file_base}_{i}.csv", index=False)
-
-    # # Reading the stop_times.txt file containing info on scheduled arrival times for all trips for every stop served and saving it to stop_times.csv
-    # stop_times_df = pd.read_csv(z.open("stop_times.txt"))
-    # stop_times_df.to_csv("data/stop_times.csv", index=False)
-
-
-
-    
-    
-
-    # --- Section of code where the realtime data related to each specific bus currently running is read and saved ---
-    # Reading the realtime bus data
-    fleet_update_response = requests.get(fleet_update_url, timeout=10)
-    fleet_update_response.raise_for_status()
-    fleet_feed = gtfs_realtime_pb2.FeedMessage()
-    fleet_feed.ParseFromString(fleet_update_response.content)
-
-    # Saving the data of every bus currently running into a dictionary and adding it to the buses
-    buses = []
-    for entity in fleet_feed.entity:
-        if entity.HasField("vehicle"):
-            buses.append({
-                "id": entity.vehicle.vehicle.id,
-                "lat": entity.vehicle.position.latitude,
-                "lon": entity.vehicle.position.longitude,
-                "speed": entity.vehicle.position.speed,
-                "route": entity.vehicle.trip.route_id,
-                "capacity": entity.vehicle.occupancy_status,
-                "trip_id": entity.vehicle.trip.trip_id,
-                "stop_id": entity.vehicle.stop_id,
-                "bearing": entity.vehicle.position.bearing,
-                "timestamp": datetime.utcnow().isoformat()
-            })
-            
-    # Overwriting the content of bus_updates.json with buses
-    with open("data/bus_updates.json", "w") as f:
-        json.dump(buses, f, indent=2)
-        
-
-    # --- Section of code where the realtime data related to each specific trip currently being run or scheduled to run in the next 2 hours is read and saved ---
-    # Reading the realtime bus data
-    trip_update_response = requests.get(trip_update_url, timeout=10)
-    trip_update_response.raise_for_status()
-    trip_feed = gtfs_realtime_pb2.FeedMessage()
-    trip_feed.ParseFromString(trip_update_response.content)
-
-    # Saving the data of every trip currently being run or scheduled to run in the next 2 hours currently running into a dictionary and adding it to the trips
-    trips = []
-    for entity in trip_feed.entity:
-        trip_entity = entity.trip_update
-        if len(trip_entity.stop_time_update) > 0:
-            for stop in trip_entity.stop_time_update:
-                if trip_entity.stop_time_update[0].stop_sequence == 1:
-                    trips.append({
-                        "trip_id": trip_entity.trip.trip_id,
-                        "route_id": trip_entity.trip.route_id,
-                        "start_time": trip_entity.trip.start_time,
-                        "stop_id": stop.stop_id,
-                        "delay": stop.departure.delay,
-                        "stop_sequence": stop.stop_sequence,
-                        "time": stop.arrival.time
-                    })
-                else:
-                    trips.append({
-                        "trip_id": trip_entity.trip.trip_id,
-                        "route_id": trip_entity.trip.route_id,
-                        "start_time": trip_entity.trip.start_time,
-                        "stop_id": stop.stop_id,
-                        "delay": stop.arrival.delay,
-                        "stop_sequence": stop.stop_sequence,
-                        "time": stop.arrival.time
-                    })
+def fetch():
+    # --- Section of code where the static data is read and stored in csv files ---
+    ingest_static(download_static())
 
-    # Overwriting the content of bus_updates.json with trips
-    with open("data/trip_updates.json", "w") as f:
-        json.dump(trips, f, indent=2)
+    # --- Section of code where the realtime data of every bus and every trip is downloaded and saved ---
+    # The feeds are decoded by the same functions as the website so bus_updates.json has every field freshness.py traces, and
+    # both files are only replaced once both feeds were downloaded
+    realtime_cache.save_snapshots({"bus_updates": fetch_fleet_data.download(), "trip_updates": fetch_trip_data.download()})
 
 
 if __name__ == "__main__":
@@ -1,13 +1,18 @@
 import requests
 from google.transit import gtfs_realtime_pb2
 import json
+import os
 from datetime import datetime
 
 # Script used to download the vehicleupdates.pb file from BC Transit's website containing realtime data of all BC Transit buses (excluding Handydart) 
 # currently running in Victoria, BC and save the data into bus_updates.json in the /data folder
 
-def fetch():
-    fleet_update_url = "https://bct.tmix.se/gtfs-realtime/vehicleupdates.pb?operatorIds=48"
+# BC Transit's GTFS-RT endpoint, which can be replaced by a local stub e.g. by load_test.py
+realtime_base_url = os.environ.get("REALTIME_BASE_URL", "https://bct.tmix.se/gtfs-realtime")
+
+# Returns the realtime data of every bus from vehicleupdates.pb, in the same format as bus_updates.json
+def download():
+    fleet_update_url = f"{realtime_base_url}/vehicleupdates.pb?operatorIds=48"
     fleet_update_response = requests.get(fleet_update_url, timeout=10)
     fleet_update_response.raise_for_status()
 
@@ -17,8 +22,9 @@ def fetch():
     buses = []
     for entity in fleet_feed.entity:
         if entity.HasField("vehicle"):
-            # Download the vehicle's id as well as its current position, speed, route, capacity, trip, next stop, bearing 
-            # along with the timestamp indicating when the data was received. Bearing is currently not being used
+            # Download the vehicle's id as well as its current position, speed, route, capacity, trip, next stop, bearing
+            # along with the timestamp indicating when the data was received, the time the bus reported its position and the
+            # time BC Transit published the feed, which are used to trace how fresh the data is (see freshness.py)
             buses.append({
                 "id": entity.vehicle.vehicle.id,
                 "lat": entity.vehicle.position.latitude,
@@ -29,12 +35,20 @@ def fetch():
                 "trip_id": entity.vehicle.trip.trip_id,
                 "stop_id": entity.vehicle.stop_id,
                 "bearing": entity.vehicle.position.bearing,
-                "timestamp": datetime.utcnow().isoformat()
+                "timestamp": datetime.utcnow().isoformat(),
+                "reported": entity.vehicle.timestamp,
+                "feed_timestamp": fleet_feed.header.timestamp
             })
 
-    # Save to bus_updates.json
-    with open("data/bus_updates.json", "w") as f:
+    return buses
+
+def fetch():
+    buses = download()
+
+    # Save to bus_updates.json through a temporary file so the website never reads a partially written file
+    with open(f"data/bus_updates.json.{os.getpid()}.tmp", "w") as f:
         json.dump(buses, f, indent=2)
+    os.replace(f"data/bus_updates.json.{os.getpid()}.tmp", "data/bus_updates.json")
 
 if __name__ == "__main__":
     fetch()
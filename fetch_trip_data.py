@@ -1,12 +1,17 @@
 import requests
 from google.transit import gtfs_realtime_pb2
 import json
+import os
 
 # Script used to download the tripupdates.pb file from BC Transit's website containing realtime data of all trips currently being run
 # or will be run in the next 2 hours in Victoria, BC and save the data into trip_updates.json in the /data folder
 
-def fetch():
-    trip_update_url = "https://bct.tmix.se/gtfs-realtime/tripupdates.pb?operatorIds=48"
+# BC Transit's GTFS-RT endpoint, which can be replaced by a local stub e.g. by load_test.py
+realtime_base_url = os.environ.get("REALTIME_BASE_URL", "https://bct.tmix.se/gtfs-realtime")
+
+# Returns the realtime data of every stop of every trip from tripupdates.pb, in the same format as trip_updates.json
+def download():
+    trip_update_url = f"{realtime_base_url}/tripupdates.pb?operatorIds=48"
     trip_update_response = requests.get(trip_update_url, timeout=10)
     trip_update_response.raise_for_status()
   
@@ -39,9 +44,15 @@ def fetch():
                         "time": stop.arrival.time
                     })
 
-    # Save to trip_updates.json
-    with open("data/trip_updates.json", "w") as f:
+    return trips
+
+def fetch():
+    trips = download()
+
+    # Save to trip_updates.json through a temporary file so the website never reads a partially written file
+    with open(f"data/trip_updates.json.{os.getpid()}.tmp", "w") as f:
         json.dump(trips, f, indent=2)
+    os.replace(f"data/trip_updates.json.{os.getpid()}.tmp", "data/trip_updates.json")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,278 @@
+import math
+import threading
+
+import numpy as np
+
+import data_plane
+import eta_engine
+import on_time
+
+# Fleet map showing every running bus at once.
+# The positions of the current bus_updates.json snapshot are put in a grid index once per snapshot: every bus is assigned to a cell
+# of index_cell_degrees, and the buses are sorted by cell so that the buses of a cell are a contiguous slice. Since cells are
+# numbered row by row, the cells of a row of the viewport are also contiguous, so the buses inside the viewport are found with two
+# binary searches per row of cells instead of going through the whole fleet. Below cluster_max_zoom, the buses in view which would
+# be drawn within cluster_pixels of each other are merged into a single cluster marker, so the number of markers sent is bounded by
+# the size of the screen instead of the size of the fleet.
+
+# Size in degrees of the cells of the grid index. 0.01 degrees is about 1.1 km north to south and 0.75 km east to west in Victoria
+index_cell_degrees = 0.01
+index_columns = int(360 / index_cell_degrees)
+
+# Below this zoom level, buses closer than cluster_pixels to each other on the screen are shown as a single marker
+cluster_max_zoom = 13
+cluster_pixels = 60
+
+# View used before the browser has sent the bounds of the map
+default_center = {"lat": 48.45, "lon": -123.40}
+default_zoom = 11
+default_map_size = (1200, 700)
+
+# Colour of the buses by how early or late they are, using the same thresholds as the on-time performance page
+delay_colors = {
+    "early": "#e67e22",
+    "on_time": "#2ca02c",
+    "late": "#d62728",
+    "unknown": "#7f7f7f",
+}
+
+# Grid index of the current snapshot and the key of the snapshot it was built from
+fleet_index = {"key": None, "index": None}
+fleet_index_lock = threading.Lock()
+
+# Returns the grid cell row and column of positions
+def get_cells(lat, lon):
+    rows = np.floor((np.asarray(lat) + 90) / index_cell_degrees).astype(np.int64)
+    columns = np.floor((np.asarray(lon) + 180) / index_cell_degrees).astype(np.int64)
+    return rows, np.clip(columns, 0, index_columns - 1)
+
+# Returns the delay category of every bus as one of the keys of delay_colors
+def get_delay_categories(delay):
+    return np.where(np.isnan(delay), "unknown",
+                    np.where(delay < on_time.early_threshold_seconds, "early",
+                             np.where(delay > on_time.late_threshold_seconds, "late", "on_time")))
+
+# Returns the grid index of a snapshot of buses
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# service_ids is the list of service ids running today
+# ----------------------------------------------------------------------------------
+def build_fleet_index(buses, current_trips, service_ids):
+    static, state = eta_engine.get_engine_state(service_ids, buses, current_trips)
+    lat = np.array([bus["lat"] for bus in buses], dtype=np.float64)
+    lon = np.array([bus["lon"] for bus in buses], dtype=np.float64)
+
+    # Route number, route colour and delay of every bus. Buses not running a trip known today have no delay
+    codes = data_plane.get_realtime_codes(static, "bus_updates", buses)
+    routes = static["tables"]["routes"]
+    route = np.asarray(codes["route"]).astype(np.int64)
+    known_route = route >= 0
+    route_numbers = np.where(known_route, np.asarray(routes["route_short_name"]).astype(str)[np.where(known_route, route, 0)], "")
+    route_colors = np.where(known_route, "#" + np.asarray(routes["route_color"]).astype(str)[np.where(known_route, route, 0)], delay_colors["unknown"])
+    trip = np.asarray(codes["trip"]).astype(np.int64)
+    running = (trip >= 0) & state["has_vehicle"][np.where(trip >= 0, trip, 0)]
+    delay = np.where(running, state["delay"][np.where(trip >= 0, trip, 0)], np.nan)
+
+    # Buses without a position are left out of the map
+    located = ~np.isnan(lat) & ~np.isnan(lon) & ((lat != 0) | (lon != 0))
+    cell_rows, cell_columns = get_cells(lat, lon)
+    keys = cell_rows * index_columns + cell_columns
+    order = np.flatnonzero(located)[np.argsort(keys[located], kind="stable")]
+    cell_keys, cell_starts = np.unique(keys[order], return_index=True)
+    return {
+        "ids": np.array([bus["id"] for bus in buses], dtype=object)[order],
+        "lat": lat[order],
+        "lon": lon[order],
+        "route_numbers": route_numbers[order],
+        "route_colors": route_colors[order],
+        "delay": delay[order],
+        "cell_keys": cell_keys,
+        "cell_offsets": np.append(cell_starts, len(order)),
+    }
+
+# Returns the grid index of the current snapshot, building it only once per snapshot
+# ----------------------------------------------------------------------------------
+# buses, current_trips, and service_ids are the same as for build_fleet_index
+# ----------------------------------------------------------------------------------
+def get_fleet_index(buses, current_trips, service_ids):
+    key = (data_plane.get_static()["version"], data_plane.get_realtime_signature(), len(buses), tuple(sorted(int(s) for s in service_ids)))
+    with fleet_index_lock:
+        if fleet_index["key"] != key:
+            fleet_index["index"] = build_fleet_index(buses, current_trips, service_ids)
+            fleet_index["key"] = key
+        return fleet_index["index"]
+
+# Returns the positions in the grid index of the buses inside bounds
+# ----------------------------------------------------------------------------------
+# index is the grid index returned by get_fleet_index
+# bounds is the dictionary with the south, west, north, and east edges of the viewport in degrees
+# ----------------------------------------------------------------------------------
+def get_viewport_buses(index, bounds):
+    if len(index["cell_keys"]) == 0:
+        return np.array([], dtype=np.int64)
+    first_row, first_column = get_cells(bounds["south"], bounds["west"])
+    last_row, last_column = get_cells(bounds["north"], bounds["east"])
+    rows = np.arange(int(first_row), int(last_row) + 1)
+    # A viewport crossing the antimeridian is split in two ranges of columns
+    if first_column <= last_column:
+        column_ranges = [(first_column, last_column)]
+    else:
+        column_ranges = [(first_column, index_columns - 1), (0, last_column)]
+
+    positions = []
+    for first, last in column_ranges:
+        first_cells = np.searchsorted(index["cell_keys"], rows * index_columns + first)
+        last_cells = np.searchsorted(index["cell_keys"], rows * index_columns + last, side="right")
+        starts = index["cell_offsets"][first_cells]
+        counts = index["cell_offsets"][last_cells] - starts
+        positions.append(np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum()))
+    positions = np.concatenate(positions)
+
+    # The cells on the edges of the viewport are only partly inside it
+    lat = index["lat"][positions]
+    lon = index["lon"][positions]
+    inside_lon = (lon >= bounds["west"]) & (lon <= bounds["east"]) if bounds["west"] <= bounds["east"] else (lon >= bounds["west"]) | (lon <= bounds["east"])
+    return positions[(lat >= bounds["south"]) & (lat <= bounds["north"]) & inside_lon]
+
+# Returns the position of points in pixels of the whole world map at a zoom level, in web mercator like the map itself
+def to_pixels(lat, lon, zoom):
+    world_size = 256 * 2 ** zoom
+    sin_lat = np.sin(np.radians(np.clip(lat, -85, 85)))
+    x = (np.asarray(lon) + 180) / 360 * world_size
+    y = (0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * world_size
+    return x, y
+
+# Returns the bounds of the map from its center and zoom level, for when the browser hasn't sent them
+def get_bounds(center, zoom, map_size=default_map_size):
+    x, y = to_pixels(center["lat"], center["lon"], zoom)
+    world_size = 256 * 2 ** zoom
+    half_width, half_height = map_size[0] / 2, map_size[1] / 2
+
+    def to_lat(pixel_y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * pixel_y / world_size))))
+
+    return {
+        "south": to_lat(float(y) + half_height),
+        "north": to_lat(float(y) - half_height),
+        "west": (float(x) - half_width) / world_size * 360 - 180,
+        "east": (float(x) + half_width) / world_size * 360 - 180,
+    }
+
+# Returns the markers to show on the fleet map for a viewport
+# ----------------------------------------------------------------------------------
+# index is the grid index returned by get_fleet_index
+# bounds is the same as for get_viewport_buses
+# zoom is the zoom level of the map
+# color_by is either "route" or "delay"
+# Returns a dictionary with the buses shown individually and the clusters, each as a dictionary of lists that can be sent as json
+# ----------------------------------------------------------------------------------
+def get_fleet_markers(index, bounds, zoom, color_by):
+    positions = get_viewport_buses(index, bounds)
+    delay = index["delay"][positions]
+    colors = index["route_colors"][positions] if color_by == "route" else np.vectorize(delay_colors.get, otypes=[object])(get_delay_categories(delay))
+
+    # Buses drawn within cluster_pixels of each other share a cluster. Clusters of a single bus are shown as that bus
+    if zoom < cluster_max_zoom and len(positions):
+        x, y = to_pixels(index["lat"][positions], index["lon"][positions], zoom)
+        cluster_keys = np.floor(x / cluster_pixels).astype(np.int64) * (1 << 32) + np.floor(y / cluster_pixels).astype(np.int64)
+        _, cluster, sizes = np.unique(cluster_keys, return_inverse=True, return_counts=True)
+        clustered = sizes[cluster] > 1
+    else:
+        cluster = np.zeros(len(positions), dtype=np.int64)
+        sizes = np.zeros(0, dtype=np.int64)
+        clustered = np.zeros(len(positions), dtype=bool)
+
+    # Clusters are placed at the mean position of their buses and coloured by their mean delay
+    cluster_lat = np.bincount(cluster[clustered], weights=index["lat"][positions][clustered], minlength=len(sizes))
+    cluster_lon = np.bincount(cluster[clustered], weights=index["lon"][positions][clustered], minlength=len(sizes))
+    known_delay = clustered & ~np.isnan(delay)
+    delay_sum = np.bincount(cluster[known_delay], weights=delay[known_delay], minlength=len(sizes))
+    delay_count = np.bincount(cluster[known_delay], minlength=len(sizes))
+    shown = sizes > 1
+    cluster_delay = np.full(len(sizes), np.nan)
+    np.divide(delay_sum, delay_count, out=cluster_delay, where=delay_count > 0)
+
+    single = positions[~clustered]
+    single_delay = index["delay"][single]
+    return {
+        "buses": {
+            "ids": index["ids"][single].tolist(),
+            "lat": index["lat"][single].tolist(),
+            "lon": index["lon"][single].tolist(),
+            "text": [f"{bus_id[-4:]} {route}".strip() for bus_id, route in zip(index["ids"][single], index["route_numbers"][single])],
+            "hovertext": [get_hover_text(bus_id, route, d) for bus_id, route, d in zip(index["ids"][single], index["route_numbers"][single], single_delay)],
+            "colors": colors[~clustered].tolist(),
+        },
+        "clusters": {
+            "lat": (cluster_lat[shown] / sizes[shown]).tolist(),
+            "lon": (cluster_lon[shown] / sizes[shown]).tolist(),
+            "sizes": sizes[shown].tolist(),
+            "colors": [delay_colors[category] for category in get_delay_categories(cluster_delay[shown])],
+        },
+        "total": len(positions),
+    }
+
+# Returns the text shown when hovering over a bus on the fleet map
+def get_hover_text(bus_id, route_number, delay):
+    if not route_number:
+        return f"{bus_id[-4:]}: Not In Service"
+    if np.isnan(delay):
+        return f"{bus_id[-4:]}: Route {route_number}"
+    minutes = int(round(delay / 60))
+    if minutes == 0:
+        return f"{bus_id[-4:]}: Route {route_number}, on schedule"
+    return f"{bus_id[-4:]}: Route {route_number}, {abs(minutes)} min {'late' if minutes > 0 else 'early'}"
+
+# Returns the view of the fleet map after the user moved it
+# ----------------------------------------------------------------------------------
+# relayout_data is the relayoutData of the map graph, containing only the properties which changed
+# view is the previous view, or None on the first update
+# Returns a dictionary with the center, zoom level, and bounds of the map
+# ----------------------------------------------------------------------------------
+def get_view(relayout_data, view):
+    view = dict(view) if view else {"center": default_center, "zoom": default_zoom, "bounds": None}
+    relayout_data = relayout_data or {}
+    moved = False
+    if "mapbox.center" in relayout_data:
+        view["center"] = relayout_data["mapbox.center"]
+        moved = True
+    if "mapbox.zoom" in relayout_data:
+        view["zoom"] = relayout_data["mapbox.zoom"]
+        moved = True
+    # Plotly sends the corners of the visible map along with the new center and zoom, otherwise they are estimated from them
+    derived = relayout_data.get("mapbox._derived")
+    if derived and derived.get("coordinates"):
+        lons = [corner[0] for corner in derived["coordinates"]]
+        lats = [corner[1] for corner in derived["coordinates"]]
+        view["bounds"] = {"south": min(lats), "west": lons[0], "north": max(lats), "east": lons[1]}
+    elif moved or view["bounds"] is None:
+        view["bounds"] = get_bounds(view["center"], view["zoom"])
+    return view
+
+# Returns the values of the properties of the two traces of the fleet map, the clusters and the buses
+# ----------------------------------------------------------------------------------
+# markers is the dictionary returned by get_fleet_markers
+# Returns a list with a dictionary for every trace mapping a property path e.g. marker.color to its list of values
+# ----------------------------------------------------------------------------------
+def get_trace_values(markers):
+    clusters = markers["clusters"]
+    buses = markers["buses"]
+    return [
+        {
+            "lat": clusters["lat"],
+            "lon": clusters["lon"],
+            "text": [str(size) for size in clusters["sizes"]],
+            "hovertext": [f"{size} buses" for size in clusters["sizes"]],
+            "marker.size": [min(20 + 4 * math.log2(size), 40) for size in clusters["sizes"]],
+            "marker.color": clusters["colors"],
+        },
+        {
+            "lat": buses["lat"],
+            "lon": buses["lon"],
+            "text": buses["text"],
+            "hovertext": buses["hovertext"],
+            "customdata": buses["ids"],
+            "marker.color": buses["colors"],
+        },
+    ]
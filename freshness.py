@@ -0,0 +1,195 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+import data_plane
+import realtime_cache
+
+# End-to-end freshness tracing of the realtime data.
+# A bus position goes through several stages before it is shown to a user: the bus reports it (the vehicle timestamp of GTFS-RT),
+# BC Transit includes it in its feed (the feed header timestamp), it is downloaded and saved in bus_updates.json (the fetch time,
+# the timestamp field), it is published to the data plane or picked up from the file (the publish time), and finally a page is
+# rendered with it. The lag of each stage is the time between the end of the previous stage and the end of that stage, and the total
+# lag is the time between the bus reporting its position and the page being rendered. The lags of the last max_samples renders are
+# kept per stage in every process and only pages actually rendered for users are recorded. When a lag exceeds its threshold an alarm
+# is raised, and every alarm raised or cleared is kept as an event which /api/freshness exposes along with the lags and the active
+# alarms, so that a monitor polling it can act on them and the refresh cadence can be tuned against the real staleness of the data
+# instead of the age of the downloaded file. Polling /api/freshness never records anything itself.
+
+# Stages in the order the data goes through them, with the name shown to users when that stage is the one lagging
+stages = {
+    "feed": "BC Transit's feed",
+    "fetch": "the download from BC Transit",
+    "publish": "the publishing of new data",
+    "render": "the refresh of the data on this website",
+    "total": "the bus",
+}
+
+# Lag in seconds above which each stage raises an alarm
+alarm_seconds = {
+    "feed": 60,
+    "fetch": 60,
+    "publish": 30,
+    "render": realtime_cache.stale_after_seconds,
+    "total": int(os.environ.get("FRESHNESS_ALARM_SECONDS", "180")),
+}
+# How often an alarm that keeps being raised is printed again
+alarm_repeat_seconds = 300
+
+max_samples = 500
+max_alarm_events = 100
+
+# The lags of the last renders of every stage, the state of the alarm of every stage, and the last alarms raised or cleared
+metrics = {stage: deque(maxlen=max_samples) for stage in stages}
+alarms = {stage: {"active": False, "since": None, "printed": 0, "count": 0} for stage in stages}
+alarm_events = deque(maxlen=max_alarm_events)
+metrics_lock = threading.Lock()
+
+# Returns a unix timestamp from a GTFS-RT timestamp or an ISO timestamp in UTC, or None if it is missing
+def to_unix_time(value):
+    if value is None or value == "" or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if isinstance(value, str):
+        return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).timestamp()
+    return float(value) if value > 0 else None
+
+# Returns the unix timestamp at which the realtime data being served was published: the publish time of the active data plane
+# version, or the time bus_updates.json was last written when the data plane is disabled
+def get_published_time():
+    realtime = data_plane.get_attached("realtime")
+    if realtime is not None:
+        return realtime["manifest"].get("published")
+    signature = realtime_cache.snapshots["bus_updates"]["signature"]
+    return signature[0] / 1e9 if signature else None
+
+# Returns the end time of every stage for a bus, or None for the stages that are unknown
+# ----------------------------------------------------------------------------------
+# bus is the dictionary of that bus from bus_updates.json
+# published is the unix timestamp returned by get_published_time
+# rendered is the unix timestamp at which the page is rendered
+# ----------------------------------------------------------------------------------
+def get_stage_times(bus, published, rendered):
+    return {
+        "reported": to_unix_time(bus.get("reported")),
+        "feed": to_unix_time(bus.get("feed_timestamp")),
+        "fetch": to_unix_time(bus.get("timestamp")),
+        "publish": published,
+        "render": rendered,
+    }
+
+# Returns the lag in seconds of every stage from the end times returned by get_stage_times, or None for the stages that are unknown
+def get_lags(stage_times):
+    lags = {}
+    previous = stage_times["reported"]
+    for stage in ["feed", "fetch", "publish", "render"]:
+        end = stage_times[stage]
+        lags[stage] = max(end - previous, 0) if end is not None and previous is not None else None
+        previous = end if end is not None else previous
+    reported = stage_times["reported"] if stage_times["reported"] is not None else stage_times["fetch"]
+    lags["total"] = max(stage_times["render"] - reported, 0) if reported is not None else None
+    return lags
+
+# Returns the lag of every stage of the data as it would be rendered now, without recording anything
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# bus is the dictionary of the bus shown on the page, or None to use the newest position of the snapshot
+# Returns the lag of every stage along with the stage times, or None if there are no buses
+# ----------------------------------------------------------------------------------
+def get_trace(buses, bus=None):
+    if bus is None:
+        if not buses:
+            return None
+        # The newest position tells how fresh the snapshot is, regardless of buses which stopped reporting
+        bus = max(buses, key=lambda b: to_unix_time(b.get("reported")) or to_unix_time(b.get("timestamp")) or 0)
+    stage_times = get_stage_times(bus, get_published_time(), time.time())
+    return {"times": stage_times, "lags": get_lags(stage_times)}
+
+# Records the lags of a page rendered for a user in the metrics and raises the alarm of every stage lagging too much
+# ----------------------------------------------------------------------------------
+# buses and bus are the same as for get_trace
+# Returns the trace returned by get_trace
+# ----------------------------------------------------------------------------------
+def record_render(buses, bus=None):
+    trace = get_trace(buses, bus)
+    if trace is None:
+        return None
+    with metrics_lock:
+        for stage, lag in trace["lags"].items():
+            if lag is None:
+                continue
+            metrics[stage].append(lag)
+            update_alarm(stage, lag, trace["times"]["render"])
+    return trace
+
+# Raises or clears the alarm of a stage, keeping an event when it changes. Must be called with metrics_lock held
+def update_alarm(stage, lag, now):
+    alarm = alarms[stage]
+    if lag <= alarm_seconds[stage]:
+        if alarm["active"]:
+            alarm_events.append({"time": now, "stage": stage, "event": "cleared", "lag": lag, "threshold": alarm_seconds[stage]})
+            print(f"Freshness alarm cleared: {stage} lag is back to {lag:.0f} s", flush=True)
+        alarm["active"] = False
+        alarm["since"] = None
+        return
+    if not alarm["active"]:
+        alarm["active"] = True
+        alarm["since"] = now
+        alarm["count"] += 1
+        alarm["printed"] = 0
+        alarm_events.append({"time": now, "stage": stage, "event": "raised", "lag": lag, "threshold": alarm_seconds[stage]})
+    if now - alarm["printed"] >= alarm_repeat_seconds:
+        alarm["printed"] = now
+        print(f"Freshness alarm: {stage} lag of {lag:.0f} s exceeds {alarm_seconds[stage]} s", flush=True)
+
+# Returns the first stage whose alarm is raised, or None if the data is fresh
+def get_lagging_stage():
+    with metrics_lock:
+        return next((stage for stage in ["feed", "fetch", "publish", "render"] if alarms[stage]["active"]), None)
+
+# Returns the freshness metrics of this process as a dictionary that can be sent as json
+def get_metrics():
+    with metrics_lock:
+        stage_metrics = {}
+        for stage in stages:
+            lags = np.array(metrics[stage])
+            stage_metrics[stage] = {
+                "samples": len(lags),
+                "last": float(lags[-1]) if len(lags) else None,
+                "mean": float(lags.mean()) if len(lags) else None,
+                "p90": float(np.percentile(lags, 90)) if len(lags) else None,
+                "max": float(lags.max()) if len(lags) else None,
+                "threshold": alarm_seconds[stage],
+                "alarm": alarms[stage]["active"],
+                "alarm_since": alarms[stage]["since"],
+                "alarm_count": alarms[stage]["count"],
+            }
+        return {
+            "pid": os.getpid(),
+            "stages": stage_metrics,
+            "alarms": [stage for stage in stages if alarms[stage]["active"]],
+            "alarm_events": list(alarm_events),
+        }
+
+# Returns the text shown on the bus tracker page telling when the position of a bus was reported and how old it is
+# ----------------------------------------------------------------------------------
+# trace is the trace returned by record_render for that bus
+# timezone_name is the timezone the time is shown in
+# ----------------------------------------------------------------------------------
+def get_freshness_text(trace, timezone_name):
+    times = trace["times"]
+    reported = times["reported"] if times["reported"] is not None else times["fetch"]
+    if reported is None:
+        return ""
+    reported_time = datetime.fromtimestamp(reported, ZoneInfo(timezone_name)).strftime("%H:%M:%S")
+    label = "Position reported" if times["reported"] is not None else "Updated"
+    text = f"{label} at {reported_time} ({int(trace['lags']['total'] or 0)} s ago)"
+    lagging_stage = get_lagging_stage()
+    if lagging_stage:
+        text = f"{text}, delayed by {stages[lagging_stage]}"
+    return text
@@ -0,0 +1,36 @@
+import multiprocessing
+import os
+
+import data_plane
+import live_stream
+
+# Gunicorn configuration used by the Dockerfile.
+# The static data is published to the data plane before any worker is started and a single refresher process keeps the static
+# and realtime data up-to-date afterwards. Workers inherit DATA_PLANE=1 and only attach to the published versions read-only,
+# so adding workers does not add more copies of the static data or more requests to BC Transit.
+# Every open live stream (see live_stream) holds a thread of its worker, so every worker gets live_stream.max_clients threads on
+# top of the ones serving the pages, the Dash callbacks, and the API.
+
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = 2 + live_stream.max_clients
+bind = f":{os.environ.get('PORT', '8080')}"
+
+os.environ["DATA_PLANE"] = "1"
+
+refresher = {"process": None}
+
+def on_starting(server):
+    os.makedirs(data_plane.plane_dir, exist_ok=True)
+    try:
+        data_plane.publish_static()
+        data_plane.publish_realtime()
+    except Exception as e:
+        print(f"Error publishing initial data plane: {e}", flush=True)
+
+def when_ready(server):
+    refresher["process"] = multiprocessing.Process(target=data_plane.run_refresher, name="data-plane-refresher", daemon=True)
+    refresher["process"].start()
+
+def on_exit(server):
+    if refresher["process"] is not None:
+        refresher["process"].terminate()
@@ -0,0 +1,214 @@
+import bisect
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+import data_plane
+import interpolation
+import linear_referencing
+import stop_events
+
+# Bus bunching and headway gaps of every route, kept up-to-date incrementally from one realtime snapshot to the next.
+# The buses of every route and direction following the same line (see linear_referencing) are kept in a list sorted by how far along
+# the line they are, so the bus ahead of every bus is the next one in the list. When a new snapshot comes in, the trip, next stop and
+# position of every bus are compared with where it was last placed in a few vectorized numpy operations, and only the buses whose
+# trip or next stop changed or which moved more than move_tolerance_meters are placed along their lines again and moved in the lists
+# with a binary search. Only the headways of those buses and of the buses right behind where they were and where they are now are
+# computed again. Buses sitting at a stop or a layover are therefore never placed again, but a bus driving at normal speed moves more
+# than the tolerance between two 30 s snapshots, so in service hours a refresh still places most of the moving fleet again: the work
+# is O(fleet) for the comparison plus O(moving buses) for the placement, not O(changed vehicles). The metrics of every refresh are
+# returned with the headways so this can be watched.
+# Headways are measured in time using the timetable of the bus behind: its actual headway is how long it is scheduled to take to get
+# from where it is to where the bus ahead is, and its scheduled headway is how long after the bus ahead's trip its own trip is
+# scheduled to get there. A bus whose actual headway is well under its scheduled headway is bunched with the bus ahead, and one whose
+# actual headway is well over its scheduled headway is running behind a gap in service.
+
+# A bus is bunched when its actual headway is less than this fraction of its scheduled headway or when it has passed the bus ahead's trip
+bunched_ratio = 0.25
+# A bus is behind a gap when its actual headway is more than this many times its scheduled headway and at least gap_min_seconds longer
+gap_ratio = 1.5
+gap_min_seconds = 300
+# A bus on the same trip and heading to the same stop keeps its place along its line until it has moved this far from where it was placed
+move_tolerance_meters = 100
+
+# The buses of the latest snapshot, the ids, trip and stop codes, and coordinates in meters where every bus was last placed, the
+# ordered buses of every route, direction, and line, the headway of every bus to the bus ahead, and the work done by the last refresh
+tracker = {"version": None, "signature": None, "vehicles": {}, "placed": None, "groups": {}, "headways": {}, "stats": {}}
+tracker_lock = threading.Lock()
+
+# Updates the headways from the buses which changed since the previous snapshot, if the snapshot is new. Must hold tracker_lock
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# ----------------------------------------------------------------------------------
+def update_headways(static, buses, current_trips):
+    signature = (data_plane.get_realtime_signature(), len(buses))
+    if tracker["version"] == static["version"] and tracker["signature"] == signature:
+        return
+    start = time.perf_counter()
+    if tracker["version"] != static["version"]:
+        tracker.update({"version": static["version"], "vehicles": {}, "placed": None, "groups": {}, "headways": {}})
+    tracker["signature"] = signature
+    vehicles = tracker["vehicles"]
+
+    # Compare every bus with where it was last placed
+    codes = data_plane.get_realtime_codes(static, "bus_updates", buses)
+    ids = pd.Index([bus["id"] for bus in buses], dtype=object)
+    rows = np.flatnonzero(~ids.duplicated())
+    current = {
+        "ids": np.asarray(ids, dtype=object)[rows],
+        "trip": np.asarray(codes["trip"], dtype=np.int64)[rows],
+        "stop": np.asarray(codes["stop"], dtype=np.int64)[rows],
+        "x": np.array([bus["lon"] for bus in buses], dtype=np.float64)[rows] * interpolation.meters_per_degree_lon,
+        "y": np.array([bus["lat"] for bus in buses], dtype=np.float64)[rows] * interpolation.meters_per_degree_lat,
+    }
+    placed = tracker["placed"]
+    if placed is None or len(placed["ids"]) == 0:
+        is_changed = np.ones(len(rows), dtype=bool)
+        tracker["placed"] = current
+    else:
+        match = pd.Index(placed["ids"]).get_indexer(current["ids"])
+        previous = np.maximum(match, 0)
+        moved = np.hypot(current["x"] - placed["x"][previous], current["y"] - placed["y"][previous]) > move_tolerance_meters
+        is_changed = (match < 0) | (current["trip"] != placed["trip"][previous]) | (current["stop"] != placed["stop"][previous]) | moved
+        # Buses which didn't change keep the place they were given, so that small moves add up until they reach the tolerance
+        tracker["placed"] = {key: np.where(is_changed, values, placed[key][previous]) for key, values in current.items()}
+    changed = [buses[row] for row in rows[is_changed]]
+    current_ids = set(current["ids"])
+    removed = [bus_id for bus_id in vehicles if bus_id not in current_ids]
+
+    # Buses behind a bus which moved or left need their headway computed again
+    dirty = set()
+    for bus_id in removed + [bus["id"] for bus in changed]:
+        remove_vehicle(bus_id, dirty)
+    located = add_vehicles(static, changed, current_trips, dirty)
+    for bus_id in dirty:
+        update_headway(static, bus_id)
+
+    tracker["stats"] = {
+        "updated": int(time.time()), "vehicles": len(vehicles), "changed": len(changed), "removed": len(removed),
+        "located": located, "recomputed": len(dirty), "seconds": round(time.perf_counter() - start, 6),
+    }
+
+# Removes a bus from the tracker, marking the bus which was behind it as dirty
+def remove_vehicle(bus_id, dirty):
+    vehicle = tracker["vehicles"].pop(bus_id, None)
+    tracker["headways"].pop(bus_id, None)
+    if vehicle is None or vehicle["group"] is None:
+        return
+    order = tracker["groups"][vehicle["group"]]
+    position = bisect.bisect_left(order, (vehicle["distance"], bus_id))
+    del order[position]
+    if position > 0:
+        dirty.add(order[position - 1][1])
+    if not order:
+        del tracker["groups"][vehicle["group"]]
+
+# Places buses along their lines and adds them to the tracker, marking them and the buses behind them as dirty
+# Returns the number of buses placed along their lines
+def add_vehicles(static, buses, current_trips, dirty):
+    if not buses:
+        return 0
+    trip_ids = {bus["trip_id"] for bus in buses}
+    next_stop_sequences = {(trip["trip_id"], str(trip["stop_id"])): trip["stop_sequence"] for trip in current_trips if trip["trip_id"] in trip_ids}
+    bus_trips = data_plane.get_trip_lookup(static).get_indexer([bus["trip_id"] for bus in buses])
+    _, bus_distance, _ = linear_referencing.locate_buses(static, buses, bus_trips, next_stop_sequences)
+    trips = static["tables"]["trips"]
+    trip_line = linear_referencing.get_line_index(static)["trip_line"]
+    located = 0
+    for bus, trip, distance in zip(buses, bus_trips, bus_distance):
+        vehicle = {"group": None, "trip": int(trip), "trip_id": bus["trip_id"], "route": bus["route"], "distance": float(distance)}
+        tracker["vehicles"][bus["id"]] = vehicle
+        if np.isnan(distance):
+            continue
+        vehicle["group"] = (int(trips["route"][trip]), int(trips["direction_id"][trip]), int(trip_line[trip]))
+        order = tracker["groups"].setdefault(vehicle["group"], [])
+        position = bisect.bisect_left(order, (vehicle["distance"], bus["id"]))
+        order.insert(position, (vehicle["distance"], bus["id"]))
+        dirty.add(bus["id"])
+        if position > 0:
+            dirty.add(order[position - 1][1])
+        located += 1
+    return located
+
+# Returns the scheduled time of a trip at some distances along its line, or nan for trips without stop distances
+def get_scheduled_times(static, trip, distances):
+    trip_stops = stop_events.get_trip_stops(static, trip)
+    stop_distance = np.asarray(trip_stops["shape_dist_traveled"], dtype=np.float64)
+    known = ~np.isnan(stop_distance)
+    if known.sum() < 2:
+        return np.full(len(distances), np.nan)
+    return np.interp(distances, stop_distance[known], np.asarray(trip_stops["arrival"], dtype=np.float64)[known])
+
+# Computes the headway of a bus to the bus ahead of it and whether it is bunched or behind a gap
+def update_headway(static, bus_id):
+    vehicle = tracker["vehicles"].get(bus_id)
+    if vehicle is None or vehicle["group"] is None:
+        return
+    order = tracker["groups"][vehicle["group"]]
+    position = bisect.bisect_left(order, (vehicle["distance"], bus_id))
+    if position + 1 >= len(order):
+        # The first bus along the line has no bus ahead of it
+        tracker["headways"].pop(bus_id, None)
+        return
+    leader_id = order[position + 1][1]
+    leader = tracker["vehicles"][leader_id]
+    follower_times = get_scheduled_times(static, vehicle["trip"], [vehicle["distance"], leader["distance"]])
+    leader_time = get_scheduled_times(static, leader["trip"], [leader["distance"]])[0]
+    actual = follower_times[1] - follower_times[0]
+    scheduled = follower_times[1] - leader_time
+    status = ""
+    if np.isnan(actual) or np.isnan(scheduled):
+        actual = scheduled = None
+    elif scheduled <= 0 or actual < bunched_ratio * scheduled:
+        status = "bunched"
+    elif actual > gap_ratio * scheduled and actual - scheduled >= gap_min_seconds:
+        status = "gap"
+    tracker["headways"][bus_id] = {
+        "leader": leader_id,
+        "actual": None if actual is None else int(round(actual)),
+        "scheduled": None if scheduled is None else int(round(scheduled)),
+        "status": status,
+    }
+
+# Returns the headways of every route, direction, and line of the latest realtime snapshot
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# Returns a list of dictionaries sorted by route with the buses of every line from the last to the first along the line, along with
+# metrics giving the work done by the last refresh and how many buses are tracked, bunched, and behind a gap across every route
+# ----------------------------------------------------------------------------------
+def get_route_headways(buses, current_trips):
+    static = data_plane.get_static()
+    with tracker_lock:
+        update_headways(static, buses, current_trips)
+        trips = static["tables"]["trips"]
+        routes = []
+        for (route, direction, line), order in tracker["groups"].items():
+            route_vehicles = []
+            for distance, bus_id in order:
+                vehicle = tracker["vehicles"][bus_id]
+                headway = tracker["headways"].get(bus_id, {"leader": None, "actual": None, "scheduled": None, "status": ""})
+                route_vehicles.append({"id": bus_id, "trip_id": vehicle["trip_id"], "distance": round(distance), **headway})
+            first_vehicle = tracker["vehicles"][order[-1][1]]
+            routes.append({
+                "route": str(first_vehicle["route"]),
+                "direction_id": direction,
+                "headsign": str(trips["trip_headsign"][first_vehicle["trip"]]),
+                "buses": len(route_vehicles),
+                "bunched": sum(vehicle["status"] == "bunched" for vehicle in route_vehicles),
+                "gaps": sum(vehicle["status"] == "gap" for vehicle in route_vehicles),
+                "vehicles": route_vehicles,
+            })
+        routes.sort(key=lambda route: (len(route["route"]), route["route"], route["direction_id"], route["headsign"]))
+        metrics = dict(tracker["stats"])
+        metrics.update({
+            "routes": len(routes),
+            "tracked": sum(route["buses"] for route in routes),
+            "bunched": sum(route["bunched"] for route in routes),
+            "gaps": sum(route["gaps"] for route in routes),
+        })
+        return {"routes": routes, "metrics": metrics}
@@ -0,0 +1,350 @@
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+import data_plane
+import fetch_data
+import static_dataset
+
+# Script used to benchmark the static ingest on synthetic GTFS feeds.
+# It generates static GTFS zip files with as many routes, stops, trips and stop times as Victoria's feed multiplied by every scale
+# given, then runs the ingest of fetch_data.py on each of them offline, in a fresh python process and an empty /data inside a temporary directory so
+# that neither the results nor the website's data are affected by the previous run. The ingest is followed by the build of the data
+# plane (see data_plane.py), which is the other half of getting a new feed to the website. The wall time, peak RSS and output size of
+# every stage are printed for every scale:
+# - unzip: opening the zip file and checking the crc of every file it contains. The output is the uncompressed size of the feed
+# - parse: reading the files into dataframes. The output is the memory used by the dataframes, summed over the stop_times chunks
+# - write: writing the dataframes to a new static version. The output is the size of the version directory
+# - transform: encoding the static version into the columns of the data plane. The output is the memory used by the columns
+# - publish: writing the columns to a new data plane version. The output is the size of the version directory
+# stop_times.txt is parsed one chunk at a time while the previous chunks are written, so the time spent reading each chunk is counted
+# in parse and the time spent writing it in write. If --memory-budget is given, the script fails when the peak RSS of any scale
+# exceeds that many MB, which tells whether feeds of that size would fit in the containers the ingest runs in.
+
+stages = ["unzip", "parse", "write", "transform", "publish"]
+
+# Approximate size of Victoria's static feed, multiplied by the scale of every synthetic feed
+victoria_feed = {
+    "routes": 69,
+    "stops": 2361,
+    "services": 23,
+    "calendar_dates": 269,
+    "trips": 51071,
+}
+# Every route has a pattern in each direction stopping at between min_pattern_stops and max_pattern_stops stops, about 40 on average
+# like in Victoria's feed
+min_pattern_stops = 20
+max_pattern_stops = 60
+# The line of every pattern in shapes.txt goes through its stops with points_per_segment - 1 more points between every two stops
+points_per_segment = 4
+# Number of trips generated at once when writing stop_times.txt
+trips_per_chunk = 50000
+
+# How often the RSS is sampled while the ingest runs
+rss_sample_seconds = 0.005
+
+# Wall time, peak RSS and output size of every stage of the ingest running in this process, and the stages currently running with
+# the innermost one last
+tracker = {"running": [], "seconds": {}, "peak_rss": {}, "output_bytes": {}, "resumed": None}
+tracker_lock = threading.Lock()
+
+# Returns a list of "HH:MM:SS" strings for every second from 0 to hours, used to format the stop times of millions of rows at once
+def get_time_strings(hours=30):
+    seconds = np.arange(hours * 3600)
+    return np.array([f"{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}" for s in seconds], dtype=object)
+
+# Writes a dataframe as a csv file inside a zip file
+def write_zip_csv(z, name, df):
+    with z.open(name, "w", force_zip64=True) as f:
+        with io.TextIOWrapper(f, encoding="utf-8", newline="") as text:
+            df.to_csv(text, index=False)
+
+# Generates a synthetic static GTFS zip file with the same files and columns as BC Transit's feed
+# ----------------------------------------------------------------------------------
+# path is the path of the zip file written
+# scale is the size of the feed relative to Victoria's feed e.g. 5 for 5 times as many routes, stops, trips and stop times
+# seed is the seed of the random stops, patterns and times
+# Returns the number of trips and stop times generated
+# ----------------------------------------------------------------------------------
+def generate_feed(path, scale, seed=0):
+    rng = np.random.default_rng(seed)
+    counts = {name: max(int(round(count * scale)), 1) for name, count in victoria_feed.items()}
+
+    # Stops are spread over an area growing with the number of stops
+    spread = 0.4 * np.sqrt(scale)
+    stop_ids = 100000 + np.arange(counts["stops"])
+    stops = pd.DataFrame({
+        "stop_id": stop_ids,
+        "stop_name": [f"Synthetic Stop {i}" for i in range(counts["stops"])],
+        "stop_lat": np.round(48.45 + (rng.random(counts["stops"]) - 0.5) * spread, 5),
+        "stop_lon": np.round(-123.4 + (rng.random(counts["stops"]) - 0.5) * spread, 5),
+        "wheelchair_boarding": 0,
+        "stop_code": stop_ids,
+    })
+    routes = pd.DataFrame({
+        "route_id": [f"{i + 1}-SYN" for i in range(counts["routes"])],
+        "route_short_name": np.arange(counts["routes"]) + 1,
+        "route_long_name": [f"Synthetic Route {i + 1}" for i in range(counts["routes"])],
+        "route_type": 3,
+        "route_color": [f"{color:06X}" for color in rng.integers(0, 0xFFFFFF, counts["routes"])],
+        "route_text_color": "FFFFFF",
+    })
+    service_ids = 4000 + np.arange(counts["services"])
+    calendar_dates = pd.DataFrame({
+        "service_id": rng.choice(service_ids, counts["calendar_dates"]),
+        "date": (pd.Timestamp("2026-09-01") + pd.to_timedelta(rng.integers(0, 90, counts["calendar_dates"]), unit="D")).strftime("%Y%m%d").astype(int),
+        "exception_type": 1,
+    })
+
+    # Pattern i is run by the trips of route i // 2 in direction i % 2. The stops of pattern i are pattern_stops[pattern_offsets[i]:pattern_offsets[i + 1]]
+    pattern_lengths = rng.integers(min_pattern_stops, max_pattern_stops + 1, counts["routes"] * 2)
+    pattern_offsets = np.concatenate([[0], np.cumsum(pattern_lengths)])
+    pattern_stops = rng.choice(stop_ids, pattern_offsets[-1])
+
+    patterns = rng.integers(0, counts["routes"] * 2, counts["trips"])
+    blocks = 13000000 + np.arange(counts["trips"]) // 8
+    trip_ids = np.array([f"{10000000 + i}:{13500000 + pattern}:{block}" for i, (pattern, block) in enumerate(zip(patterns, blocks))], dtype=object)
+    trips = pd.DataFrame({
+        "route_id": routes["route_id"].to_numpy()[patterns // 2],
+        "service_id": rng.choice(service_ids, counts["trips"]),
+        "trip_id": trip_ids,
+        "trip_headsign": [f"Synthetic {pattern // 2 + 1}" for pattern in patterns],
+        "shape_id": 50000 + patterns,
+        "block_id": blocks,
+        "direction_id": patterns % 2,
+    })
+
+    # Every point of the line of each pattern is either a stop of the pattern or between it and the next stop, 400 meters apart like
+    # in shape_dist_traveled of stop_times.txt
+    pattern_count = counts["routes"] * 2
+    is_last_stop = np.zeros(pattern_offsets[-1], dtype=bool)
+    is_last_stop[pattern_offsets[1:] - 1] = True
+    point_counts = np.where(is_last_stop, 1, points_per_segment)
+    point_stops = np.repeat(np.arange(pattern_offsets[-1]), point_counts)
+    fractions = (np.arange(len(point_stops)) - np.repeat(np.cumsum(point_counts) - point_counts, point_counts)) / points_per_segment
+    next_point_stops = np.minimum(point_stops + 1, pattern_offsets[-1] - 1)
+    stop_rows = pattern_stops - stop_ids[0]
+    point_patterns = np.repeat(np.arange(pattern_count), pattern_lengths)[point_stops]
+    shape_offsets = np.searchsorted(point_patterns, np.arange(pattern_count))
+    shapes = pd.DataFrame({
+        "shape_id": 50000 + point_patterns,
+        "shape_pt_lat": np.round(stops["stop_lat"].to_numpy()[stop_rows[point_stops]] * (1 - fractions) + stops["stop_lat"].to_numpy()[stop_rows[next_point_stops]] * fractions, 6),
+        "shape_pt_lon": np.round(stops["stop_lon"].to_numpy()[stop_rows[point_stops]] * (1 - fractions) + stops["stop_lon"].to_numpy()[stop_rows[next_point_stops]] * fractions, 6),
+        "shape_pt_sequence": np.arange(len(point_stops)) - shape_offsets[point_patterns] + 1,
+        "shape_dist_traveled": (point_stops - pattern_offsets[point_patterns] + fractions) * 400,
+    })
+
+    time_strings = get_time_strings()
+    stop_time_count = 0
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for name, df in [("trips", trips), ("stops", stops), ("routes", routes), ("calendar_dates", calendar_dates), ("shapes", shapes)]:
+            write_zip_csv(z, f"{name}.txt", df)
+
+        with z.open("stop_times.txt", "w", force_zip64=True) as f:
+            with io.TextIOWrapper(f, encoding="utf-8", newline="") as text:
+                for start in range(0, counts["trips"], trips_per_chunk):
+                    chunk_patterns = patterns[start:start + trips_per_chunk]
+                    lengths = pattern_lengths[chunk_patterns]
+                    owners = np.repeat(np.arange(len(chunk_patterns)), lengths)
+                    sequence = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+                    # Buses leave their first stop between 5:00 and 25:00 and take 1 to 2 minutes between stops
+                    first_departures = rng.integers(5 * 3600, 25 * 3600, len(chunk_patterns))
+                    steps = (60 + rng.integers(0, 60, len(owners))) * (sequence > 0)
+                    elapsed = np.cumsum(steps)
+                    arrivals = first_departures[owners] + elapsed - np.repeat(elapsed[np.cumsum(lengths) - lengths], lengths)
+                    stop_times = pd.DataFrame({
+                        "trip_id": trip_ids[start:start + trips_per_chunk][owners],
+                        "arrival_time": time_strings[arrivals],
+                        "departure_time": time_strings[arrivals],
+                        "stop_id": pattern_stops[pattern_offsets[chunk_patterns][owners] + sequence],
+                        "stop_sequence": sequence + 1,
+                        "shape_dist_traveled": sequence * 400,
+                        "stop_headsign": "",
+                        "pickup_type": 0,
+                        "drop_off_type": 0,
+                        "timepoint": 0,
+                    })
+                    stop_times.to_csv(text, index=False, header=start == 0)
+                    stop_time_count += len(stop_times)
+    return counts["trips"], stop_time_count
+
+# Returns the resident set size of this process in bytes
+def get_rss():
+    with open("/proc/self/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+# Samples the RSS of this process and records it as the peak of every stage running until stop is set
+def sample_rss(stop):
+    while not stop.is_set():
+        rss = get_rss()
+        with tracker_lock:
+            for name in tracker["running"]:
+                tracker["peak_rss"][name] = max(tracker["peak_rss"].get(name, 0), rss)
+        stop.wait(rss_sample_seconds)
+
+# Counts the time spent inside the block in a stage. When a stage is started inside another one, the time is only counted in the
+# inner stage, while the peak RSS counts for both
+@contextlib.contextmanager
+def stage(name):
+    with tracker_lock:
+        now = time.perf_counter()
+        if tracker["running"]:
+            outer = tracker["running"][-1]
+            tracker["seconds"][outer] = tracker["seconds"].get(outer, 0) + now - tracker["resumed"]
+        tracker["running"].append(name)
+        tracker["resumed"] = now
+        tracker["peak_rss"][name] = max(tracker["peak_rss"].get(name, 0), get_rss())
+    try:
+        yield
+    finally:
+        with tracker_lock:
+            now = time.perf_counter()
+            tracker["seconds"][name] = tracker["seconds"].get(name, 0) + now - tracker["resumed"]
+            tracker["running"].pop()
+            tracker["resumed"] = now
+
+# Returns the memory used by a dataframe, a numpy array, or a dictionary of them in bytes
+def get_memory_bytes(data):
+    if isinstance(data, dict):
+        return sum(get_memory_bytes(value) for value in data.values())
+    if isinstance(data, pd.DataFrame):
+        return int(data.memory_usage(deep=True).sum())
+    return int(np.asarray(data).nbytes)
+
+# Returns the size of every file inside a directory in bytes
+def get_directory_bytes(directory):
+    return sum(os.path.getsize(os.path.join(root, file)) for root, _, files in os.walk(directory) for file in files)
+
+# Yields the chunks of stop_times.txt while counting the time spent reading them in the parse stage
+def parse_chunks(stop_times_iter):
+    while True:
+        with stage("parse"):
+            chunk = next(stop_times_iter, None)
+            if chunk is not None:
+                tracker["output_bytes"]["parse"] = tracker["output_bytes"].get("parse", 0) + get_memory_bytes(chunk)
+        if chunk is None:
+            return
+        yield chunk
+
+# Runs the whole ingest of a static GTFS zip file in an empty /data inside workdir and returns the results of every stage
+def run_ingest(zip_path, workdir):
+    os.chdir(workdir)
+    os.makedirs("data", exist_ok=True)
+    with open(zip_path, "rb") as f:
+        content = f.read()
+    feed_hash = hashlib.sha256(content).hexdigest()
+
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample_rss, args=(stop,), daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        with stage("unzip"):
+            z = fetch_data.unzip_static(content)
+            tracker["output_bytes"]["unzip"] = sum(info.file_size for info in z.infolist())
+        with stage("parse"):
+            tables, stop_times_iter = fetch_data.parse_static(z)
+            tracker["output_bytes"]["parse"] = get_memory_bytes(tables)
+        with stage("write"):
+            version = static_dataset.write_version(feed_hash, tables, parse_chunks(stop_times_iter))
+            tracker["output_bytes"]["write"] = get_directory_bytes(os.path.join(static_dataset.static_root, version))
+        del tables, stop_times_iter, z, content
+
+        signature = data_plane.get_static_signature()
+        with stage("transform"):
+            plane_tables = data_plane.build_static_tables()
+            tracker["output_bytes"]["transform"] = get_memory_bytes(plane_tables)
+        with stage("publish"):
+            plane_version = data_plane.write_static_version(plane_tables, signature)
+            tracker["output_bytes"]["publish"] = get_directory_bytes(os.path.join(data_plane.plane_dir, plane_version))
+    finally:
+        stop.set()
+        sampler.join()
+
+    return {
+        "total_seconds": time.perf_counter() - start,
+        "peak_rss": max(tracker["peak_rss"].values()),
+        "stages": {name: {
+            "seconds": tracker["seconds"].get(name, 0),
+            "peak_rss": tracker["peak_rss"].get(name, 0),
+            "output_bytes": tracker["output_bytes"].get(name, 0),
+        } for name in stages},
+    }
+
+# Runs the ingest of a zip file in a fresh python process and returns its results
+def run_ingest_process(zip_path, workdir):
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--ingest", zip_path, "--workdir", workdir],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+                            env={**os.environ, "PYTHONPATH": os.path.dirname(os.path.abspath(__file__))})
+    if result.returncode != 0:
+        raise RuntimeError(f"The ingest of {zip_path} failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the static ingest on synthetic GTFS feeds scaled from Victoria's feed")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 5, 20], help="sizes of the synthetic feeds relative to Victoria's feed")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic feeds")
+    parser.add_argument("--workdir", help="directory where the feeds are generated and ingested, a temporary directory by default")
+    parser.add_argument("--keep", action="store_true", help="keep the generated feeds and ingested data")
+    parser.add_argument("--memory-budget", type=float, help="fail if the peak RSS of any scale exceeds this many MB")
+    parser.add_argument("--output", help="also save the results as json to this file")
+    parser.add_argument("--ingest", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Run by run_ingest_process in the fresh python process
+    if args.ingest:
+        print(json.dumps(run_ingest(args.ingest, args.workdir)))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ingest-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    try:
+        for scale in args.scales:
+            scale_dir = os.path.join(workdir, f"scale-{scale:g}")
+            shutil.rmtree(scale_dir, ignore_errors=True)
+            os.makedirs(scale_dir)
+            zip_path = os.path.join(scale_dir, "google_transit.zip")
+            start = time.perf_counter()
+            trip_count, stop_time_count = generate_feed(zip_path, scale, args.seed)
+            print(f"Scale {scale:g}: generated {trip_count} trips and {stop_time_count} stop times ({os.path.getsize(zip_path) / 1e6:.1f} MB zipped) in {time.perf_counter() - start:.1f} s")
+
+            result = run_ingest_process(zip_path, scale_dir)
+            result.update({"scale": scale, "trips": trip_count, "stop_times": stop_time_count, "zip_bytes": os.path.getsize(zip_path)})
+            results.append(result)
+            for name in stages:
+                stage_result = result["stages"][name]
+                print(f"  {name:<10} {stage_result['seconds']:8.2f} s  peak RSS {stage_result['peak_rss'] / 1e6:8.1f} MB  output {stage_result['output_bytes'] / 1e6:8.1f} MB")
+            print(f"  {'total':<10} {result['total_seconds']:8.2f} s  peak RSS {result['peak_rss'] / 1e6:8.1f} MB")
+            if not args.keep:
+                shutil.rmtree(scale_dir, ignore_errors=True)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    over_budget = [result for result in results if args.memory_budget is not None and result["peak_rss"] / 1e6 > args.memory_budget]
+    if over_budget:
+        over_budget_scales = ", ".join(f"{result['scale']:g}" for result in over_budget)
+        raise SystemExit(f"The peak RSS of scale {over_budget_scales} exceeds the budget of {args.memory_budget} MB")
+
+if __name__ == "__main__":
+    main()
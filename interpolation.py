@@ -0,0 +1,156 @@
+import math
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+import data_plane
+import linear_referencing
+
+# Dead-reckoning of bus positions between realtime refreshes.
+# The position of a bus only changes when the realtime data is refreshed, so the bus tracker map jumps from point to point.
+# Instead of refreshing more often, every bus is placed along the line of its trip's shape (see linear_referencing), only looking
+# between its previous stop and its next stop so a loop or a there-and-back trip doesn't place it on the wrong visit, and moved along
+# that line at its reported speed for the time elapsed since its position was reported. A bus is never moved past its next stop,
+# since it may stop there, and is never extrapolated for more than max_extrapolation_seconds. Buses which are not running a trip or
+# couldn't be placed along their line are moved in a straight line along their bearing instead.
+# The motion model of a bus is built once per snapshot: its reported time and speed and the part of its line it can be moved along,
+# as lists of lat, lon and distance from where it is now. It is sent once to the browser, which moves the bus marker itself on every
+# tick without asking the server, and the same model gives the position returned by /api/vehicles/interpolated.
+
+max_extrapolation_seconds = 90
+
+# Meters per degree of latitude and of longitude around Victoria, used to work in meters on a flat local projection
+meters_per_degree_lat = 111_132.0
+meters_per_degree_lon = 111_320.0 * math.cos(math.radians(48.45))
+
+# The motion model of every bus in the latest realtime snapshot, built as buses are asked for
+model = {"signature": None, "vehicles": {}}
+model_lock = threading.Lock()
+
+# Returns the unix timestamp at which the position of a bus was reported, or at which it was downloaded for snapshots without it
+def get_report_time(bus):
+    if bus.get("reported"):
+        return float(bus["reported"])
+    return datetime.fromisoformat(bus["timestamp"]).replace(tzinfo=ZoneInfo("UTC")).timestamp()
+
+# Returns the points of a bus's line it can be moved along, as x and y coordinates in meters and distances from where it is now
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# bus is the dictionary of that bus from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# Returns None if the bus isn't running a trip or couldn't be placed along the line of its trip
+# ----------------------------------------------------------------------------------
+def get_line_path(static, bus, current_trips):
+    if not bus["trip_id"]:
+        return None
+    trip = data_plane.get_trip_lookup(static).get_indexer([bus["trip_id"]])
+    next_stop_sequences = {(t["trip_id"], str(t["stop_id"])): t["stop_sequence"] for t in current_trips if t["trip_id"] == bus["trip_id"]}
+    next_position, bus_distance, _ = linear_referencing.locate_buses(static, [bus], trip, next_stop_sequences)
+    if np.isnan(bus_distance[0]):
+        return None
+
+    # The bus is never moved past its next stop, or past the end of its line when the distance of the stop is unknown
+    index = linear_referencing.get_line_index(static)
+    line = index["trip_line"][trip[0]]
+    first, last = index["line_offsets"][line], index["line_offsets"][line + 1]
+    pattern = int(static["tables"]["trips"]["pattern"][trip[0]])
+    pattern_row = static["tables"]["indexes"]["pattern_offsets"][pattern] + next_position[0]
+    max_distance = float(static["tables"]["patterns"]["shape_dist_traveled"][pattern_row])
+    if np.isnan(max_distance):
+        max_distance = float(index["distance"][last - 1])
+    max_distance = max(max_distance, bus_distance[0])
+
+    line_distance = index["distance"][first:last]
+    ahead = (line_distance > bus_distance[0]) & (line_distance < max_distance)
+    distance = np.concatenate([[bus_distance[0]], line_distance[ahead], [max_distance]])
+    x = np.interp(distance, line_distance, index["x"][first:last])
+    y = np.interp(distance, line_distance, index["y"][first:last])
+    return x, y, distance - bus_distance[0]
+
+# Returns the motion model of a bus, which can be sent as json
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# bus is the dictionary of that bus from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# Returns the bus number, its id, the time its position was reported, its speed and bearing, how long it can be extrapolated for, and
+# the lat, lon, and distance in meters from its reported position of every point of the path it can be moved along
+# ----------------------------------------------------------------------------------
+def build_motion_model(static, bus, current_trips):
+    speed = bus["speed"] or 0
+    path = get_line_path(static, bus, current_trips)
+    if path is None:
+        # Move the bus in a straight line along its bearing
+        x = bus["lon"] * meters_per_degree_lon
+        y = bus["lat"] * meters_per_degree_lat
+        reach = speed * max_extrapolation_seconds
+        bearing = math.radians(bus["bearing"] or 0)
+        path = np.array([x, x + reach * math.sin(bearing)]), np.array([y, y + reach * math.cos(bearing)]), np.array([0.0, reach])
+    x, y, distance = path
+    return {
+        "bus": bus["id"][-4:],
+        "id": bus["id"],
+        "reported": get_report_time(bus),
+        "speed": speed,
+        "bearing": bus["bearing"],
+        "max_extrapolation_seconds": max_extrapolation_seconds,
+        "lat": (y / meters_per_degree_lat).tolist(),
+        "lon": (x / meters_per_degree_lon).tolist(),
+        "distance": np.round(distance, 2).tolist(),
+    }
+
+# Returns the motion model of a bus of the latest realtime snapshot, building it only once per snapshot
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# bus_number is the bus number e.g. 9541
+# Returns the motion model returned by build_motion_model along with the signature of the snapshot, or None if the bus isn't running
+# ----------------------------------------------------------------------------------
+def get_motion_model(buses, current_trips, bus_number):
+    bus = next((b for b in buses if b["id"].endswith(str(bus_number))), None)
+    if not bus:
+        return None
+    static = data_plane.get_static()
+    signature = str(data_plane.get_realtime_signature())
+    with model_lock:
+        if model["signature"] != signature:
+            model["signature"] = signature
+            model["vehicles"] = {}
+        motion = model["vehicles"].get(bus["id"])
+    if motion is None:
+        motion = build_motion_model(static, bus, current_trips)
+        motion["signature"] = signature
+        with model_lock:
+            model["vehicles"][bus["id"]] = motion
+    return motion
+
+# Returns the dead-reckoned position of a bus from its motion model, the same way the bus tracker page moves the bus marker
+# ----------------------------------------------------------------------------------
+# motion is the motion model returned by get_motion_model
+# at_time is the unix timestamp at which the position is wanted, or now if it isn't given
+# Returns a dictionary with the bus number, its id, lat, lon, bearing and how many seconds it was extrapolated for
+# ----------------------------------------------------------------------------------
+def get_model_position(motion, at_time=None):
+    at_time = time.time() if at_time is None else at_time
+    elapsed = min(max(at_time - motion["reported"], 0), motion["max_extrapolation_seconds"])
+    distance = np.asarray(motion["distance"])
+    travelled = min(motion["speed"] * elapsed, distance[-1])
+    lat = float(np.interp(travelled, distance, motion["lat"]))
+    lon = float(np.interp(travelled, distance, motion["lon"]))
+    bearing = motion["bearing"]
+    # The bearing is the one of the part of the path the bus is on, or the reported bearing while it hasn't moved
+    if travelled > 0:
+        segment = int(np.clip(np.searchsorted(distance, travelled) - 1, 0, len(distance) - 2))
+        segment_x = (motion["lon"][segment + 1] - motion["lon"][segment]) * meters_per_degree_lon
+        segment_y = (motion["lat"][segment + 1] - motion["lat"][segment]) * meters_per_degree_lat
+        bearing = math.degrees(math.atan2(segment_x, segment_y)) % 360
+    return {
+        "bus": motion["bus"],
+        "id": motion["id"],
+        "lat": lat,
+        "lon": lon,
+        "bearing": bearing,
+        "extrapolated_seconds": elapsed,
+    }
@@ -0,0 +1,101 @@
+import argparse
+import json
+import time
+from datetime import date
+
+import numpy as np
+
+import data_plane
+import journey_planner
+import realtime_cache
+
+# Script used to benchmark the journey planner.
+# It builds the route patterns, walking transfers and timetable of a service day once, then plans journeys between random pairs of
+# stops served that day and prints how long building and planning took along with the percentiles of the query times. If --budget
+# is given, the script fails when the 99th percentile of the query times exceeds that many milliseconds.
+
+# Returns the realtime data of bus_updates.json or trip_updates.json without ever calling BC Transit
+def load_realtime(name):
+    data = data_plane.load_realtime(name)
+    return data if data is not None else realtime_cache.load_local_snapshot(name)
+
+# Returns the service ids running on a date of the static data e.g. 20260901
+def get_service_ids(static, service_date):
+    calendar_dates = static["tables"]["calendar_dates"]
+    return np.asarray(calendar_dates["service_id"])[np.asarray(calendar_dates["date"]).astype(str) == str(service_date)].astype(np.int64)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the journey planner over random origin and destination stops")
+    parser.add_argument("--queries", type=int, default=500, help="number of journeys planned")
+    parser.add_argument("--date", default=date.today().strftime("%Y%m%d"), help="service date in the YYYYMMDD format")
+    parser.add_argument("--time", default="08:00", help="departure time of every journey in the HH:MM format")
+    parser.add_argument("--realtime", action="store_true", help="use the arrival times estimated from the realtime data")
+    parser.add_argument("--max-transfers", type=int, default=journey_planner.max_transfers, help="maximum number of transfers between buses")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random stop pairs")
+    parser.add_argument("--budget", type=float, help="fail if the 99th percentile query time exceeds this many milliseconds")
+    parser.add_argument("--output", help="also save the results as json to this file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    static = data_plane.get_static()
+    service_ids = get_service_ids(static, args.date)
+    if len(service_ids) == 0:
+        parser.error(f"no service runs on {args.date}")
+    buses = load_realtime("bus_updates")
+    current_trips = load_realtime("trip_updates")
+    static_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    static, network, timetable, _ = journey_planner.get_timetable(service_ids, buses, current_trips, args.realtime)
+    build_seconds = time.perf_counter() - start
+
+    # Only pick stops served by at least one trip that day
+    served = np.unique(timetable["stop_codes"])
+    if len(served) < 2:
+        parser.error(f"fewer than 2 stops are served on {args.date}")
+    stop_ids = np.asarray(static["tables"]["stops"]["stop_id"])
+    hours, minutes = args.time.split(":")
+    departure_time = int(hours) * 3600 + int(minutes) * 60
+    rng = np.random.default_rng(args.seed)
+    pairs = [rng.choice(served, 2, replace=False) for _ in range(args.queries)]
+
+    query_seconds = []
+    found = 0
+    transfers = []
+    for origin, destination in pairs:
+        start = time.perf_counter()
+        journey = journey_planner.plan_journey(stop_ids[origin], stop_ids[destination], service_ids, buses, current_trips, departure_time,
+                                               args.realtime, args.max_transfers)
+        query_seconds.append(time.perf_counter() - start)
+        if journey is not None:
+            found += 1
+            transfers.append(journey["transfers"])
+
+    query_ms = np.array(query_seconds) * 1000
+    results = {
+        "patterns": len(network["stop_offsets"]) - 1,
+        "stops_served": len(served),
+        "transfers": len(network["transfer_stops"]),
+        "cells": len(timetable["cells"]),
+        "static_seconds": static_seconds,
+        "build_seconds": build_seconds,
+        "queries": len(query_ms),
+        "found": found,
+        "mean_transfers": float(np.mean(transfers)) if transfers else 0.0,
+        "p50_ms": float(np.percentile(query_ms, 50)),
+        "p90_ms": float(np.percentile(query_ms, 90)),
+        "p99_ms": float(np.percentile(query_ms, 99)),
+        "max_ms": float(query_ms.max()),
+    }
+    print(f"{results['patterns']} patterns, {results['stops_served']} stops served, {results['transfers']} walking transfers, {results['cells']} stop times on {args.date}")
+    print(f"Loading the static data took {static_seconds:.2f} s and building the network and timetable took {build_seconds:.2f} s")
+    print(f"{found} of {len(query_ms)} journeys found with {results['mean_transfers']:.2f} transfers on average")
+    print(f"Query time p50 {results['p50_ms']:.2f} ms, p90 {results['p90_ms']:.2f} ms, p99 {results['p99_ms']:.2f} ms, max {results['max_ms']:.2f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.budget is not None and results["p99_ms"] > args.budget:
+        raise SystemExit(f"The 99th percentile query time of {results['p99_ms']:.2f} ms exceeds the budget of {args.budget} ms")
+
+if __name__ == "__main__":
+    main()
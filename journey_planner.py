@@ -0,0 +1,435 @@
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+import data_plane
+import eta_engine
+import interpolation
+
+# RAPTOR journey planner over the static timetable.
+# Trips visiting the same stops in the same order are grouped into route patterns when the static data is built, and the stop times
+# of every pattern are stored as one flat array of stop_times rows (one row of cells per trip, sorted by departure). Walking transfers
+# between stops less than max_walk_meters apart are precomputed from the stop coordinates. For each service day, only the trips
+# running that day are kept and their cells are also sorted by pattern position and departure time, so finding the first trip
+# leaving a stop after a given time is a single searchsorted for every stop reached so far. A query then runs one round per bus taken:
+# every round boards the earliest catchable trip of every pattern at every stop improved in the previous round, rides it to the
+# following stops and walks from the stops it improved, all with vectorized numpy operations instead of a loop over patterns or stops.
+# When realtime is used, the arrival and departure times of every cell are the ones estimated by eta_engine and the stops a bus has
+# already passed can't be boarded anymore.
+
+max_walk_meters = 400
+walking_speed = 1.2
+# Walking distances are longer than straight lines between stops
+walking_detour = 1.3
+min_transfer_seconds = 60
+max_transfers = 3
+
+# Time used for unreachable stops and for cells which can't be boarded
+never = 2 ** 31 - 1
+
+# The timetable of every pattern for the current service day, for the scheduled times and for the realtime estimates
+timetables = {
+    False: {"key": None, "data": None},
+    True: {"key": None, "data": None},
+}
+timetable_lock = threading.Lock()
+
+# Returns the indices of every element of the ranges starts[i] to starts[i] + lengths[i] along with the range each one belongs to
+def expand_ranges(starts, lengths):
+    lengths = np.asarray(lengths, dtype=np.int64)
+    owners = np.repeat(np.arange(len(lengths)), lengths)
+    ends = np.cumsum(lengths)
+    total = int(ends[-1]) if len(ends) else 0
+    return np.repeat(np.asarray(starts, dtype=np.int64) - ends + lengths, lengths) + np.arange(total), owners
+
+# Returns the position of the smallest value of every key
+def get_min_rows(keys, values):
+    if len(keys) == 0:
+        return np.array([], dtype=np.int64)
+    order = np.lexsort((values, keys))
+    first = np.concatenate([[True], keys[order][1:] != keys[order][:-1]])
+    return order[first]
+
+# Returns the route patterns and walking transfers of the static data
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# ----------------------------------------------------------------------------------
+def build_network(static):
+    tables = static["tables"]
+    indexes = tables["indexes"]
+    trip_offsets = np.asarray(indexes["trip_offsets"])
+    stop_count = len(tables["stops"]["stop_id"])
+
+    # The stop patterns of the static data group the trips visiting the same stops in the same order. Patterns with fewer than 2 stops
+    # or unknown stops and trips with missing times are left out
+    pattern_offsets = np.asarray(indexes["pattern_offsets"])
+    pattern_lengths = np.diff(pattern_offsets)
+    pattern_count = len(pattern_lengths)
+    row_patterns = np.repeat(np.arange(pattern_count), pattern_lengths)
+    stored_stops = np.asarray(tables["patterns"]["stop"]).astype(np.int64)
+    usable_pattern = (pattern_lengths >= 2) & (np.bincount(row_patterns[stored_stops < 0], minlength=pattern_count) == 0)
+    timing_offsets = np.asarray(indexes["timing_offsets"])
+    timings = tables["timings"]
+    earliest_offsets = np.minimum(np.asarray(timings["arrival"]), np.asarray(timings["departure"])).astype(np.int64)
+    timing_min = np.minimum.reduceat(earliest_offsets, timing_offsets[:-1]) if len(earliest_offsets) else np.array([], dtype=np.int64)
+    stored_trips = np.asarray(indexes["pattern_trips"])
+    stored_trip_offsets = np.asarray(indexes["pattern_trip_offsets"])
+    trip_patterns = np.repeat(np.arange(pattern_count), np.diff(stored_trip_offsets))
+    complete_times = np.asarray(tables["trips"]["start"])[stored_trips] + timing_min[np.asarray(tables["trips"]["timing"])[stored_trips]] >= 0
+    kept = usable_pattern[trip_patterns] & complete_times
+    pattern_trips = stored_trips[kept].astype(np.int64)
+    trip_patterns = trip_patterns[kept]
+
+    # Patterns are numbered again from 0 without the ones left out
+    kept_patterns, pattern_trip_counts = np.unique(trip_patterns, return_counts=True)
+    pattern_lengths = pattern_lengths[kept_patterns]
+    pattern_stops, _ = expand_ranges(pattern_offsets[kept_patterns], pattern_lengths)
+    pattern_stops = stored_stops[pattern_stops]
+    stop_offsets = np.concatenate([[0], np.cumsum(pattern_lengths)]).astype(np.int64)
+
+    # The stop_times rows of every trip of every pattern, one trip after the other
+    cells, _ = expand_ranges(trip_offsets[pattern_trips], trip_offsets[pattern_trips + 1] - trip_offsets[pattern_trips])
+
+    # Every position of every pattern serving each stop: the positions of stop i are stop_positions[stop_position_offsets[i]:stop_position_offsets[i + 1]]
+    stop_positions = np.argsort(pattern_stops, kind="stable")
+    stop_position_offsets = np.searchsorted(pattern_stops[stop_positions], np.arange(stop_count + 1)).astype(np.int64)
+
+    # Walking transfers from every stop to the stops around it, compared a block of stops at a time
+    stops = static["tables"]["stops"]
+    x = np.asarray(stops["stop_lon"], dtype=np.float64) * interpolation.meters_per_degree_lon
+    y = np.asarray(stops["stop_lat"], dtype=np.float64) * interpolation.meters_per_degree_lat
+    transfer_from, transfer_to, transfer_distance = [], [], []
+    for start in range(0, stop_count, 512):
+        distance = np.hypot(x[start:start + 512, None] - x[None, :], y[start:start + 512, None] - y[None, :])
+        near_from, near_to = np.nonzero(distance <= max_walk_meters)
+        different = near_from + start != near_to
+        transfer_from.append(near_from[different] + start)
+        transfer_to.append(near_to[different])
+        transfer_distance.append(distance[near_from[different], near_to[different]])
+    transfer_from = np.concatenate(transfer_from) if transfer_from else np.array([], dtype=np.int64)
+
+    return {
+        "pattern_stops": pattern_stops,
+        "stop_offsets": stop_offsets,
+        "position_pattern": np.repeat(np.arange(len(pattern_lengths)), pattern_lengths),
+        "pattern_trips": pattern_trips,
+        "trip_offsets": np.concatenate([[0], np.cumsum(pattern_trip_counts)]).astype(np.int64),
+        "cells": cells,
+        "stop_positions": stop_positions,
+        "stop_position_offsets": stop_position_offsets,
+        "transfer_offsets": np.searchsorted(transfer_from, np.arange(stop_count + 1)).astype(np.int64),
+        "transfer_stops": np.concatenate(transfer_to) if transfer_to else np.array([], dtype=np.int64),
+        "transfer_seconds": np.ceil(np.concatenate(transfer_distance) * walking_detour / walking_speed).astype(np.int64) if transfer_distance else np.array([], dtype=np.int64),
+    }
+
+# Returns the timetable of every pattern for one service day
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# network is the network returned by build_network
+# service_ids is the list of service ids running that day
+# state is the engine state returned by eta_engine.get_engine_state, or None to only use the scheduled times
+# ----------------------------------------------------------------------------------
+def build_timetable(static, network, service_ids, state):
+    stop_times = static["tables"]["stop_times"]
+    running = np.isin(np.asarray(static["tables"]["trips"]["service_id"]), np.asarray(service_ids, dtype=np.int64))
+
+    # Only keep the trips of each pattern running that day, along with their cells
+    pattern_count = len(network["stop_offsets"]) - 1
+    pattern_lengths = np.diff(network["stop_offsets"])
+    trip_pattern = np.repeat(np.arange(pattern_count), np.diff(network["trip_offsets"]))
+    trip_running = running[network["pattern_trips"]]
+    trip_counts = np.bincount(trip_pattern[trip_running], minlength=pattern_count)
+    cells = network["cells"][np.repeat(trip_running, pattern_lengths[trip_pattern])]
+    cell_offsets = np.concatenate([[0], np.cumsum(trip_counts * pattern_lengths)]).astype(np.int64)
+
+    arrival = np.asarray(stop_times["arrival"])[cells].astype(np.int64)
+    departure = np.asarray(stop_times["departure"])[cells].astype(np.int64)
+    source = np.zeros(len(cells), dtype=np.int64)
+    if state is not None:
+        trip = np.asarray(stop_times["trip"])[cells].astype(np.int64)
+        stop_sequence = np.asarray(stop_times["stop_sequence"])[cells].astype(np.int64)
+        eta, source, passed = eta_engine.estimate_arrivals(state, trip, stop_sequence, arrival)
+        # A bus keeps its scheduled dwell time at every stop
+        departure = np.where(passed, never, eta + np.maximum(departure - arrival, 0))
+        arrival = eta
+
+    # Cells sorted by pattern position and departure time, so that the first trip leaving a position after a time is a searchsorted away
+    cell_pattern = np.repeat(np.arange(pattern_count), trip_counts * pattern_lengths)
+    within = np.arange(len(cells)) - cell_offsets[cell_pattern]
+    cell_position = network["stop_offsets"][cell_pattern] + within % pattern_lengths[cell_pattern]
+    departure_cells = np.lexsort((departure, cell_position))
+
+    return {
+        "cells": cells,
+        "stop_codes": np.asarray(stop_times["stop"])[cells].astype(np.int64),
+        "cell_offsets": cell_offsets,
+        "arrival": arrival,
+        "departure": departure,
+        "source": source,
+        "departure_keys": (cell_position[departure_cells] << 32) | np.minimum(departure[departure_cells], never),
+        "departure_cells": departure_cells,
+        "departure_trips": (within // pattern_lengths[cell_pattern])[departure_cells],
+    }
+
+# Returns the network and timetable used to plan journeys today, rebuilding the timetable only when the static data, realtime
+# snapshot, or service day changes
+# ----------------------------------------------------------------------------------
+# service_ids is the list of service ids running today
+# buses and current_trips are the realtime data from bus_updates.json and trip_updates.json
+# use_realtime is True to use the times estimated by eta_engine instead of the scheduled times
+# Returns the static data, the network, the timetable, and the unix timestamp of the start of today's service day
+# ----------------------------------------------------------------------------------
+def get_timetable(service_ids, buses, current_trips, use_realtime):
+    if use_realtime:
+        static, state = eta_engine.get_engine_state(service_ids, buses, current_trips)
+        service_day_start = state["service_day_start"]
+        realtime_signature = data_plane.get_realtime_signature()
+    else:
+        static, state = data_plane.get_static(), None
+        service_day_start = eta_engine.get_service_day_start(datetime.now(ZoneInfo(eta_engine.service_timezone)))
+        realtime_signature = None
+    network = data_plane.get_cached(static, ("journey_network",), lambda: build_network(static))
+    key = (static["version"], realtime_signature, service_day_start, tuple(sorted(int(s) for s in service_ids)))
+    cached = timetables[use_realtime]
+    with timetable_lock:
+        if cached["key"] != key:
+            cached["data"] = build_timetable(static, network, service_ids, state)
+            cached["key"] = key
+        return static, network, cached["data"], service_day_start
+
+# Walks from stops improved by a bus to the stops around them
+# ----------------------------------------------------------------------------------
+# network is the network returned by build_network
+# label is the label of the current round
+# best is the earliest arrival at every stop in any round
+# sources are the stops improved by a bus in the current round
+# destination is the stop code of the destination, used to ignore arrivals later than the best known arrival there
+# Returns the stops improved by walking
+# ----------------------------------------------------------------------------------
+def relax_transfers(network, label, best, sources, destination):
+    transfer_offsets = network["transfer_offsets"]
+    transfers, owners = expand_ranges(transfer_offsets[sources], transfer_offsets[sources + 1] - transfer_offsets[sources])
+    targets = network["transfer_stops"][transfers]
+    times = label["arrival"][sources][owners] + network["transfer_seconds"][transfers]
+    rows = get_min_rows(targets, times)
+    targets, times, owners = targets[rows], times[rows], owners[rows]
+    improved = times < np.minimum(best[targets], best[destination])
+    targets, times = targets[improved], times[improved]
+    label["arrival"][targets] = times
+    label["walk_from"][targets] = sources[owners[improved]]
+    best[targets] = times
+    return targets
+
+# Returns a new label for a round: the arrival at every stop and how it was reached
+def new_label(arrival):
+    stop_count = len(arrival)
+    return {
+        "arrival": arrival.copy(),
+        "board_cell": np.full(stop_count, -1, dtype=np.int64),
+        "alight_cell": np.full(stop_count, -1, dtype=np.int64),
+        "walk_from": np.full(stop_count, -1, dtype=np.int64),
+    }
+
+# Runs the RAPTOR rounds from an origin stop
+# ----------------------------------------------------------------------------------
+# network and timetable are returned by get_timetable
+# origin and destination are stop codes
+# departure is the departure time from the origin in seconds after the start of the service day
+# rounds is the maximum number of buses taken
+# Returns the label of every round
+# ----------------------------------------------------------------------------------
+def search(network, timetable, origin, destination, departure, rounds):
+    stop_count = len(network["transfer_offsets"]) - 1
+    best = np.full(stop_count, never, dtype=np.int64)
+    best[origin] = departure
+    label = new_label(best)
+    marked = np.append(relax_transfers(network, label, best, np.array([origin]), destination), origin)
+    labels = [label]
+
+    stop_position_offsets = network["stop_position_offsets"]
+    stop_offsets = network["stop_offsets"]
+    departure_keys = timetable["departure_keys"]
+    for round_number in range(1, rounds + 1):
+        previous = labels[-1]["arrival"]
+        label = new_label(previous)
+
+        # Every position of every pattern at the stops improved in the previous round, in pattern and position order
+        positions, owners = expand_ranges(stop_position_offsets[marked], stop_position_offsets[marked + 1] - stop_position_offsets[marked])
+        positions = network["stop_positions"][positions]
+        ready = previous[marked][owners] + (min_transfer_seconds if round_number > 1 else 0)
+        order = np.argsort(positions, kind="stable")
+        positions, ready = positions[order], ready[order]
+
+        # First trip leaving each position once the stop is reached
+        found = np.searchsorted(departure_keys, (positions << 32) | ready)
+        found_keys = departure_keys[np.minimum(found, len(departure_keys) - 1)] if len(departure_keys) else found
+        boardable = (found < len(departure_keys)) & (found_keys >> 32 == positions) & (found_keys & 0xFFFFFFFF < never)
+        positions, found = positions[boardable], found[boardable]
+        pattern = network["position_pattern"][positions]
+        trip = timetable["departure_trips"][found]
+
+        # A boarding is only useful if no earlier position of the same pattern boards the same or an earlier trip. Trips of a pattern
+        # are sorted by departure, and subtracting a large multiple of the pattern makes the running minimum restart at every pattern
+        pattern_trip = trip - (pattern << 32)
+        earlier = np.minimum.accumulate(pattern_trip)
+        useful = np.concatenate([[True], pattern_trip[1:] < earlier[:-1]]) if len(pattern_trip) else np.array([], dtype=bool)
+        positions, found, pattern, trip = positions[useful], found[useful], pattern[useful], trip[useful]
+
+        # Each boarding rides its trip up to the next useful boarding of the same pattern, which takes an earlier trip from there on
+        next_boarding = np.append(positions[1:], 0)
+        same_pattern = np.append(pattern[1:] == pattern[:-1], False)
+        last = np.where(same_pattern, next_boarding, stop_offsets[pattern + 1] - 1)
+        rides, owners = expand_ranges(positions + 1, last - positions)
+        ride_pattern = pattern[owners]
+        alight_cells = (timetable["cell_offsets"][ride_pattern] + trip[owners] * (stop_offsets[ride_pattern + 1] - stop_offsets[ride_pattern])
+                        + rides - stop_offsets[ride_pattern])
+        alight_stops = network["pattern_stops"][rides]
+        times = timetable["arrival"][alight_cells]
+
+        rows = get_min_rows(alight_stops, times)
+        improved = rows[times[rows] < np.minimum(best[alight_stops[rows]], best[destination])]
+        improved_stops = alight_stops[improved]
+        label["arrival"][improved_stops] = times[improved]
+        label["board_cell"][improved_stops] = timetable["departure_cells"][found[owners[improved]]]
+        label["alight_cell"][improved_stops] = alight_cells[improved]
+        best[improved_stops] = times[improved]
+
+        walked = relax_transfers(network, label, best, improved_stops, destination)
+        labels.append(label)
+        marked = np.union1d(improved_stops, walked)
+        if len(marked) == 0:
+            break
+    return labels
+
+# Returns the legs of the earliest arrival found by search, from the origin to the destination
+# ----------------------------------------------------------------------------------
+# labels are the labels returned by search
+# origin and destination are stop codes
+# departure is the departure time from the origin in seconds after the start of the service day
+# timetable is the timetable used by search
+# Returns a list of ("bus", board cell, alight cell) and ("walk", from stop, to stop, departure, arrival) legs, or None if the destination can't be reached.
+# A walk before the first bus ends when that bus leaves
+# ----------------------------------------------------------------------------------
+def get_legs(labels, origin, destination, departure, timetable):
+    arrivals = [label["arrival"][destination] for label in labels]
+    round_number = int(np.argmin(arrivals))
+    if arrivals[round_number] >= never:
+        return None
+    legs = []
+    stop = destination
+    walked = False
+    while stop != origin or round_number > 0:
+        label = labels[round_number]
+        if not walked and label["walk_from"][stop] >= 0:
+            from_stop = int(label["walk_from"][stop])
+            # Walks start from the stop where a bus was left, or from the origin before the first bus
+            walk_departure = timetable["arrival"][label["alight_cell"][from_stop]] if round_number > 0 else departure
+            legs.append(("walk", from_stop, stop, int(walk_departure), int(label["arrival"][stop])))
+            stop = from_stop
+            walked = True
+        elif label["board_cell"][stop] >= 0:
+            legs.append(("bus", int(label["board_cell"][stop]), int(label["alight_cell"][stop])))
+            stop = int(timetable["stop_codes"][label["board_cell"][stop]])
+            round_number -= 1
+            walked = False
+        else:
+            round_number -= 1
+            walked = False
+    legs = legs[::-1]
+    # A walk to the first bus is timed to end when that bus leaves rather than when the search started
+    if len(legs) > 1 and legs[0][0] == "walk":
+        _, from_stop, to_stop, walk_departure, walk_arrival = legs[0]
+        bus_departure = int(timetable["departure"][legs[1][1]])
+        legs[0] = ("walk", from_stop, to_stop, bus_departure - (walk_arrival - walk_departure), bus_departure)
+    return legs
+
+# Returns a time in seconds after the start of the service day as HH:MM
+def format_time(seconds):
+    return data_plane.seconds_to_gtfs_time(np.array([seconds]))[0][:5]
+
+# Returns the earliest arrival journey between two stops
+# ----------------------------------------------------------------------------------
+# origin_stop_id and destination_stop_id are stop ids e.g. 100002
+# service_ids is the list of service ids running today
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# departure_time is the departure time in seconds after the start of today's service day, or now if it isn't given
+# use_realtime is True to use the arrival times estimated from the realtime data instead of the scheduled times
+# max_transfers is the maximum number of transfers between buses
+# Returns a dictionary with the departure and arrival times, number of transfers, and every bus and walking leg of the journey,
+# or None if the destination can't be reached today. Raises a KeyError if one of the stops doesn't exist
+# ----------------------------------------------------------------------------------
+def plan_journey(origin_stop_id, destination_stop_id, service_ids, buses, current_trips, departure_time=None, use_realtime=True, max_transfers=max_transfers):
+    static, network, timetable, service_day_start = get_timetable(service_ids, buses, current_trips, use_realtime)
+    origin, destination = data_plane.encode_ids(static, "stop", [origin_stop_id, destination_stop_id]).astype(np.int64)
+    if origin < 0 or destination < 0:
+        raise KeyError(origin_stop_id if origin < 0 else destination_stop_id)
+    departure = int(time.time()) - service_day_start if departure_time is None else int(departure_time)
+
+    labels = search(network, timetable, origin, destination, departure, max_transfers + 1)
+    legs = get_legs(labels, origin, destination, departure, timetable)
+    if legs is None:
+        return None
+    return build_journey(static, timetable, legs, origin_stop_id, destination_stop_id, departure)
+
+# Returns the journey returned by plan_journey from the legs returned by get_legs
+def build_journey(static, timetable, legs, origin_stop_id, destination_stop_id, departure):
+    stops = static["tables"]["stops"]
+    trips = static["tables"]["trips"]
+    stop_times = static["tables"]["stop_times"]
+    stop_ids = np.asarray(stops["stop_id"])
+    stop_names = np.asarray(stops["stop_name"])
+
+    journey_legs = []
+    for leg in legs:
+        if leg[0] == "walk":
+            _, from_stop, to_stop, walk_departure, walk_arrival = leg
+            journey_legs.append({
+                "mode": "walk",
+                "from_stop_id": int(stop_ids[from_stop]),
+                "from_stop_name": str(stop_names[from_stop]),
+                "to_stop_id": int(stop_ids[to_stop]),
+                "to_stop_name": str(stop_names[to_stop]),
+                "departure_time": format_time(walk_departure),
+                "arrival_time": format_time(walk_arrival),
+                "minutes": int(np.ceil((walk_arrival - walk_departure) / 60)),
+            })
+            continue
+        _, board_cell, alight_cell = leg
+        board_row, alight_row = timetable["cells"][board_cell], timetable["cells"][alight_cell]
+        trip = int(stop_times["trip"][board_row])
+        from_stop, to_stop = timetable["stop_codes"][board_cell], timetable["stop_codes"][alight_cell]
+        route_id = str(trips["route_id"][trip])
+        journey_legs.append({
+            "mode": "bus",
+            "route_id": route_id,
+            "route_number": route_id.split("-")[0],
+            "trip_id": str(data_plane.decode_ids(static, "trip", [trip])[0]),
+            "trip_headsign": str(trips["trip_headsign"][trip]),
+            "from_stop_id": int(stop_ids[from_stop]),
+            "from_stop_name": str(stop_names[from_stop]),
+            "to_stop_id": int(stop_ids[to_stop]),
+            "to_stop_name": str(stop_names[to_stop]),
+            "departure_time": format_time(timetable["departure"][board_cell]),
+            "arrival_time": format_time(timetable["arrival"][alight_cell]),
+            "stops": int(alight_row - board_row),
+            "eta_source": eta_engine.eta_sources[timetable["source"][alight_cell]],
+        })
+
+    bus_legs = [leg for leg in journey_legs if leg["mode"] == "bus"]
+    arrival = timetable["arrival"][legs[-1][2]] if legs and legs[-1][0] == "bus" else (legs[-1][4] if legs else departure)
+    # The journey starts when its first leg leaves the origin, and its duration is counted from then rather than from the query time
+    if legs:
+        departure = legs[0][3] if legs[0][0] == "walk" else timetable["departure"][legs[0][1]]
+    return {
+        "origin": int(origin_stop_id),
+        "destination": int(destination_stop_id),
+        "departure_time": format_time(departure),
+        "arrival_time": format_time(arrival),
+        "duration_minutes": int(np.ceil((arrival - departure) / 60)),
+        "transfers": max(len(bus_legs) - 1, 0),
+        "legs": journey_legs,
+    }
@@ -0,0 +1,283 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+import data_plane
+import interpolation
+
+# Linear referencing of every bus along the line followed by its trip.
+# The line of a trip is the polyline of its shape in shapes.csv, with the distance along the line of every point taken from
+# shape_dist_traveled so that it is in the same units as shape_dist_traveled of the stop times. Trips whose shape has no points (static
+# versions ingested before shapes.txt was saved) follow the straight lines between their stops instead, one line per stop pattern.
+# The segments of every line are indexed in a grid of cell_meters cells keyed by line and cell, so the segments of a bus's line near
+# its position are found with a binary search instead of a scan of the whole line. Every bus of a snapshot is then snapped to the
+# closest of those segments in a single vectorized pass, only looking between its previous stop and its next stop so that a line
+# passing the same street twice (a loop or a there-and-back) doesn't snap a bus to the wrong visit. The distance of a bus along its
+# trip gives how many stops and how many kilometers away it is from every stop still ahead of it.
+
+# Size of the cells of the segment grid. A bus further than this from its line can't be placed along it
+cell_meters = 250
+# A bus can be up to this far before its previous stop or past its next stop along the line, since the next stop in the realtime data
+# is sometimes updated a little before or after the bus gets to it
+stop_slack_meters = 100
+
+# The progress of every bus of the latest realtime snapshot and the static version and snapshot it was computed for
+fleet_progress = {"key": None, "progress": None}
+fleet_progress_lock = threading.Lock()
+
+# Returns the line of every trip and the grid index of the segments of every line, built once per static version
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# The points of line i are x[line_offsets[i]:line_offsets[i + 1]], y and distance, and trip_line gives the line of every trip (or -1)
+# ----------------------------------------------------------------------------------
+def get_line_index(static):
+    def build():
+        tables = static["tables"]
+        indexes = tables["indexes"]
+        trips = tables["trips"]
+        stops = tables["stops"]
+        shape_points = tables["shape_points"]
+        shape_offsets = np.asarray(indexes["shape_offsets"])
+        shape_count = len(shape_offsets) - 1
+        trip_shape = np.asarray(trips["shape"]).astype(np.int64)
+        trip_pattern = np.asarray(trips["pattern"]).astype(np.int64)
+
+        # Lines of the shapes with points, using the distances of shapes.csv unless some are missing
+        shape_x = np.asarray(shape_points["lon"], dtype=np.float64) * interpolation.meters_per_degree_lon
+        shape_y = np.asarray(shape_points["lat"], dtype=np.float64) * interpolation.meters_per_degree_lat
+        shape_distance = np.asarray(shape_points["shape_dist_traveled"], dtype=np.float64)
+        if not np.isfinite(shape_distance).all():
+            shape_distance = get_line_distances(shape_x, shape_y, shape_offsets)
+        has_line = np.diff(shape_offsets) >= 2
+        trip_line = np.where((trip_shape >= 0) & has_line[np.maximum(trip_shape, 0)], trip_shape, -1)
+
+        # Lines between the stops of the patterns of every other trip, numbered after the shapes
+        pattern_offsets = np.asarray(indexes["pattern_offsets"])
+        line_patterns = np.unique(trip_pattern[(trip_line < 0) & (trip_pattern >= 0)])
+        pattern_lengths = pattern_offsets[line_patterns + 1] - pattern_offsets[line_patterns]
+        pattern_rows = np.repeat(pattern_offsets[line_patterns] - np.cumsum(pattern_lengths) + pattern_lengths, pattern_lengths) + np.arange(pattern_lengths.sum())
+        stop_codes = np.asarray(tables["patterns"]["stop"]).astype(np.int64)[pattern_rows]
+        known = stop_codes >= 0
+        pattern_rows = pattern_rows[known]
+        pattern_point_lines = np.repeat(np.arange(len(line_patterns)), pattern_lengths)[known]
+        pattern_line_offsets = np.searchsorted(pattern_point_lines, np.arange(len(line_patterns) + 1))
+        pattern_x = np.asarray(stops["stop_lon"], dtype=np.float64)[stop_codes[known]] * interpolation.meters_per_degree_lon
+        pattern_y = np.asarray(stops["stop_lat"], dtype=np.float64)[stop_codes[known]] * interpolation.meters_per_degree_lat
+        pattern_distance = np.asarray(tables["patterns"]["shape_dist_traveled"], dtype=np.float64)[pattern_rows]
+        if not np.isfinite(pattern_distance).all():
+            pattern_distance = get_line_distances(pattern_x, pattern_y, pattern_line_offsets)
+        pattern_line = np.full(len(pattern_offsets) - 1, -1, dtype=np.int64)
+        pattern_line[line_patterns] = shape_count + np.arange(len(line_patterns))
+        trip_line = np.where((trip_line < 0) & (trip_pattern >= 0), pattern_line[np.maximum(trip_pattern, 0)], trip_line)
+
+        x = np.concatenate([shape_x, pattern_x])
+        y = np.concatenate([shape_y, pattern_y])
+        distance = np.concatenate([shape_distance, pattern_distance])
+        line_offsets = np.concatenate([shape_offsets[:-1], shape_offsets[-1] + pattern_line_offsets]).astype(np.int64)
+
+        # Every segment goes from one point to the next point of the same line, and is added to every cell its bounding box covers
+        point_lines = np.repeat(np.arange(len(line_offsets) - 1), np.diff(line_offsets))
+        segments = np.flatnonzero(point_lines[:-1] == point_lines[1:]) if len(point_lines) else np.array([], dtype=np.int64)
+        origin = (float(x.min()), float(y.min())) if len(x) else (0.0, 0.0)
+        first_column = ((np.minimum(x[segments], x[segments + 1]) - origin[0]) // cell_meters).astype(np.int64)
+        last_column = ((np.maximum(x[segments], x[segments + 1]) - origin[0]) // cell_meters).astype(np.int64)
+        first_row = ((np.minimum(y[segments], y[segments + 1]) - origin[1]) // cell_meters).astype(np.int64)
+        last_row = ((np.maximum(y[segments], y[segments + 1]) - origin[1]) // cell_meters).astype(np.int64)
+        row_counts = last_row - first_row + 1
+        cell_counts = (last_column - first_column + 1) * row_counts
+        cell_segments = np.repeat(segments, cell_counts)
+        cell_positions = np.arange(cell_counts.sum()) - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts)
+        columns = np.repeat(first_column, cell_counts) + cell_positions // np.repeat(row_counts, cell_counts)
+        rows = np.repeat(first_row, cell_counts) + cell_positions % np.repeat(row_counts, cell_counts)
+        cell_keys = get_cell_keys(point_lines[cell_segments], columns, rows)
+        order = np.argsort(cell_keys, kind="stable")
+        return {
+            "x": x, "y": y, "distance": distance, "line_offsets": line_offsets, "trip_line": trip_line, "origin": origin,
+            "cell_keys": cell_keys[order], "cell_segments": cell_segments[order],
+        }
+
+    return data_plane.get_cached(static, "line_index", build)
+
+# Returns the key of cells of lines in the segment grid
+def get_cell_keys(lines, columns, rows):
+    return (np.asarray(lines, dtype=np.int64) << 40) | (np.asarray(columns, dtype=np.int64) << 20) | np.asarray(rows, dtype=np.int64)
+
+# Returns the cumulative distance along several lines, starting at 0 at the first point of every line
+def get_line_distances(x, y, line_offsets):
+    steps = np.concatenate([[0.0], np.hypot(np.diff(x), np.diff(y))]) if len(x) else np.zeros(0)
+    steps[line_offsets[:-1][np.diff(line_offsets) > 0]] = 0
+    distance = np.cumsum(steps)
+    lengths = np.diff(line_offsets)
+    return distance - np.repeat(distance[line_offsets[:-1][lengths > 0]], lengths[lengths > 0])
+
+# Returns the distance of several points along their lines, looking only at the part of every line between a minimum and maximum distance
+# ----------------------------------------------------------------------------------
+# index is the line index returned by get_line_index
+# lines is a numpy array with the line of every point, or -1
+# x and y are numpy arrays with the coordinates of every point in meters
+# min_distance and max_distance are numpy arrays with the part of the line of every point to look at
+# Returns the distance along the line and the distance from the line in meters of every point, or nan if it isn't near its line
+# ----------------------------------------------------------------------------------
+def locate_points(index, lines, x, y, min_distance, max_distance):
+    along = np.full(len(lines), np.nan)
+    offset = np.full(len(lines), np.nan)
+    if len(index["cell_keys"]) == 0 or len(lines) == 0:
+        return along, offset
+
+    # The segments of the line of every point in the 3 by 3 cells around it
+    column = np.floor((x - index["origin"][0]) / cell_meters).astype(np.int64)
+    row = np.floor((y - index["origin"][1]) / cell_meters).astype(np.int64)
+    neighbours = np.array([(dc, dr) for dc in [-1, 0, 1] for dr in [-1, 0, 1]])
+    owners = np.repeat(np.arange(len(lines)), len(neighbours))
+    columns = np.repeat(column, len(neighbours)) + np.tile(neighbours[:, 0], len(lines))
+    rows = np.repeat(row, len(neighbours)) + np.tile(neighbours[:, 1], len(lines))
+    valid = (np.repeat(lines, len(neighbours)) >= 0) & (columns >= 0) & (rows >= 0) & (columns < 1 << 20) & (rows < 1 << 20)
+    owners, keys = owners[valid], get_cell_keys(lines[owners[valid]], columns[valid], rows[valid])
+    first = np.searchsorted(index["cell_keys"], keys, side="left")
+    counts = np.searchsorted(index["cell_keys"], keys, side="right") - first
+    owners = np.repeat(owners, counts)
+    segments = index["cell_segments"][np.repeat(first - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+    if len(segments) == 0:
+        return along, offset
+
+    # Closest point of every candidate segment, with the segments outside the part of the line looked at only used if nothing else is near
+    start_x, start_y = index["x"][segments], index["y"][segments]
+    segment_x, segment_y = index["x"][segments + 1] - start_x, index["y"][segments + 1] - start_y
+    segment_length_squared = np.maximum(segment_x ** 2 + segment_y ** 2, 1e-9)
+    fraction = np.clip(((x[owners] - start_x) * segment_x + (y[owners] - start_y) * segment_y) / segment_length_squared, 0, 1)
+    gap = np.hypot(start_x + fraction * segment_x - x[owners], start_y + fraction * segment_y - y[owners])
+    segment_along = index["distance"][segments] + fraction * (index["distance"][segments + 1] - index["distance"][segments])
+    outside = (segment_along < min_distance[owners]) | (segment_along > max_distance[owners])
+    order = np.lexsort((gap, outside, owners))
+    best = order[np.concatenate([[True], owners[order][1:] != owners[order][:-1]])]
+    near = gap[best] <= cell_meters
+    along[owners[best][near]] = segment_along[best][near]
+    offset[owners[best][near]] = gap[best][near]
+    return along, offset
+
+# Returns where every bus of a realtime snapshot is along its trip, computed once per snapshot
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# Returns arrays with one value per trip: the distance along the trip of the bus running it and the position in the trip of its
+# next stop (nan and -1 for trips no bus is running or buses that couldn't be placed), along with the same values for every bus
+# ----------------------------------------------------------------------------------
+def get_fleet_progress(buses, current_trips):
+    static = data_plane.get_static()
+    key = (static["version"], data_plane.get_realtime_signature(), len(buses))
+    with fleet_progress_lock:
+        if fleet_progress["key"] != key:
+            fleet_progress["progress"] = build_fleet_progress(static, buses, current_trips)
+            fleet_progress["key"] = key
+        return fleet_progress["progress"]
+
+# Returns where every bus of a realtime snapshot is along its trip (see get_fleet_progress)
+def build_fleet_progress(static, buses, current_trips):
+    next_stop_sequences = {(trip["trip_id"], str(trip["stop_id"])): trip["stop_sequence"] for trip in current_trips}
+    bus_trips = data_plane.get_realtime_codes(static, "bus_updates", buses)["trip"].astype(np.int64)
+    next_position, bus_distance, bus_offset = locate_buses(static, buses, bus_trips, next_stop_sequences)
+    trip_count = len(static["tables"]["trips"]["pattern"])
+    trip_distance = np.full(trip_count, np.nan)
+    trip_next_position = np.full(trip_count, -1, dtype=np.int64)
+    located = ~np.isnan(bus_distance)
+    trip_distance[bus_trips[located]] = bus_distance[located]
+    trip_next_position[bus_trips[located]] = next_position[located]
+    return {
+        "trip_distance": trip_distance, "trip_next_position": trip_next_position,
+        "bus_trip": bus_trips, "bus_distance": bus_distance, "bus_offset": bus_offset, "bus_next_position": next_position,
+    }
+
+# Returns where some buses are along their trips
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# buses is a list of dictionaries of buses from bus_updates.json
+# bus_trips is a numpy array with the trip code of every bus, or -1
+# next_stop_sequences is a dictionary giving the stop_sequence of (trip_id, stop_id) for the next stop of every bus
+# Returns the position of the next stop of every bus in its trip (or -1), its distance along the line of its trip and its distance
+# from that line in meters (or nan for buses that couldn't be placed)
+# ----------------------------------------------------------------------------------
+def locate_buses(static, buses, bus_trips, next_stop_sequences):
+    tables = static["tables"]
+    index = get_line_index(static)
+    stop_sequence = np.array([next_stop_sequences.get((bus["trip_id"], str(bus["stop_id"])), -1) for bus in buses], dtype=np.int64)
+    placed = (bus_trips >= 0) & (stop_sequence >= 0)
+    placed[placed] = np.asarray(tables["trips"]["pattern"])[bus_trips[placed]] >= 0
+
+    # Position of the next stop of every bus in its trip, found in the stop_sequence values of the pattern of its trip
+    pattern_offsets = np.asarray(tables["indexes"]["pattern_offsets"])
+    pattern = np.asarray(tables["trips"]["pattern"]).astype(np.int64)[bus_trips[placed]]
+    pattern_keys = get_pattern_keys(static)
+    rows = np.searchsorted(pattern_keys, pattern * 65536 + stop_sequence[placed])
+    rows = np.minimum(rows, pattern_offsets[pattern + 1] - 1)
+    next_position = np.full(len(buses), -1, dtype=np.int64)
+    next_position[placed] = rows - pattern_offsets[pattern]
+
+    # Each bus is looked for between its previous stop and its next stop
+    stop_distance = np.asarray(tables["patterns"]["shape_dist_traveled"], dtype=np.float64)
+    max_distance = np.where(np.isnan(stop_distance[rows]), np.inf, stop_distance[rows] + stop_slack_meters)
+    previous_distance = np.where(rows > pattern_offsets[pattern], stop_distance[np.maximum(rows - 1, 0)], -np.inf)
+    min_distance = np.where(np.isnan(previous_distance), -np.inf, previous_distance - stop_slack_meters)
+    x = np.array([bus["lon"] for bus in buses], dtype=np.float64)[placed] * interpolation.meters_per_degree_lon
+    y = np.array([bus["lat"] for bus in buses], dtype=np.float64)[placed] * interpolation.meters_per_degree_lat
+    along, offset = locate_points(index, index["trip_line"][bus_trips[placed]], x, y, min_distance, max_distance)
+
+    bus_distance = np.full(len(buses), np.nan)
+    bus_offset = np.full(len(buses), np.nan)
+    bus_distance[placed] = along
+    bus_offset[placed] = offset
+    return next_position, bus_distance, bus_offset
+
+# Returns the keys pattern * 65536 + stop_sequence of every row of patterns, which are sorted since the rows of every pattern are
+def get_pattern_keys(static):
+    def build():
+        pattern_offsets = np.asarray(static["tables"]["indexes"]["pattern_offsets"])
+        patterns = np.repeat(np.arange(len(pattern_offsets) - 1), np.diff(pattern_offsets))
+        return patterns * 65536 + np.asarray(static["tables"]["patterns"]["stop_sequence"]).astype(np.int64)
+
+    return data_plane.get_cached(static, "pattern_keys", build)
+
+# Returns how many stops and how many meters away the bus running each trip is from some of the stop times of its trip
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# progress is the fleet progress returned by get_fleet_progress
+# trips is a numpy array with the row in trips of every stop time
+# positions is a numpy array with the position of every stop time in its trip
+# Returns the number of stops (1 for the next stop of the bus) and the distance in meters, or -1 and nan if no bus is placed along
+# the trip or the bus has already passed the stop
+# ----------------------------------------------------------------------------------
+def get_stops_away(static, progress, trips, positions):
+    trips = np.asarray(trips, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    next_position = progress["trip_next_position"][trips]
+    stops_away = np.where((next_position >= 0) & (positions >= next_position), positions - next_position + 1, -1)
+    stop_distance = data_plane.get_stop_time_values(static["tables"], trips, positions, "shape_dist_traveled").astype(np.float64)
+    meters_away = np.where(stops_away > 0, np.maximum(stop_distance - progress["trip_distance"][trips], 0), np.nan)
+    return stops_away, meters_away
+
+# Returns the text saying how far a bus is from a stop e.g. 3 stops / 1.2 km away
+def get_stops_away_text(stops_away, meters_away):
+    if stops_away <= 0 or pd.isna(meters_away):
+        return ""
+    return f"{stops_away} stop{'' if stops_away == 1 else 's'} / {meters_away / 1000:.1f} km away"
+
+# Returns the texts saying how far the bus running a trip is from some of the stops of that trip e.g. 3 stops / 1.2 km away
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# trip_id is the id of the trip
+# stop_sequences is the list of the stop_sequence values of the stops
+# Returns one text per stop, which is empty for the stops the bus is not known to be heading to
+# ----------------------------------------------------------------------------------
+def get_trip_stops_away_texts(buses, current_trips, trip_id, stop_sequences):
+    static = data_plane.get_static()
+    trip = data_plane.get_trip_lookup(static).get_indexer([trip_id])[0]
+    pattern = int(static["tables"]["trips"]["pattern"][trip]) if trip >= 0 else -1
+    if pattern < 0 or not stop_sequences:
+        return [""] * len(stop_sequences)
+    progress = get_fleet_progress(buses, current_trips)
+    pattern_offsets = np.asarray(static["tables"]["indexes"]["pattern_offsets"])
+    positions = np.searchsorted(get_pattern_keys(static), pattern * 65536 + np.asarray(stop_sequences, dtype=np.int64)) - pattern_offsets[pattern]
+    positions = np.minimum(positions, pattern_offsets[pattern + 1] - pattern_offsets[pattern] - 1)
+    stops_away, meters_away = get_stops_away(static, progress, np.full(len(positions), trip), positions)
+    return [get_stops_away_text(stops, meters) for stops, meters in zip(stops_away, meters_away)]
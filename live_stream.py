@@ -0,0 +1,222 @@
+import json
+import os
+import threading
+import time
+
+import data_plane
+import realtime_cache
+
+# Server-sent event (SSE) stream of live vehicle positions and ETAs.
+# A single publisher thread per worker watches the realtime snapshot (bus_updates.json and trip_updates.json) and only when
+# it changes builds one shared payload for every running bus along with route and stop indexes. Every connected client waits
+# on a shared condition between updates, so an open client uses no CPU until a new snapshot is published and then only has
+# to pick its vehicles out of the already built payload. While at least one client is connected, the publisher also has realtime_cache refresh
+# the realtime data from BC Transit at a fixed cadence so that all clients share a single upstream fetch. When the data plane is
+# enabled, the data plane refresher already keeps the realtime data up-to-date so the publisher only follows its versions.
+# The website runs on gunicorn's threaded workers, where an open stream holds one worker thread for as long as the client stays
+# connected even though it sleeps between updates. Every worker therefore accepts at most max_clients streams at once and answers the
+# next ones with a 503, and gunicorn.conf.py gives every worker max_clients threads on top of the ones serving the pages and the API,
+# so streams can never take the threads the Dash callbacks need. Raising STREAM_MAX_CLIENTS costs one thread (and its stack) per
+# worker per client.
+
+bus_updates_file = os.path.join("data", "bus_updates.json")
+trip_updates_file = os.path.join("data", "trip_updates.json")
+
+# How often the snapshot files are checked for changes, how often the realtime data is refreshed while clients are connected,
+# and how often a comment is sent to idle clients so proxies do not close the connection
+poll_seconds = 1
+refresh_seconds = int(os.environ.get("STREAM_REFRESH_SECONDS", "30"))
+keepalive_seconds = 15
+
+# Most streams open at once in every worker, and how long a client turned away should wait before reconnecting
+max_clients = int(os.environ.get("STREAM_MAX_CLIENTS", "4"))
+retry_after_seconds = 30
+
+# The latest published snapshot. version is increased every time a new snapshot is published
+snapshot = {
+    "version": 0,
+    "signature": None,
+    "vehicles": {},
+    "by_bus": {},
+    "by_route": {},
+    "by_stop": {},
+}
+subscribers = {"count": 0}
+publisher = {"thread": None}
+snapshot_condition = threading.Condition()
+publish_lock = threading.Lock()
+
+# Returns the content of a realtime json file or an empty list if it is missing or currently being rewritten
+def read_snapshot_file(data_file):
+    try:
+        with open(data_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+# Builds the shared payload for every running bus along with the indexes used to filter it for each client
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# ----------------------------------------------------------------------------------
+def build_vehicle_snapshot(buses, current_trips):
+    # Group the upcoming stop ETAs of every trip so each bus only has to look up its own trip
+    trip_stops = {}
+    for trip in current_trips:
+        trip_stops.setdefault(trip["trip_id"], []).append(trip)
+
+    vehicles = {}
+    by_bus = {}
+    by_route = {}
+    by_stop = {}
+    for bus in buses:
+        vehicle_id = bus["id"]
+        trip_id = bus["trip_id"]
+        stops = trip_stops.get(trip_id, [])
+        current_stop = next((stop for stop in stops if stop["stop_id"] == bus["stop_id"]), None)
+
+        # Only keep the ETAs of the stops that haven't yet been served by that bus
+        upcoming = {}
+        if current_stop:
+            for stop in stops:
+                if stop["stop_sequence"] >= current_stop["stop_sequence"]:
+                    upcoming[stop["stop_id"]] = {"eta": stop["time"] or None, "delay": stop["delay"]}
+
+        route_number = bus["route"].split("-")[0]
+        vehicles[vehicle_id] = {
+            "bus": vehicle_id[-4:],
+            "lat": bus["lat"],
+            "lon": bus["lon"],
+            "speed": bus["speed"],
+            "bearing": bus["bearing"],
+            "route": route_number,
+            "trip_id": trip_id,
+            "stop_id": bus["stop_id"],
+            "eta": (current_stop["time"] or None) if current_stop else None,
+            "delay": current_stop["delay"] if current_stop else None,
+            "capacity": bus["capacity"],
+            "timestamp": bus["timestamp"],
+            "reported": bus.get("reported") or None,
+            "upcoming": upcoming,
+        }
+        by_bus.setdefault(vehicle_id[-4:], set()).add(vehicle_id)
+        if route_number:
+            by_route.setdefault(route_number, set()).add(vehicle_id)
+        for stop_id in upcoming:
+            by_stop.setdefault(stop_id, set()).add(vehicle_id)
+
+    return vehicles, by_bus, by_route, by_stop
+
+# Publishes a new snapshot if the realtime files have changed and wakes up every waiting client
+def publish_if_changed():
+    with publish_lock:
+        signature = data_plane.get_realtime_signature()
+        if signature == snapshot["signature"]:
+            return False
+        if data_plane.is_enabled():
+            buses = data_plane.load_realtime("bus_updates") or []
+            current_trips = data_plane.load_realtime("trip_updates") or []
+        else:
+            buses = read_snapshot_file(bus_updates_file)
+            current_trips = read_snapshot_file(trip_updates_file)
+        vehicles, by_bus, by_route, by_stop = build_vehicle_snapshot(buses, current_trips)
+        with snapshot_condition:
+            snapshot["signature"] = signature
+            snapshot["vehicles"] = vehicles
+            snapshot["by_bus"] = by_bus
+            snapshot["by_route"] = by_route
+            snapshot["by_stop"] = by_stop
+            snapshot["version"] += 1
+            snapshot_condition.notify_all()
+        return True
+
+# Loop run by the single publisher thread. Upstream data is only refreshed while there are clients connected
+def run_publisher():
+    while True:
+        if subscribers["count"] > 0:
+            realtime_cache.revalidate(max_age_seconds=refresh_seconds)
+        try:
+            publish_if_changed()
+        except Exception as e:
+            print(f"Error publishing live stream snapshot: {e}", flush=True)
+        time.sleep(poll_seconds)
+
+# Starts the publisher thread if it is not already running in this worker
+def start_publisher():
+    with snapshot_condition:
+        if publisher["thread"] is None:
+            publisher["thread"] = threading.Thread(target=run_publisher, name="live-stream-publisher", daemon=True)
+            publisher["thread"].start()
+
+# Returns the ids of the vehicles in the current snapshot that match the filters of a client
+# ----------------------------------------------------------------------------------
+# bus_numbers is a set of bus numbers e.g. {"9541"}
+# route_numbers is a set of route numbers e.g. {"6", "6A"}
+# stop_ids is a set of stop ids e.g. {"100032"}
+# If no filter is given, every vehicle matches. Otherwise a vehicle only needs to match one of the filters
+# ----------------------------------------------------------------------------------
+def get_matching_vehicles(bus_numbers, route_numbers, stop_ids):
+    if not bus_numbers and not route_numbers and not stop_ids:
+        return set(snapshot["vehicles"])
+    matching = set()
+    for bus_number in bus_numbers:
+        matching |= snapshot["by_bus"].get(bus_number, set())
+    for route_number in route_numbers:
+        matching |= snapshot["by_route"].get(route_number, set())
+    for stop_id in stop_ids:
+        matching |= snapshot["by_stop"].get(stop_id, set())
+    return matching
+
+# Returns the text of a single SSE event containing the matching vehicles of the current snapshot
+# ----------------------------------------------------------------------------------
+# version is the version of the snapshot being sent
+# vehicle_ids is the set of vehicle ids matching the filters of the client
+# stop_ids is the set of stop ids the client filtered by. If given, only the ETAs of those stops are sent for each vehicle
+# ----------------------------------------------------------------------------------
+def format_vehicle_event(version, vehicle_ids, stop_ids):
+    vehicles = []
+    for vehicle_id in sorted(vehicle_ids):
+        vehicle = snapshot["vehicles"][vehicle_id]
+        upcoming = vehicle["upcoming"]
+        if stop_ids:
+            upcoming = {stop_id: upcoming[stop_id] for stop_id in stop_ids if stop_id in upcoming}
+        vehicles.append({**vehicle, "upcoming": upcoming})
+    return f"id: {version}\nevent: vehicles\ndata: {json.dumps(vehicles, separators=(',', ':'))}\n\n"
+
+# Takes one of the max_clients streams of this worker for a new client
+# Returns False if every stream is already taken, in which case the client must be turned away
+def open_stream():
+    with snapshot_condition:
+        if subscribers["count"] >= max_clients:
+            return False
+        subscribers["count"] += 1
+    start_publisher()
+    return True
+
+# Gives back the stream taken by open_stream once its response is closed
+def close_stream():
+    with snapshot_condition:
+        subscribers["count"] -= 1
+
+# Generator used as the body of the SSE response for a single client which was given a stream by open_stream
+# ----------------------------------------------------------------------------------
+# bus_numbers, route_numbers, and stop_ids are the filters requested by the client (see get_matching_vehicles)
+# ----------------------------------------------------------------------------------
+def stream_vehicle_events(bus_numbers, route_numbers, stop_ids):
+    last_version = 0
+    # Publish straight away so the first client doesn't have to wait for the next poll of the publisher
+    if snapshot["version"] == 0:
+        publish_if_changed()
+    while True:
+        with snapshot_condition:
+            if snapshot["version"] == last_version:
+                snapshot_condition.wait(timeout=keepalive_seconds)
+            version = snapshot["version"]
+            if version != last_version:
+                vehicle_ids = get_matching_vehicles(bus_numbers, route_numbers, stop_ids)
+                event = format_vehicle_event(version, vehicle_ids, stop_ids)
+        if version == last_version:
+            yield ": keepalive\n\n"
+            continue
+        last_version = version
+        yield event
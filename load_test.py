@@ -0,0 +1,435 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import requests
+from google.transit import gtfs_realtime_pb2
+
+# Script used to load test the website the same way the Dockerfile serves it.
+# It starts gunicorn with gunicorn.conf.py inside a copy of /data so that the realtime files of the repo are never overwritten,
+# with BC Transit replaced by a local stub serving vehicleupdates.pb and tripupdates.pb built from data/bus_updates.json and
+# data/trip_updates.json (shifted to the current time, optionally with added latency and errors). Virtual users then drive the
+# real Dash callback endpoint (/_dash-update-component) like a browser would: bus tracker users search for a random bus, refresh the
+# page every --refresh-seconds and check for the motion model of the next snapshot every motion_seconds (the marker itself is moved
+# in the browser by a clientside callback which never reaches the server), and next buses users search for a random stop, sometimes
+# filtered by a route, and refresh it. Throughput, latency percentiles and error rates are reported for every callback along with
+# the CPU and RSS of every gunicorn process, which gives the number of concurrent users an instance can hold when sizing Cloud Run.
+# If --url is given, an already running deployment is tested instead and no stub or gunicorn is started.
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The callbacks driven by virtual users, each identified by one of its inputs
+callback_inputs = {
+    "bus_tracker": "interval-component",
+    "motion_model": "motion-interval",
+    "next_buses": "stop-interval-component",
+}
+
+# Seconds between two checks for a new motion model by the bus tracker page, the interval of motion-interval
+motion_seconds = 30
+
+# The upstream stub configuration and how many requests it answered
+stub = {"latency": 0.0, "error_rate": 0.0, "requests": 0}
+
+# Returns the realtime json files of /data as the stub serves them, moved forward in time as if they had just been downloaded
+def load_stub_snapshot():
+    with open(os.path.join(repo_dir, "data", "bus_updates.json"), "r") as f:
+        buses = json.load(f)
+    with open(os.path.join(repo_dir, "data", "trip_updates.json"), "r") as f:
+        current_trips = json.load(f)
+    snapshot_time = max((datetime.fromisoformat(bus["timestamp"]).replace(tzinfo=timezone.utc).timestamp() for bus in buses), default=time.time())
+    return buses, current_trips, int(time.time() - snapshot_time)
+
+# Returns a vehicleupdates.pb feed with every bus of buses
+def build_vehicle_feed(buses):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = int(time.time())
+    for i, bus in enumerate(buses):
+        entity = feed.entity.add()
+        entity.id = str(i)
+        entity.vehicle.vehicle.id = bus["id"]
+        entity.vehicle.position.latitude = bus["lat"]
+        entity.vehicle.position.longitude = bus["lon"]
+        entity.vehicle.position.speed = bus["speed"] or 0
+        entity.vehicle.position.bearing = bus["bearing"] or 0
+        entity.vehicle.trip.route_id = bus["route"]
+        entity.vehicle.trip.trip_id = bus["trip_id"]
+        entity.vehicle.occupancy_status = bus["capacity"]
+        entity.vehicle.stop_id = str(bus["stop_id"])
+        entity.vehicle.timestamp = int(time.time())
+    return feed.SerializeToString()
+
+# Returns a tripupdates.pb feed with every stop of current_trips, with the predicted times moved forward by shift seconds
+def build_trip_feed(current_trips, shift):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.header.gtfs_realtime_version = "2.0"
+    feed.header.timestamp = int(time.time())
+    trip_updates = {}
+    for trip in current_trips:
+        if trip["trip_id"] not in trip_updates:
+            entity = feed.entity.add()
+            entity.id = str(len(trip_updates))
+            entity.trip_update.trip.trip_id = trip["trip_id"]
+            entity.trip_update.trip.route_id = trip["route_id"]
+            entity.trip_update.trip.start_time = trip["start_time"]
+            trip_updates[trip["trip_id"]] = entity.trip_update
+        stop_time_update = trip_updates[trip["trip_id"]].stop_time_update.add()
+        stop_time_update.stop_id = str(trip["stop_id"])
+        stop_time_update.stop_sequence = trip["stop_sequence"]
+        stop_time_update.arrival.delay = trip["delay"]
+        stop_time_update.arrival.time = trip["time"] + shift if trip["time"] else 0
+        stop_time_update.departure.delay = trip["delay"]
+    return feed.SerializeToString()
+
+# Serves vehicleupdates.pb and tripupdates.pb in place of BC Transit
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        stub["requests"] += 1
+        time.sleep(stub["latency"])
+        if random.random() < stub["error_rate"]:
+            self.send_error(503)
+            return
+        buses, current_trips, shift = load_stub_snapshot()
+        if self.path.startswith("/vehicleupdates.pb"):
+            body = build_vehicle_feed(buses)
+        elif self.path.startswith("/tripupdates.pb"):
+            body = build_trip_feed(current_trips, shift)
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-protobuf")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Starts the upstream stub in a background thread and returns its base url
+def start_stub(port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    threading.Thread(target=server.serve_forever, name="upstream-stub", daemon=True).start()
+    return f"http://127.0.0.1:{port}"
+
+# Returns a free local port
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Starts gunicorn with gunicorn.conf.py inside a copy of /data and waits until it answers requests
+# ----------------------------------------------------------------------------------
+# port is the local port gunicorn binds to
+# stub_url is the base url of the upstream stub
+# workers and threads are the number of gunicorn workers and threads per worker. threads is None to use the number set by gunicorn.conf.py
+# Returns the gunicorn process and the temporary directory it runs in
+# ----------------------------------------------------------------------------------
+def start_app(port, stub_url, workers, threads):
+    run_dir = tempfile.mkdtemp(prefix="load-test-")
+    shutil.copytree(os.path.join(repo_dir, "data"), os.path.join(run_dir, "data"), ignore=shutil.ignore_patterns("plane", "on_time"))
+    env = dict(os.environ, REALTIME_BASE_URL=stub_url, PYTHONPATH=repo_dir, PORT=str(port))
+    # gunicorn.conf.py sizes the threads for the live streams, so they are only overridden when asked for
+    thread_args = ["--threads", str(threads)] if threads is not None else []
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "--config", os.path.join(repo_dir, "gunicorn.conf.py"), "--workers", str(workers),
+         *thread_args, "--bind", f"127.0.0.1:{port}", "app:server"],
+        cwd=run_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 180
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            if requests.get(base_url, timeout=5).status_code == 200:
+                return process, run_dir
+        except requests.RequestException:
+            pass
+        time.sleep(1)
+    process.terminate()
+    raise RuntimeError("gunicorn did not start within 180 s")
+
+# Returns the ids of every running process whose parent is pid
+def get_child_pids(pid):
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        if int(stat[stat.rindex(")") + 2:].split()[1]) == pid:
+            children.append(int(entry))
+    return children
+
+# Returns the CPU time in seconds and RSS in bytes used so far by a process, or None if it has exited
+def read_process_stats(pid):
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        rss_bytes = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+        return cpu_seconds, rss_bytes
+    except (OSError, IndexError, ValueError):
+        return None
+
+# Samples the CPU and RSS of the gunicorn master and every process it started once per second until stop is set
+# ----------------------------------------------------------------------------------
+# master_pid is the process id of the gunicorn master
+# samples is a dictionary filled with a list of (time, cpu seconds, rss bytes) for every process id
+# stop is a threading.Event set when the load test is over
+# ----------------------------------------------------------------------------------
+def run_sampler(master_pid, samples, stop):
+    while not stop.is_set():
+        now = time.monotonic()
+        for pid in [master_pid] + get_child_pids(master_pid):
+            stats = read_process_stats(pid)
+            if stats is not None:
+                samples.setdefault(pid, []).append((now, *stats))
+        stop.wait(1)
+
+# Returns the callbacks driven by virtual users from the dependencies of the Dash app, keyed by the names in callback_inputs
+def get_callbacks(base_url):
+    dependencies = requests.get(f"{base_url}/_dash-dependencies", timeout=30).json()
+    callbacks = {}
+    for name, input_id in callback_inputs.items():
+        callbacks[name] = next(dependency for dependency in dependencies if any(i["id"] == input_id for i in dependency["inputs"]))
+    return callbacks
+
+# Returns the outputs of a callback as sent by the browser from its output string e.g. ..live-map.figure...desc-text.children..
+def parse_outputs(output):
+    if output.startswith("..") and output.endswith(".."):
+        outputs = [dict(zip(["id", "property"], part.split(".", 1))) for part in output[2:-2].split("...")]
+        return outputs
+    return dict(zip(["id", "property"], output.split(".", 1)))
+
+# Returns the body of a request to /_dash-update-component for a callback
+# ----------------------------------------------------------------------------------
+# callback is the dependency of the callback returned by get_callbacks
+# values is a dictionary of the value of every input and state e.g. {"url.href": "http://localhost/bus_tracker"}
+# changed is the input that triggered the callback e.g. interval-component.n_intervals
+# ----------------------------------------------------------------------------------
+def build_callback_request(callback, values, changed):
+    return {
+        "output": callback["output"],
+        "outputs": parse_outputs(callback["output"]),
+        "inputs": [{**i, "value": values.get(f"{i['id']}.{i['property']}")} for i in callback["inputs"]],
+        "state": [{**s, "value": values.get(f"{s['id']}.{s['property']}")} for s in callback["state"]],
+        "changedPropIds": [changed],
+    }
+
+# Calls a callback and records its latency and whether it failed
+# Returns the outputs of the callback as sent to the browser e.g. {"tracked-bus": {"data": ...}}, which are empty if nothing was updated
+def call_callback(session, base_url, name, callback, values, changed, results, timeout):
+    start = time.perf_counter()
+    outputs = {}
+    try:
+        response = session.post(f"{base_url}/_dash-update-component", json=build_callback_request(callback, values, changed), timeout=timeout)
+        ok = response.status_code in (200, 204)
+        if response.status_code == 200:
+            outputs = response.json().get("response", {})
+    except (requests.RequestException, ValueError):
+        ok = False
+    results.append((name, time.perf_counter() - start, ok))
+    return outputs
+
+# Loop run by every virtual user until the end of the load test
+# ----------------------------------------------------------------------------------
+# base_url is the url of the website
+# callbacks are the callbacks returned by get_callbacks
+# targets is a dictionary with the bus numbers, stop ids and route numbers users pick from
+# args are the command line arguments
+# results is the list every callback call is recorded in
+# deadline is the time.monotonic() at which the load test ends
+# ----------------------------------------------------------------------------------
+def run_user(base_url, callbacks, targets, args, results, deadline):
+    session = requests.Session()
+    rng = random.Random()
+    page = "bus_tracker" if rng.random() < args.bus_tracker_share else "next_buses"
+    clicks = 0
+    refreshes = 0
+    checks = 0
+    if page == "bus_tracker":
+        values = {"url.href": f"{base_url}/bus_tracker", "bus-search-user-input.value": rng.choice(targets["buses"]),
+                  "bus-search-user-input.n_submit": 0, "manual-update.n_clicks": 0, "toggle-future-stops.n_clicks": 0, "clear-bus-input.n_clicks": 0}
+    else:
+        values = {"url.href": f"{base_url}/next_buses", "stop-dropdown.value": rng.choice(targets["stops"]), "route-dropdown.value": None,
+                  "variant-checklist.value": [], "toggle-future-buses.n_clicks": 0}
+    outputs = call_callback(session, base_url, page, callbacks[page], {**values, "search-for-bus.n_clicks": 0, "stop-search.n_clicks": 0}, "url.href", results, args.timeout)
+    # The motion model of the tracked bus is kept like the tracked-bus store of the browser
+    tracked_bus = outputs.get("tracked-bus", {}).get("data")
+
+    next_refresh = time.monotonic() + rng.uniform(0, args.refresh_seconds)
+    next_check = time.monotonic() + rng.uniform(0, motion_seconds)
+    while True:
+        now = time.monotonic()
+        next_event = min(next_refresh, next_check) if page == "bus_tracker" else next_refresh
+        if next_event >= deadline:
+            return
+        time.sleep(max(next_event - now, 0))
+
+        if page == "bus_tracker" and next_check <= next_refresh:
+            checks += 1
+            outputs = call_callback(session, base_url, "motion_model", callbacks["motion_model"],
+                                    {"motion-interval.n_intervals": checks, "tracked-bus.data": tracked_bus},
+                                    "motion-interval.n_intervals", results, args.timeout)
+            tracked_bus = outputs.get("tracked-bus", {}).get("data", tracked_bus)
+            next_check += motion_seconds
+            continue
+
+        # Every refresh is either the page's interval or a new search by the user
+        changed = "interval-component.n_intervals" if page == "bus_tracker" else "stop-interval-component.n_intervals"
+        if rng.random() < args.search_share:
+            clicks += 1
+            if page == "bus_tracker":
+                values["bus-search-user-input.value"] = rng.choice(targets["buses"])
+                changed = "search-for-bus.n_clicks"
+            else:
+                values["stop-dropdown.value"] = rng.choice(targets["stops"])
+                values["route-dropdown.value"] = rng.choice(targets["routes"]) if rng.random() < 0.3 else None
+                values["variant-checklist.value"] = ["include_variants"] if rng.random() < 0.5 else []
+                changed = "stop-search.n_clicks"
+        refreshes += 1
+        outputs = call_callback(session, base_url, page, callbacks[page],
+                                {**values, "interval-component.n_intervals": refreshes, "stop-interval-component.n_intervals": refreshes,
+                                 "search-for-bus.n_clicks": clicks, "stop-search.n_clicks": clicks}, changed, results, args.timeout)
+        tracked_bus = outputs.get("tracked-bus", {}).get("data", tracked_bus)
+        next_refresh += args.refresh_seconds
+
+# Returns the bus numbers, stop ids and route numbers virtual users pick from
+def load_targets():
+    with open(os.path.join(repo_dir, "data", "bus_updates.json"), "r") as f:
+        buses = [bus["id"][-4:] for bus in json.load(f) if bus["trip_id"]]
+    stops = pd.read_csv(os.path.join(repo_dir, "data", "stops.csv"), usecols=["stop_id"])["stop_id"].astype(int).tolist()
+    routes = pd.read_csv(os.path.join(repo_dir, "data", "routes.csv"), usecols=["route_short_name"])["route_short_name"].astype(str).tolist()
+    return {"buses": buses or ["9541"], "stops": stops, "routes": routes}
+
+# Returns the throughput, latency percentiles and error rate of every callback and of every request together
+def summarize_results(results, duration):
+    summary = {}
+    names = sorted({name for name, _, _ in results})
+    for name in names + ["all"]:
+        latencies = np.array([latency for n, latency, _ in results if name in (n, "all")]) * 1000
+        errors = sum(1 for n, _, ok in results if name in (n, "all") and not ok)
+        if len(latencies) == 0:
+            continue
+        summary[name] = {
+            "requests": len(latencies),
+            "throughput": len(latencies) / duration,
+            "error_rate": errors / len(latencies),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p90_ms": float(np.percentile(latencies, 90)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+            "max_ms": float(latencies.max()),
+        }
+    return summary
+
+# Returns the average CPU use in percent of one core and the peak RSS of every sampled process
+def summarize_samples(samples):
+    processes = {}
+    for pid, process_samples in samples.items():
+        if len(process_samples) < 2:
+            continue
+        (start, start_cpu, _), (end, end_cpu, _) = process_samples[0], process_samples[-1]
+        processes[pid] = {
+            "cpu_percent": (end_cpu - start_cpu) / (end - start) * 100,
+            "peak_rss_mb": max(rss for _, _, rss in process_samples) / 2 ** 20,
+        }
+    return processes
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Dash callbacks of the website served by gunicorn")
+    parser.add_argument("--url", help="test an already running deployment instead of starting gunicorn and the upstream stub")
+    parser.add_argument("--users", type=int, default=20, help="number of concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=60, help="length of the load test in seconds, after the ramp up")
+    parser.add_argument("--ramp-up", type=float, default=10, help="seconds over which the virtual users are started")
+    parser.add_argument("--bus-tracker-share", type=float, default=0.5, help="share of users on the bus tracker page, the others are on the next buses page")
+    parser.add_argument("--refresh-seconds", type=float, default=30, help="seconds between two page refreshes or searches of a user")
+    parser.add_argument("--search-share", type=float, default=0.3, help="share of refreshes which are a new search")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds after which a callback counts as an error")
+    parser.add_argument("--workers", type=int, default=2, help="number of gunicorn workers")
+    parser.add_argument("--threads", type=int, help="number of threads per gunicorn worker, the number set by gunicorn.conf.py by default")
+    parser.add_argument("--stub-latency", type=float, default=0, help="seconds the upstream stub waits before answering")
+    parser.add_argument("--stub-error-rate", type=float, default=0, help="share of upstream stub requests answered with an error")
+    parser.add_argument("--output", help="also save the results as json to this file")
+    args = parser.parse_args()
+
+    process = None
+    run_dir = None
+    samples = {}
+    stop_sampler = threading.Event()
+    base_url = args.url.rstrip("/") if args.url else None
+    try:
+        if base_url is None:
+            stub["latency"] = args.stub_latency
+            stub["error_rate"] = args.stub_error_rate
+            stub_url = start_stub(get_free_port())
+            print(f"Upstream stub listening on {stub_url}", flush=True)
+            port = get_free_port()
+            process, run_dir = start_app(port, stub_url, args.workers, args.threads)
+            base_url = f"http://127.0.0.1:{port}"
+            threads = f"{args.threads} threads" if args.threads is not None else "the threads of gunicorn.conf.py"
+            print(f"gunicorn started with {args.workers} workers and {threads} on {base_url}", flush=True)
+            threading.Thread(target=run_sampler, args=(process.pid, samples, stop_sampler), name="process-sampler", daemon=True).start()
+
+        callbacks = get_callbacks(base_url)
+        targets = load_targets()
+        results = []
+        start = time.monotonic()
+        deadline = start + args.ramp_up + args.duration
+        users = []
+        for i in range(args.users):
+            user = threading.Thread(target=run_user, args=(base_url, callbacks, targets, args, results, deadline), daemon=True)
+            user.start()
+            users.append(user)
+            time.sleep(args.ramp_up / max(args.users, 1))
+        for user in users:
+            user.join(args.timeout + max(deadline - time.monotonic(), 0))
+        duration = time.monotonic() - start
+    finally:
+        stop_sampler.set()
+        if process is not None:
+            # SIGINT makes gunicorn stop right away instead of waiting for busy workers
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    summary = summarize_results(results, duration)
+    processes = summarize_samples(samples)
+    print(f"\n{args.users} users for {duration:.0f} s ({stub['requests']} upstream requests)")
+    print(f"{'callback':<14} {'requests':>8} {'req/s':>8} {'errors':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, stats in summary.items():
+        print(f"{name:<14} {stats['requests']:>8} {stats['throughput']:>8.2f} {stats['error_rate']:>8.1%} {stats['p50_ms']:>9.1f} "
+              f"{stats['p90_ms']:>9.1f} {stats['p99_ms']:>9.1f} {stats['max_ms']:>9.1f}")
+    if processes:
+        print(f"\n{'process':<10} {'cpu %':>8} {'peak rss MB':>12}")
+        for pid, stats in processes.items():
+            print(f"{pid:<10} {stats['cpu_percent']:>8.1f} {stats['peak_rss_mb']:>12.1f}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"users": args.users, "duration": duration, "workers": args.workers, "threads": args.threads,
+                       "callbacks": summary, "processes": {str(pid): stats for pid, stats in processes.items()}}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
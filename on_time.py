@@ -0,0 +1,212 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+import data_plane
+import stop_events
+
+# On-time performance aggregates per route, direction, hour and stop.
+# Every time a bus moves on from a stop (its next stop in bus_updates.json changes), the last delay reported for that stop in
+# trip_updates.json is counted once as early, on time, or late and added to a histogram of delays. A bus can go through several
+# stops between two snapshots, so every stop of its trip from its previous next stop up to its current one is counted, each with the
+# last delay reported for it. A bus which starts a new trip has only served the rest of its previous trip if it was heading to the
+# last stop, and a bus which left the feed hasn't been seen serving anything, so neither is counted. Only the buses whose next stop
+# changed since the previous snapshot are counted, so the counters never have to be recomputed from raw snapshots. The counters of each service day are kept in memory and regularly saved as a rollup in data/on_time/YYYYMMDD.json,
+# which is all the On-Time Performance page ever reads.
+
+rollup_dir = os.path.join("data", "on_time")
+service_timezone = "America/Los_Angeles"
+
+# A bus more than 1 minute early is early and more than 5 minutes late is late
+early_threshold_seconds = -60
+late_threshold_seconds = 300
+
+# Delays are counted in 1 minute bins from 10 minutes early to 30 minutes late. Delays outside that range go in the first or last bin
+histogram_min_minutes = -10
+histogram_max_minutes = 30
+
+# How often the rollup of the current service day is saved
+persist_seconds = 60
+
+# The last stop and delay seen for every bus, the counters of the current service day, and when they were last saved
+aggregator = {"signature": None, "last_seen": {}, "date": None, "rollup": None, "persisted": 0}
+aggregator_lock = threading.Lock()
+
+# Returns an empty rollup for a service day
+def new_rollup(service_date):
+    return {"date": service_date, "updated": None, "routes": {}, "stops": {}}
+
+# Returns the index of the counter of a delay: 0 for early, 1 for on time, and 2 for late
+def classify_delay(delay):
+    if delay < early_threshold_seconds:
+        return 0
+    if delay > late_threshold_seconds:
+        return 2
+    return 1
+
+# Returns the path of the rollup file of a service day
+def get_rollup_file(service_date):
+    return os.path.join(rollup_dir, f"{service_date}.json")
+
+# Returns the saved rollup of a service day or an empty rollup if there is none
+def load_rollup(service_date):
+    try:
+        with open(get_rollup_file(service_date), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return new_rollup(service_date)
+
+# Atomically saves a rollup so the On-Time Performance page never reads a partially written file
+def save_rollup(rollup):
+    os.makedirs(rollup_dir, exist_ok=True)
+    rollup_file = get_rollup_file(rollup["date"])
+    temp_rollup_file = f"{rollup_file}.{os.getpid()}.tmp"
+    with open(temp_rollup_file, "w") as f:
+        json.dump(rollup, f)
+    os.replace(temp_rollup_file, rollup_file)
+
+# Returns the dates of every saved rollup from newest to oldest
+def get_rollup_dates():
+    if not os.path.isdir(rollup_dir):
+        return []
+    return sorted((file[:-5] for file in os.listdir(rollup_dir) if file.endswith(".json")), reverse=True)
+
+# Adds a single served stop to the counters of a rollup
+# ----------------------------------------------------------------------------------
+# rollup is the rollup of the current service day
+# route_number is the route number of the trip e.g. 6
+# direction is the direction_id of the trip
+# hour is the hour at which the stop was served
+# stop_id is the id of the stop that was served
+# delay is the last delay in seconds reported for that stop
+# ----------------------------------------------------------------------------------
+def add_observation(rollup, route_number, direction, hour, stop_id, delay):
+    category = classify_delay(delay)
+    route_key = f"{route_number}|{direction}"
+    route = rollup["routes"].setdefault(route_key, {
+        "route": route_number,
+        "direction": direction,
+        "hours": {},
+        "histogram": [0] * (histogram_max_minutes - histogram_min_minutes + 1),
+    })
+    route["hours"].setdefault(str(hour), [0, 0, 0])[category] += 1
+    delay_minutes = min(max(int(round(delay / 60)), histogram_min_minutes), histogram_max_minutes)
+    route["histogram"][delay_minutes - histogram_min_minutes] += 1
+    rollup["stops"].setdefault(str(stop_id), [0, 0, 0])[category] += 1
+
+# Updates the counters from a new realtime snapshot
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# now is the current datetime in the service timezone
+# ----------------------------------------------------------------------------------
+def process_snapshot(buses, current_trips, now):
+    service_date = now.strftime("%Y%m%d")
+    if aggregator["date"] != service_date:
+        if aggregator["rollup"] is not None:
+            save_rollup(aggregator["rollup"])
+        aggregator["date"] = service_date
+        aggregator["rollup"] = load_rollup(service_date)
+
+    # Delays reported for the upcoming stops of every trip
+    trip_delays = {}
+    for trip in current_trips:
+        trip_delays.setdefault(trip["trip_id"], {})[trip["stop_sequence"]] = (trip["stop_id"], trip["delay"])
+    static = data_plane.get_static()
+    trip_lookup = data_plane.get_trip_lookup(static)
+    trips = static["tables"]["trips"]
+
+    last_seen = aggregator["last_seen"]
+    seen = {}
+    for bus in buses:
+        delays = trip_delays.get(bus["trip_id"], {})
+        stop_sequence = next((sequence for sequence, (stop_id, _) in delays.items() if str(stop_id) == str(bus["stop_id"])), None)
+        if stop_sequence is None:
+            continue
+        seen[bus["id"]] = (bus["trip_id"], bus["stop_id"], stop_sequence, delays)
+    # Buses which left the feed or stopped reporting their next stop are dropped without counting anything
+    changed = [bus_id for bus_id, previous in last_seen.items() if bus_id in seen and seen[bus_id][:3] != previous[:3]]
+
+    # A bus whose next stop changed has served every stop from its previous next stop up to its current one, so count each of them
+    # with the last delay reported for it
+    changed_trips = trip_lookup.get_indexer([last_seen[bus_id][0] for bus_id in changed]) if changed else np.array([], dtype=np.int64)
+    served = 0
+    for bus_id, trip in zip(changed, changed_trips):
+        if trip < 0:
+            continue
+        trip_id, stop_id, stop_sequence, delays = last_seen[bus_id]
+        trip_stops = stop_events.get_trip_stops(static, trip)
+        stop_sequences = trip_stops["stop_sequence"]
+        if seen[bus_id][0] == trip_id:
+            served_positions = np.flatnonzero((stop_sequences >= stop_sequence) & (stop_sequences < seen[bus_id][2]))
+        elif len(stop_sequences) and stop_sequences[-1] == stop_sequence:
+            served_positions = [len(stop_sequences) - 1]
+        else:
+            continue
+        route_number = str(trips["route_id"][trip]).split("-")[0]
+        direction = int(trips["direction_id"][trip])
+        delay = delays[stop_sequence][1]
+        for position in served_positions:
+            # A stop without a delay of its own in the previous snapshot gets the delay of the stop before it
+            delay = delays.get(int(stop_sequences[position]), (None, delay))[1]
+            add_observation(aggregator["rollup"], route_number, direction, now.hour, int(trip_stops["stop_id"][position]), delay)
+            served += 1
+
+    aggregator["last_seen"] = seen
+    aggregator["rollup"]["updated"] = now.isoformat()
+    return served
+
+# Updates the counters if a new realtime snapshot is available and saves the rollup every persist_seconds.
+# Only one process should call this: the data plane refresher when it is running, or the website itself otherwise
+def update_from_snapshot():
+    with aggregator_lock:
+        signature = data_plane.get_realtime_signature()
+        if signature == aggregator["signature"]:
+            return 0
+        aggregator["signature"] = signature
+        buses = data_plane.load_realtime("bus_updates")
+        current_trips = data_plane.load_realtime("trip_updates")
+        if buses is None:
+            buses = read_json(os.path.join("data", "bus_updates.json"))
+            current_trips = read_json(os.path.join("data", "trip_updates.json"))
+        changed = process_snapshot(buses, current_trips, datetime.now(ZoneInfo(service_timezone)))
+        if time.monotonic() - aggregator["persisted"] >= persist_seconds:
+            save_rollup(aggregator["rollup"])
+            aggregator["persisted"] = time.monotonic()
+        return changed
+
+# Returns the content of a realtime json file or an empty list if it is missing
+def read_json(data_file):
+    try:
+        with open(data_file, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+# Returns the rollup of a service day, using the counters in memory for the current service day if this process is updating them
+def get_rollup(service_date):
+    with aggregator_lock:
+        if aggregator["date"] == service_date and aggregator["rollup"] is not None:
+            return json.loads(json.dumps(aggregator["rollup"]))
+    return load_rollup(service_date)
+
+# Returns the early, on time, and late totals of every route of a rollup sorted by route number
+def get_route_totals(rollup):
+    totals = []
+    for route in rollup["routes"].values():
+        counts = np.sum([hour_counts for hour_counts in route["hours"].values()], axis=0) if route["hours"] else np.zeros(3)
+        totals.append({"route": route["route"], "direction": route["direction"], "early": int(counts[0]), "on_time": int(counts[1]), "late": int(counts[2])})
+    return sorted(totals, key=lambda total: (len(total["route"]), total["route"], total["direction"]))
+
+# Returns the early, on time, and late totals of every hour of a rollup across all routes
+def get_hour_totals(rollup):
+    hours = np.zeros((24, 3), dtype=np.int64)
+    for route in rollup["routes"].values():
+        for hour, counts in route["hours"].items():
+            hours[int(hour) % 24] += counts
+    return hours
@@ -0,0 +1,185 @@
+import functools
+import hmac
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# On-demand profiling of the website under real traffic.
+# A profiled call is watched by a sampler thread which records the stack of the thread running it every sample_interval_seconds,
+# and the number of times every stack was seen is written to data/profiles as collapsed stacks (one "outer;inner;innermost count"
+# line per stack), which flamegraph.pl and speedscope turn into a flame graph. Nothing is profiled unless asked: a fraction
+# PROFILE_SAMPLE_RATE of the calls of the callbacks decorated with sampled are profiled, and a single request is profiled when it
+# is sent with the X-Profile header set to PROFILE_TOKEN. Memory growth is diagnosed with tracemalloc, started, snapshotted and stopped
+# through /debug/tracemalloc, where every snapshot is compared with the previous one. The debug routes and the header only work when
+# PROFILE_TOKEN is set, and at most max_profiles files are kept so a high sample rate can't fill the disk.
+
+profile_dir = os.environ.get("PROFILE_DIR", os.path.join("data", "profiles"))
+
+# Fraction of the calls of sampled callbacks which are profiled, and the secret enabling the X-Profile header and the debug routes
+sample_rate = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+profile_token = os.environ.get("PROFILE_TOKEN", "")
+profile_header = "X-Profile"
+
+# How often the stack of a profiled call is recorded, and how many profile and snapshot files are kept
+sample_interval_seconds = 0.002
+max_profiles = 200
+
+# Number of frames kept per allocation by tracemalloc and number of lines returned by a snapshot
+tracemalloc_frames = 10
+tracemalloc_top = 25
+
+# The sampler of the call or request being profiled by every thread, so that a profiled request doesn't profile its callback again
+current = threading.local()
+
+# The previous tracemalloc snapshot of this process, which the next snapshot is compared with
+memory = {"previous": None}
+memory_lock = threading.Lock()
+
+# Returns True if a value sent by a client is the profiling token
+def is_authorized(value):
+    return bool(profile_token) and bool(value) and hmac.compare_digest(str(value), profile_token)
+
+# Starts recording the stacks of the current thread and returns the sampler, or None if this thread is already being profiled
+# ----------------------------------------------------------------------------------
+# name is the name of the profiled call or request, used in the name of the profile file
+# ----------------------------------------------------------------------------------
+def start_sampling(name):
+    if getattr(current, "sampler", None) is not None:
+        return None
+    sampler = {"name": name, "thread_id": threading.get_ident(), "stacks": Counter(), "stop": threading.Event(), "start": time.perf_counter()}
+    sampler["thread"] = threading.Thread(target=sample_stacks, args=(sampler,), name="profile-sampler", daemon=True)
+    sampler["thread"].start()
+    current.sampler = sampler
+    return sampler
+
+# Loop of the sampler thread counting the stacks of the profiled thread until the sampler is stopped
+def sample_stacks(sampler):
+    while not sampler["stop"].wait(sample_interval_seconds):
+        frame = sys._current_frames().get(sampler["thread_id"])
+        stack = []
+        while frame is not None:
+            stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+            frame = frame.f_back
+        if stack:
+            sampler["stacks"][";".join(reversed(stack))] += 1
+
+# Stops a sampler and writes its collapsed stacks to profile_dir
+# Returns the name of the profile file, or None if nothing was recorded
+def stop_sampling(sampler):
+    if sampler is None or sampler["stop"].is_set():
+        return None
+    sampler["stop"].set()
+    sampler["thread"].join()
+    current.sampler = None
+    if not sampler["stacks"]:
+        return None
+    elapsed_ms = int((time.perf_counter() - sampler["start"]) * 1000)
+    name = "".join(character if character.isalnum() or character in "-_" else "_" for character in sampler["name"])
+    file_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{elapsed_ms}ms-{os.getpid()}.collapsed"
+    try:
+        os.makedirs(profile_dir, exist_ok=True)
+        with open(os.path.join(profile_dir, file_name), "w") as f:
+            for stack, count in sampler["stacks"].most_common():
+                f.write(f"{stack} {count}\n")
+        prune_profiles()
+    except OSError as e:
+        print(f"Error writing profile {file_name}: {e}", flush=True)
+        return None
+    return file_name
+
+# Deletes the oldest files of profile_dir beyond max_profiles
+def prune_profiles():
+    for file_name in list_profiles()[max_profiles:]:
+        try:
+            os.remove(os.path.join(profile_dir, file_name))
+        except OSError:
+            pass
+
+# Returns the names of the files in profile_dir from newest to oldest
+def list_profiles():
+    try:
+        file_names = os.listdir(profile_dir)
+    except OSError:
+        return []
+    return sorted(file_names, key=lambda file_name: os.path.getmtime(os.path.join(profile_dir, file_name)), reverse=True)
+
+# Decorator profiling a fraction sample_rate of the calls of a function
+def sampled(function):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if sample_rate <= 0 or random.random() >= sample_rate:
+            return function(*args, **kwargs)
+        sampler = start_sampling(function.__name__)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stop_sampling(sampler)
+
+    return wrapper
+
+# Starts profiling the current request if it was sent with the profiling token in the X-Profile header, except for the debug routes
+# which are sent the token as well
+# ----------------------------------------------------------------------------------
+# header_value is the value of the X-Profile header of the request or None
+# path is the path of the request
+# ----------------------------------------------------------------------------------
+def start_request_profile(header_value, path):
+    if is_authorized(header_value) and not path.startswith("/debug/"):
+        start_sampling(f"request-{path}")
+
+# Stops profiling the current request if it is being profiled and returns the name of the profile file or None
+def stop_request_profile():
+    return stop_sampling(getattr(current, "sampler", None))
+
+# Starts, snapshots or stops tracemalloc in this process
+# ----------------------------------------------------------------------------------
+# action is start, snapshot, or stop
+# Returns a dictionary that can be sent as json. A snapshot returns the lines allocating the most memory and the lines whose
+# allocations grew the most since the previous snapshot, which are also written to profile_dir
+# ----------------------------------------------------------------------------------
+def run_tracemalloc(action):
+    with memory_lock:
+        if action == "start":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(tracemalloc_frames)
+            memory["previous"] = None
+        elif action == "stop":
+            tracemalloc.stop()
+            memory["previous"] = None
+        elif action != "snapshot":
+            return {"error": "action must be start, snapshot, or stop"}
+        result = {"pid": os.getpid(), "tracing": tracemalloc.is_tracing()}
+        if action != "snapshot" or not tracemalloc.is_tracing():
+            return result
+
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        current_bytes, peak_bytes = tracemalloc.get_traced_memory()
+        result["current_kb"] = current_bytes // 1024
+        result["peak_kb"] = peak_bytes // 1024
+        result["top"] = [
+            {"line": str(stat.traceback[0]), "size_kb": stat.size // 1024, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:tracemalloc_top]
+        ]
+        if memory["previous"] is not None:
+            result["growth"] = [
+                {"line": str(stat.traceback[0]), "size_diff_kb": stat.size_diff // 1024, "count_diff": stat.count_diff}
+                for stat in snapshot.compare_to(memory["previous"], "lineno")[:tracemalloc_top]
+            ]
+        memory["previous"] = snapshot
+
+        file_name = f"{time.strftime('%Y%m%d-%H%M%S')}-tracemalloc-{os.getpid()}.txt"
+        try:
+            os.makedirs(profile_dir, exist_ok=True)
+            with open(os.path.join(profile_dir, file_name), "w") as f:
+                for stat in snapshot.statistics("traceback")[:tracemalloc_top]:
+                    f.write(f"{stat.size // 1024} KB in {stat.count} blocks\n")
+                    f.write("\n".join(stat.traceback.format()) + "\n\n")
+            prune_profiles()
+            result["file"] = file_name
+        except OSError as e:
+            print(f"Error writing tracemalloc snapshot {file_name}: {e}", flush=True)
+        return result
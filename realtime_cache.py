@@ -0,0 +1,229 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import requests
+
+import data_plane
+import fetch_fleet_data
+import fetch_trip_data
+
+# Stale-while-revalidate serving of the realtime data.
+# Pages are always served the last good snapshot of bus_updates.json and trip_updates.json right away, along with its age, and never
+# wait on BC Transit. When the snapshot is older than fresh_seconds, a single background thread per worker downloads a new one while
+# the current one keeps being served. Every upstream (BC Transit and the copy of the last GitHub Actions Workflow run used as a fallback)
+# goes through a circuit breaker: after failure_threshold failures in a row the upstream is not called again until an exponentially
+# growing backoff has passed, so a slow or failing upstream costs at most one background request per backoff instead of stalling
+# every request. BC Transit's vehicle and trip feeds have a breaker each, so a failing feed only counts against itself. The two files
+# are always replaced together, and only once both were downloaded, so bus_updates.json never comes from another snapshot than
+# trip_updates.json. A user asking for an update only waits for the background refresh for up to refresh_wait_seconds.
+
+fallback_urls = {
+    "bus_updates": "https://raw.githubusercontent.com/CP8714/BC_Transit_tracker/refs/heads/main/data/bus_updates.json",
+    "trip_updates": "https://raw.githubusercontent.com/CP8714/BC_Transit_tracker/refs/heads/main/data/trip_updates.json",
+}
+fallback_timeout_seconds = (3, 10)
+
+# A snapshot younger than fresh_seconds is not refreshed, and one older than stale_after_seconds has its age shown to users
+fresh_seconds = int(os.environ.get("REALTIME_FRESH_SECONDS", "30"))
+stale_after_seconds = 120
+refresh_wait_seconds = 3
+
+# Number of failures in a row opening a circuit and how long it stays open, doubling after every further failure up to max_backoff_seconds
+failure_threshold = 3
+base_backoff_seconds = 15
+max_backoff_seconds = 600
+
+breakers = {
+    "bc_transit_fleet": {"failures": 0, "open_until": 0},
+    "bc_transit_trips": {"failures": 0, "open_until": 0},
+    "github": {"failures": 0, "open_until": 0},
+}
+breaker_lock = threading.Lock()
+
+# The last good snapshot of each realtime file and the signature of the file it was read from
+snapshots = {
+    "bus_updates": {"signature": None, "data": []},
+    "trip_updates": {"signature": None, "data": []},
+}
+snapshot_lock = threading.Lock()
+
+# The background refresh thread of this worker and an event set when it finishes
+refresher = {"thread": None, "finished": threading.Event()}
+refresher_lock = threading.Lock()
+
+# Returns True if an upstream can be called, i.e. its circuit is closed or its backoff has passed
+def is_available(upstream):
+    with breaker_lock:
+        return time.monotonic() >= breakers[upstream]["open_until"]
+
+# Records the result of a call to an upstream and opens its circuit after failure_threshold failures in a row
+def record_result(upstream, success):
+    with breaker_lock:
+        breaker = breakers[upstream]
+        if success:
+            breaker["failures"] = 0
+            breaker["open_until"] = 0
+            return
+        breaker["failures"] += 1
+        if breaker["failures"] >= failure_threshold:
+            backoff = min(base_backoff_seconds * 2 ** (breaker["failures"] - failure_threshold), max_backoff_seconds)
+            breaker["open_until"] = time.monotonic() + backoff
+            print(f"Circuit for {upstream} opened for {backoff} s after {breaker['failures']} failures", flush=True)
+
+# Calls an upstream through its circuit breaker
+# ----------------------------------------------------------------------------------
+# upstream is the name of the upstream in breakers
+# fetch is the function downloading the data from that upstream
+# Returns True if the upstream was called and succeeded
+# ----------------------------------------------------------------------------------
+def call_upstream(upstream, fetch):
+    if not is_available(upstream):
+        return False
+    try:
+        fetch()
+    except Exception as e:
+        print(f"Error fetching realtime data from {upstream}: {e}", flush=True)
+        record_result(upstream, False)
+        return False
+    record_result(upstream, True)
+    return True
+
+# Returns the path of a realtime file e.g. data/bus_updates.json
+def get_snapshot_file(name):
+    return os.path.join("data", f"{name}.json")
+
+# Returns the content of a realtime file, only parsing it again when it changes. If the file is missing or only partially written,
+# the last good snapshot is returned instead
+# ----------------------------------------------------------------------------------
+# name is either bus_updates or trip_updates
+# ----------------------------------------------------------------------------------
+def load_local_snapshot(name):
+    snapshot = snapshots[name]
+    try:
+        file_stat = os.stat(get_snapshot_file(name))
+    except OSError:
+        return snapshot["data"]
+    signature = (file_stat.st_mtime_ns, file_stat.st_size)
+    with snapshot_lock:
+        if signature != snapshot["signature"]:
+            try:
+                with open(get_snapshot_file(name), "r") as f:
+                    snapshot["data"] = json.load(f)
+                snapshot["signature"] = signature
+            except (OSError, ValueError) as e:
+                print(f"Error reading {name}.json, serving the last good snapshot: {e}", flush=True)
+        return snapshot["data"]
+
+# Returns the realtime data of bus_updates.json or trip_updates.json without ever waiting on an upstream, and starts a background refresh if it is not fresh
+# ----------------------------------------------------------------------------------
+# name is either bus_updates or trip_updates
+# ----------------------------------------------------------------------------------
+def load_snapshot(name):
+    data = data_plane.load_realtime(name)
+    if data is not None:
+        return data
+    data = load_local_snapshot(name)
+    if name == "bus_updates":
+        age = get_snapshot_age(data)
+        if age is None or age >= fresh_seconds:
+            revalidate()
+    return data
+
+# Returns how many seconds ago the newest bus position of a snapshot was received, or None if the snapshot is empty
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# ----------------------------------------------------------------------------------
+def get_snapshot_age(buses):
+    if not buses:
+        return None
+    newest = datetime.fromisoformat(max(bus["timestamp"] for bus in buses)).replace(tzinfo=timezone.utc)
+    return max(time.time() - newest.timestamp(), 0)
+
+# Atomically saves realtime files so that readers never see a partially written file. Every file is written to a temporary file
+# first and they are only swapped in once all of them have been written
+# ----------------------------------------------------------------------------------
+# records is a dictionary giving the content of every realtime file to save e.g. {"bus_updates": [...], "trip_updates": [...]}
+# ----------------------------------------------------------------------------------
+def save_snapshots(records):
+    temp_snapshot_files = {}
+    try:
+        for name, name_records in records.items():
+            temp_snapshot_files[name] = f"{get_snapshot_file(name)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_snapshot_files[name], "w") as f:
+                json.dump(name_records, f, indent=2)
+        for name, temp_snapshot_file in temp_snapshot_files.items():
+            os.replace(temp_snapshot_file, get_snapshot_file(name))
+    finally:
+        for temp_snapshot_file in temp_snapshot_files.values():
+            if os.path.exists(temp_snapshot_file):
+                os.remove(temp_snapshot_file)
+
+# Downloads the realtime files of the last GitHub Actions Workflow run and saves them if they are newer than the local ones
+def fetch_fallback():
+    fallback = {}
+    for name, url in fallback_urls.items():
+        response = requests.get(url, timeout=fallback_timeout_seconds)
+        response.raise_for_status()
+        fallback[name] = response.json()
+    local_age = get_snapshot_age(load_local_snapshot("bus_updates"))
+    fallback_age = get_snapshot_age(fallback["bus_updates"])
+    if fallback_age is not None and (local_age is None or fallback_age < local_age):
+        save_snapshots(fallback)
+
+# Downloads both realtime files from BC Transit, each through the breaker of its feed, and saves them only if both were downloaded
+# Returns True if new realtime files were saved
+def fetch_bc_transit():
+    records = {}
+    if not is_available("bc_transit_fleet") or not is_available("bc_transit_trips"):
+        return False
+    if not call_upstream("bc_transit_fleet", lambda: records.update(bus_updates=fetch_fleet_data.download())):
+        return False
+    if not call_upstream("bc_transit_trips", lambda: records.update(trip_updates=fetch_trip_data.download())):
+        return False
+    save_snapshots(records)
+    return True
+
+# Downloads new realtime data from BC Transit, or from the GitHub fallback if BC Transit is unavailable and the local data is stale
+# Returns True if new realtime files were saved
+def refresh():
+    if fetch_bc_transit():
+        return True
+    local_age = get_snapshot_age(load_local_snapshot("bus_updates"))
+    if local_age is not None and local_age < stale_after_seconds:
+        return False
+    signature = snapshots["bus_updates"]["signature"]
+    if not call_upstream("github", fetch_fallback):
+        return False
+    load_local_snapshot("bus_updates")
+    return snapshots["bus_updates"]["signature"] != signature
+
+# Starts a background refresh unless one is already running or the data is still fresh. The data plane refresher already keeps
+# the realtime data up-to-date when the data plane is enabled
+# ----------------------------------------------------------------------------------
+# wait_seconds is how long to wait for the refresh to finish, e.g. when a user clicked a button asking for an update
+# max_age_seconds is the age of the local data above which it is refreshed
+# ----------------------------------------------------------------------------------
+def revalidate(wait_seconds=0, max_age_seconds=fresh_seconds):
+    if data_plane.is_enabled():
+        return
+    age = get_snapshot_age(load_local_snapshot("bus_updates"))
+    if age is not None and age < max_age_seconds:
+        return
+    with refresher_lock:
+        if refresher["thread"] is None or not refresher["thread"].is_alive():
+            refresher["finished"] = threading.Event()
+            refresher["thread"] = threading.Thread(target=run_refresh, args=(refresher["finished"],), name="realtime-refresh", daemon=True)
+            refresher["thread"].start()
+        finished = refresher["finished"]
+    if wait_seconds:
+        finished.wait(wait_seconds)
+
+# Runs a single refresh in the background refresh thread
+def run_refresh(finished):
+    try:
+        refresh()
+    finally:
+        finished.set()
@@ -0,0 +1,59 @@
+import re
+
+import numpy as np
+
+import data_plane
+
+# Route indexes used to filter the next buses page by route.
+# Every route belongs to a family named after its number, so the 6, 6A and 6B all belong to the family 6, and the routes served at
+# every stop on every service day are indexed when the static data is built (see data_plane.build_static_tables). Filtering the
+# next arrivals by a route is then a lookup in a boolean mask over every trip of that route or family, which is only computed once per
+# version of the static data, and the route dropdown can only offer the routes that actually serve the selected stop today.
+
+# Returns the family of a route number e.g. 6 for 6A
+def get_route_family(route_short_name):
+    match = re.match(r"^(\d+)", str(route_short_name))
+    return match.group(1) if match else str(route_short_name)
+
+# Returns a boolean numpy array telling for every row of trips whether that trip runs a specific route, or one of its variants
+# as well if include_variants is True
+# ----------------------------------------------------------------------------------
+# route_short_name is the route number selected by the user e.g. 6
+# include_variants is True if the trips of every route in the same family (e.g. 6A and 6B for the 6) should also be included
+# ----------------------------------------------------------------------------------
+def get_route_trip_mask(route_short_name, include_variants):
+    static = data_plane.get_static()
+    route_short_name = str(route_short_name)
+
+    def build():
+        routes = static["tables"]["routes"]
+        if include_variants:
+            route_codes = np.flatnonzero(np.asarray(routes["route_family"]) == get_route_family(route_short_name))
+        else:
+            route_codes = np.flatnonzero(np.asarray(routes["route_short_name"]).astype(str) == route_short_name)
+        return np.isin(static["tables"]["trips"]["route"], route_codes)
+
+    return data_plane.get_cached(static, ("route_trip_mask", route_short_name, include_variants), build)
+
+# Returns the options of the route dropdown for the routes serving a specific stop on the given service days
+# ----------------------------------------------------------------------------------
+# stop_id is the id of the stop selected by the user
+# service_ids is the list of service ids running today
+# ----------------------------------------------------------------------------------
+def get_stop_route_options(stop_id, service_ids):
+    static = data_plane.get_static()
+    indexes = static["tables"]["indexes"]
+    stop_id = int(stop_id)
+    position = np.searchsorted(indexes["stop_routes_ids"], stop_id)
+    if position >= len(indexes["stop_routes_ids"]) or indexes["stop_routes_ids"][position] != stop_id:
+        return []
+    stop_routes = static["tables"]["stop_routes"]
+    rows = slice(indexes["stop_routes_offsets"][position], indexes["stop_routes_offsets"][position + 1])
+    today = np.isin(stop_routes["service_id"][rows], np.asarray(service_ids, dtype=np.int64))
+    route_rows = np.unique(np.asarray(stop_routes["route"][rows])[today])
+    routes = static["tables"]["routes"]
+    route_options = [
+        {"label": f"{routes['route_short_name'][row]} {routes['route_long_name'][row]}", "value": str(routes["route_short_name"][row])}
+        for row in route_rows if row >= 0
+    ]
+    return sorted(route_options, key=lambda option: (len(get_route_family(option["value"])), option["value"]))
@@ -0,0 +1,92 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+
+# Route lines drawn on the bus tracker map.
+# The route lines are stored in routes.shp which can only be read with geopandas, by far the slowest import of the website.
+# The lines are therefore converted into routes.geojson, which only needs the json module to be read, by running this script
+# after updating the shapefile. The website never converts the shapefile itself, so geopandas can't be imported while serving a
+# request. The sha256 of the shapefile converted last is kept in routes.geojson.sha256, and python route_shapes.py --check (run by
+# the Startup Budget workflow) fails when the shapefile has changed since, which doesn't depend on file modification times that a
+# git checkout or a docker COPY doesn't keep.
+
+routes_shp_file = os.path.join("data", "routes.shp")
+routes_geojson_file = os.path.join("data", "routes.geojson")
+routes_hash_file = os.path.join("data", "routes.geojson.sha256")
+
+# Files of the shapefile read by geopandas
+routes_shapefile_extensions = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+
+# The features of every route grouped by route_id, loaded the first time a route line is needed
+route_features = {}
+
+# Returns the sha256 of the content of every file of the shapefile
+def get_shapefile_hash():
+    shapefile_hash = hashlib.sha256()
+    base = os.path.splitext(routes_shp_file)[0]
+    for extension in routes_shapefile_extensions:
+        if os.path.exists(base + extension):
+            shapefile_hash.update(extension.encode())
+            with open(base + extension, "rb") as f:
+                shapefile_hash.update(f.read())
+    return shapefile_hash.hexdigest()
+
+# Converts routes.shp into routes.geojson and records the hash of the shapefile it was converted from. This is the only place where
+# geopandas is used
+def build_routes_geojson():
+    import geopandas as gpd
+
+    route_data = gpd.read_file(routes_shp_file)
+    with open(routes_geojson_file, "w") as f:
+        f.write(route_data.to_json())
+    with open(routes_hash_file, "w") as f:
+        f.write(get_shapefile_hash() + "\n")
+
+# Returns True if routes.geojson is missing or was converted from another version of the shapefile
+def is_geojson_outdated():
+    try:
+        with open(routes_hash_file, "r") as f:
+            converted_hash = f.read().strip()
+    except OSError:
+        return True
+    return not os.path.exists(routes_geojson_file) or converted_hash != get_shapefile_hash()
+
+# Loads routes.geojson and groups its features by route_id. Without routes.geojson no route lines are drawn
+def load_route_features():
+    try:
+        with open(routes_geojson_file, "r") as f:
+            routes_geojson = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Error loading route lines, run python route_shapes.py to build {routes_geojson_file}: {e}", flush=True)
+        return {}
+    features = {}
+    for feature in routes_geojson["features"]:
+        features.setdefault(feature["properties"]["route_id"], []).append(feature)
+    return features
+
+# Returns the geojson of the line of a specific route, in the same format as geopandas' to_json
+# ----------------------------------------------------------------------------------
+# route_id is the id of the route e.g. 6-VIC. If it doesn't match any route, the geojson contains no lines
+# ----------------------------------------------------------------------------------
+def get_route_geojson(route_id):
+    if not route_features:
+        route_features.update(load_route_features())
+    return {"type": "FeatureCollection", "features": route_features.get(route_id, [])}
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert the route lines of routes.shp into routes.geojson")
+    parser.add_argument("--check", action="store_true", help="only check that routes.geojson was converted from the current routes.shp")
+    args = parser.parse_args()
+
+    if args.check:
+        if is_geojson_outdated():
+            print(f"{routes_geojson_file} is out of date, run python route_shapes.py to rebuild it", flush=True)
+            sys.exit(1)
+        print(f"{routes_geojson_file} is up-to-date", flush=True)
+        return
+    build_routes_geojson()
+
+if __name__ == "__main__":
+    main()
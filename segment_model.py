@@ -0,0 +1,336 @@
+import argparse
+import os
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+
+import data_plane
+import on_time
+
+# Learned segment travel times used to predict arrival times.
+# Every realtime snapshot is appended to a daily archive of vehicle positions (the time each bus reported its position, its trip,
+# and its next stop along with the stop_sequence of that stop from trip_updates.json). An offline batch job (python segment_model.py)
+# then goes through every archived day it hasn't trained on yet: a bus whose next stop moved on between two snapshots passed the
+# stops in between, and the time between two such passages is split across the segments travelled in proportion to their
+# scheduled times. The travel time of every segment (route, from stop, to stop, and hour of the scheduled departure) is accumulated
+# as a sum and a count, capped at max_samples so that recent days keep mattering, and saved in segment_model.npz.
+# When the static data is loaded, the model is turned into one learned travel time per stop_times row (the time to reach that stop
+# from the previous one), so predicting the arrival at every remaining stop of every running trip is a gather and a cumulative sum.
+
+model_file = os.environ.get("SEGMENT_MODEL_FILE", os.path.join("data", "segment_model.npz"))
+archive_dir = os.environ.get("ARCHIVE_DIR", os.path.join("data", "archive"))
+service_timezone = "America/Los_Angeles"
+
+# Segments are learned for every hour of the day
+bucket_seconds = 3600
+bucket_count = 86400 // bucket_seconds
+
+# A segment is only used once it has been observed min_samples times, and older observations are discounted past max_samples
+min_samples = 5
+max_samples = 500
+
+# Passages further apart than this many segments, or travelling a segment faster or slower than these ratios of its scheduled
+# time, are too uncertain to learn from
+max_segments_per_observation = 3
+min_schedule_ratio = 0.2
+max_schedule_ratio = 5
+
+archive_columns = ["time", "trip_id", "route_id", "stop_id", "stop_sequence"]
+
+# The realtime snapshot last archived by this process
+archiver = {"signature": None}
+archiver_lock = threading.Lock()
+
+# The model last loaded from model_file and the signature of the file it was read from
+loaded = {"signature": None, "model": None}
+loaded_lock = threading.Lock()
+
+# Returns the path of the archive file of a service day
+def get_archive_file(service_date):
+    return os.path.join(archive_dir, f"positions_{service_date}.csv")
+
+# Appends the positions of every bus running a trip in the latest realtime snapshot to the archive of the current service day.
+# Only one process should call this: the data plane refresher
+def archive_snapshot():
+    with archiver_lock:
+        signature = data_plane.get_realtime_signature()
+        if signature == archiver["signature"]:
+            return 0
+        archiver["signature"] = signature
+        buses = data_plane.load_realtime("bus_updates")
+        current_trips = data_plane.load_realtime("trip_updates")
+        if buses is None:
+            buses = on_time.read_json(os.path.join("data", "bus_updates.json"))
+            current_trips = on_time.read_json(os.path.join("data", "trip_updates.json"))
+
+        next_stop_sequences = {(trip["trip_id"], str(trip["stop_id"])): trip["stop_sequence"] for trip in current_trips}
+        positions = pd.DataFrame([{
+            "time": int(bus.get("reported") or datetime.fromisoformat(bus["timestamp"]).replace(tzinfo=ZoneInfo("UTC")).timestamp()),
+            "trip_id": bus["trip_id"],
+            "route_id": bus["route"],
+            "stop_id": bus["stop_id"],
+            "stop_sequence": next_stop_sequences.get((bus["trip_id"], str(bus["stop_id"])), -1),
+        } for bus in buses if bus["trip_id"]], columns=archive_columns)
+        if positions.empty:
+            return 0
+        os.makedirs(archive_dir, exist_ok=True)
+        archive_file = get_archive_file(datetime.now(ZoneInfo(service_timezone)).strftime("%Y%m%d"))
+        positions.to_csv(archive_file, mode="a", header=not os.path.exists(archive_file), index=False)
+        return len(positions)
+
+# Returns the stop_times rows passed by buses and when they were passed, from the archived positions of one service day
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# positions is a dataframe of the archive_columns
+# Returns a dataframe with the trip, row, and time of every passage sorted by trip and time
+# ----------------------------------------------------------------------------------
+def get_passages(static, positions):
+    stop_times = static["tables"]["stop_times"]
+    trip_offsets = np.asarray(static["tables"]["indexes"]["trip_offsets"])
+    trip = data_plane.encode_ids(static, "trip", positions["trip_id"]).astype(np.int64)
+    stop = data_plane.encode_ids(static, "stop", positions["stop_id"]).astype(np.int64)
+    sequence = positions["stop_sequence"].to_numpy().astype(np.int64)
+    known = trip >= 0
+    trip, stop, sequence, times = trip[known], stop[known], sequence[known], positions["time"].to_numpy()[known]
+
+    # Row in stop_times of the next stop of every position, found by stop_sequence or by the first visit of the stop otherwise
+    row_trips = np.asarray(stop_times["trip"]).astype(np.int64)
+    sequence_keys = row_trips * 65536 + np.asarray(stop_times["stop_sequence"]).astype(np.int64)
+    found = np.minimum(np.searchsorted(sequence_keys, trip * 65536 + sequence), len(sequence_keys) - 1)
+    row = np.where((sequence >= 0) & (sequence_keys[found] == trip * 65536 + sequence), found, -1)
+    stop_keys = pd.Index(row_trips * len(static["tables"]["stops"]["stop_id"]) + np.asarray(stop_times["stop"]).astype(np.int64))
+    first_visits = ~stop_keys.duplicated()
+    visit = pd.Index(stop_keys[first_visits]).get_indexer(trip * len(static["tables"]["stops"]["stop_id"]) + stop)
+    row = np.where((row < 0) & (visit >= 0), np.flatnonzero(first_visits)[np.maximum(visit, 0)], row)
+
+    observed = pd.DataFrame({"trip": trip, "row": row, "time": times})
+    observed = observed[observed["row"] >= 0].drop_duplicates(["trip", "time"]).sort_values(["trip", "time"], kind="stable")
+
+    # When the next stop of a bus moved on between two positions, the stop right before its new next stop was passed between them
+    same_trip = observed["trip"].to_numpy()[1:] == observed["trip"].to_numpy()[:-1]
+    moved_on = same_trip & (observed["row"].to_numpy()[1:] > observed["row"].to_numpy()[:-1])
+    previous, current = observed.iloc[:-1][moved_on], observed.iloc[1:][moved_on]
+    passages = pd.DataFrame({
+        "trip": current["trip"].to_numpy(),
+        "row": current["row"].to_numpy() - 1,
+        "time": (previous["time"].to_numpy() + current["time"].to_numpy()) / 2,
+    })
+    # The first stop of a trip has no stop before it
+    passages = passages[passages["row"] >= trip_offsets[passages["trip"].to_numpy()]]
+    return passages.reset_index(drop=True)
+
+# Returns the travel time observed on every segment from the passages of one service day
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# passages is the dataframe returned by get_passages
+# Returns a dataframe with the route_id, from_stop_id, to_stop_id, bucket, travel_sum, and samples of every segment observed
+# ----------------------------------------------------------------------------------
+def get_observations(static, passages):
+    stop_times = static["tables"]["stop_times"]
+    departures = np.asarray(stop_times["departure"]).astype(np.int64)
+    arrivals = np.asarray(stop_times["arrival"]).astype(np.int64)
+
+    # Pairs of consecutive passages of the same trip close enough to be split across their segments
+    trip = passages["trip"].to_numpy()
+    row = passages["row"].to_numpy()
+    passed = passages["time"].to_numpy()
+    pair = np.flatnonzero((trip[1:] == trip[:-1]) & (row[1:] > row[:-1]) & (row[1:] - row[:-1] <= max_segments_per_observation))
+    start_row, end_row = row[pair], row[pair + 1]
+    travelled = passed[pair + 1] - passed[pair]
+    scheduled = arrivals[end_row] - departures[start_row]
+    plausible = (scheduled > 0) & (travelled >= scheduled * min_schedule_ratio) & (travelled <= scheduled * max_schedule_ratio)
+    start_row, end_row, travelled, scheduled = start_row[plausible], end_row[plausible], travelled[plausible], scheduled[plausible]
+
+    # Every segment of a pair gets the share of the travelled time its scheduled time has of the pair
+    segment_counts = end_row - start_row
+    owners = np.repeat(np.arange(len(start_row)), segment_counts)
+    segment_end = np.repeat(start_row + 1 - np.cumsum(segment_counts) + segment_counts, segment_counts) + np.arange(segment_counts.sum())
+    segment_scheduled = arrivals[segment_end] - departures[segment_end - 1]
+    segment_travelled = travelled[owners] * segment_scheduled / scheduled[owners]
+
+    segment_trips = np.asarray(stop_times["trip"])[segment_end]
+    observations = pd.DataFrame({
+        "route_id": np.asarray(static["tables"]["trips"]["route_id"]).astype(str)[segment_trips],
+        "from_stop_id": np.asarray(stop_times["stop_id"])[segment_end - 1].astype(np.int64),
+        "to_stop_id": np.asarray(stop_times["stop_id"])[segment_end].astype(np.int64),
+        "bucket": (departures[segment_end - 1] // bucket_seconds) % bucket_count,
+        "travel_sum": segment_travelled,
+        "samples": 1.0,
+    })
+    return observations.groupby(["route_id", "from_stop_id", "to_stop_id", "bucket"], as_index=False).sum()
+
+# Returns the saved model as a dataframe of segments along with the service days it was trained on
+def load_model():
+    segments = pd.DataFrame({"route_id": pd.Series([], dtype=str), "from_stop_id": pd.Series([], dtype=np.int64), "to_stop_id": pd.Series([], dtype=np.int64),
+                             "bucket": pd.Series([], dtype=np.int64), "travel_sum": pd.Series([], dtype=np.float64), "samples": pd.Series([], dtype=np.float64)})
+    try:
+        with np.load(model_file) as saved:
+            segments = pd.DataFrame({column: saved[column] for column in segments.columns})
+            trained_days = saved["trained_days"].tolist()
+    except (OSError, KeyError, ValueError):
+        trained_days = []
+    return segments, trained_days
+
+# Atomically saves the model so the website never reads a partially written file
+def save_model(segments, trained_days):
+    temp_model_file = f"{model_file}.{os.getpid()}.tmp.npz"
+    np.savez(
+        temp_model_file,
+        route_id=segments["route_id"].to_numpy().astype(str),
+        from_stop_id=segments["from_stop_id"].to_numpy().astype(np.int64),
+        to_stop_id=segments["to_stop_id"].to_numpy().astype(np.int64),
+        bucket=segments["bucket"].to_numpy().astype(np.int16),
+        travel_sum=segments["travel_sum"].to_numpy().astype(np.float64),
+        samples=segments["samples"].to_numpy().astype(np.float64),
+        trained_days=np.asarray(sorted(trained_days), dtype=str),
+    )
+    os.replace(temp_model_file, model_file)
+
+# Trains the model on every archived service day it hasn't been trained on yet. The current service day is only trained on once it is over
+# ----------------------------------------------------------------------------------
+# include_today is True to also train on the current service day, e.g. to try the model out. It will not be trained on again
+# Returns the service days trained on and the number of segments observed
+# ----------------------------------------------------------------------------------
+def train(include_today=False):
+    segments, trained_days = load_model()
+    today = datetime.now(ZoneInfo(service_timezone)).strftime("%Y%m%d")
+    archived_days = sorted(file[len("positions_"):-len(".csv")] for file in os.listdir(archive_dir)
+                           if file.startswith("positions_") and file.endswith(".csv")) if os.path.isdir(archive_dir) else []
+    new_days = [day for day in archived_days if day not in trained_days and (include_today or day < today)]
+    if not new_days:
+        return [], 0
+
+    static = data_plane.get_static()
+    observations = []
+    for day in new_days:
+        positions = pd.read_csv(get_archive_file(day), dtype={"trip_id": str, "route_id": str, "stop_id": str})
+        observations.append(get_observations(static, get_passages(static, positions)))
+    observations = pd.concat(observations, ignore_index=True)
+
+    keys = ["route_id", "from_stop_id", "to_stop_id", "bucket"]
+    segments = pd.concat([segments, observations], ignore_index=True).groupby(keys, as_index=False)[["travel_sum", "samples"]].sum()
+    # Older observations are discounted so that a segment never counts more than max_samples of them
+    discount = np.minimum(max_samples / segments["samples"].to_numpy(), 1)
+    segments["travel_sum"] *= discount
+    segments["samples"] *= discount
+    save_model(segments, trained_days + new_days)
+    return new_days, len(observations)
+
+# Returns the saved model, only reading model_file again when it changes, or None if there is no model
+def get_model():
+    try:
+        file_stat = os.stat(model_file)
+    except OSError:
+        return None
+    signature = (file_stat.st_mtime_ns, file_stat.st_size)
+    with loaded_lock:
+        if signature != loaded["signature"]:
+            segments, _ = load_model()
+            loaded["model"] = {"signature": signature, "segments": segments}
+            loaded["signature"] = signature
+        return loaded["model"]
+
+# Returns the learned time in seconds to reach every stop_times row from the previous stop of its trip, or NaN if that segment
+# hasn't been learned. Built once per static version and model
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# ----------------------------------------------------------------------------------
+def get_segment_seconds(static):
+    model = get_model()
+    if model is None:
+        return None
+
+    def build():
+        segments = model["segments"]
+        stop_times = static["tables"]["stop_times"]
+        stop_count = len(static["tables"]["stops"]["stop_id"])
+        learned = segments[segments["samples"] >= min_samples]
+
+        # Segments are keyed by their route, stops, and hour encoded with the id dictionary of this version
+        def get_keys(route, from_stop, to_stop, bucket):
+            known = (route >= 0) & (from_stop >= 0) & (to_stop >= 0)
+            return np.where(known, ((route * stop_count + from_stop) * stop_count + to_stop) * bucket_count + bucket, -1)
+
+        model_keys = get_keys(data_plane.encode_ids(static, "route", learned["route_id"]).astype(np.int64),
+                              data_plane.encode_ids(static, "stop", learned["from_stop_id"]).astype(np.int64),
+                              data_plane.encode_ids(static, "stop", learned["to_stop_id"]).astype(np.int64),
+                              learned["bucket"].to_numpy().astype(np.int64))
+        order = np.argsort(model_keys)
+        model_keys = model_keys[order]
+        model_seconds = (learned["travel_sum"].to_numpy() / learned["samples"].to_numpy())[order]
+
+        trip = np.asarray(stop_times["trip"]).astype(np.int64)
+        stop = np.asarray(stop_times["stop"]).astype(np.int64)
+        departure = np.asarray(stop_times["departure"]).astype(np.int64)
+        route = np.asarray(static["tables"]["trips"]["route"]).astype(np.int64)[trip]
+        # The first stop of a trip has no previous stop
+        has_previous = np.concatenate([[False], trip[1:] == trip[:-1]])
+        row_keys = np.full(len(trip), -1, dtype=np.int64)
+        row_keys[1:] = get_keys(route[1:], stop[:-1], stop[1:], (departure[:-1] // bucket_seconds) % bucket_count)
+        row_keys[~has_previous] = -1
+
+        seconds = np.full(len(row_keys), np.nan, dtype=np.float32)
+        if len(model_keys) == 0:
+            return seconds
+        found = np.minimum(np.searchsorted(model_keys, row_keys), len(model_keys) - 1)
+        matched = (row_keys >= 0) & (model_keys[found] == row_keys)
+        seconds[matched] = model_seconds[found[matched]]
+        return seconds
+
+    return data_plane.get_cached(static, ("segment_seconds", model["signature"]), build)
+
+# Returns the arrival time predicted at every remaining stop of several running trips at once
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# next_rows is a numpy array with the stop_times row of the next stop of every trip
+# next_etas is a numpy array with the estimated arrival time at that stop in GTFS seconds
+# Returns the stop_times rows after the next stop of every trip along with their predicted arrival times in GTFS seconds,
+# only for the rows where every segment from the next stop has been learned
+# ----------------------------------------------------------------------------------
+def predict_arrivals(static, next_rows, next_etas):
+    segment_seconds = get_segment_seconds(static)
+    if segment_seconds is None or len(next_rows) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    stop_times = static["tables"]["stop_times"]
+    trip_offsets = np.asarray(static["tables"]["indexes"]["trip_offsets"])
+    trips = np.asarray(stop_times["trip"])[next_rows].astype(np.int64)
+
+    # Every row after the next stop of every trip, one trip after the other. Trips already at their last stop have no rows
+    counts = trip_offsets[trips + 1] - next_rows - 1
+    group_starts = np.cumsum(counts) - counts
+    rows = np.repeat(next_rows + 1 - group_starts, counts) + np.arange(counts.sum())
+    if len(rows) == 0:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+    owners = np.repeat(np.arange(len(next_rows)), counts)
+    group_starts = np.minimum(group_starts, len(rows) - 1)
+
+    # The time to reach a stop is the learned travel time of its segment plus the scheduled dwell time at the previous stop
+    arrivals = np.asarray(stop_times["arrival"]).astype(np.int64)
+    departures = np.asarray(stop_times["departure"]).astype(np.int64)
+    learned = segment_seconds[rows].astype(np.float64)
+    steps = np.nan_to_num(learned) + np.maximum(departures[rows - 1] - arrivals[rows - 1], 0)
+    # Cumulative sums restarting at the first row of every trip
+    elapsed = np.cumsum(steps)
+    elapsed -= np.repeat(elapsed[group_starts] - steps[group_starts], counts)
+    unlearned = np.cumsum(np.isnan(learned))
+    unlearned -= np.repeat(unlearned[group_starts] - np.isnan(learned)[group_starts], counts)
+    confident = unlearned == 0
+    return rows[confident], (next_etas[owners] + np.round(elapsed)).astype(np.int64)[confident]
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the segment travel time model on the archived service days it hasn't been trained on yet")
+    parser.add_argument("--include-today", action="store_true", help="also train on the current service day, which will not be trained on again")
+    args = parser.parse_args()
+    new_days, observed = train(args.include_today)
+    if not new_days:
+        print("No new archived service days to train on", flush=True)
+        return
+    segments, trained_days = load_model()
+    print(f"Trained on {len(new_days)} service days ({', '.join(new_days)}) with {observed} segment observations", flush=True)
+    print(f"The model has {len(segments)} segments, {int((segments['samples'] >= min_samples).sum())} of them learned, from {len(trained_days)} service days", flush=True)
+
+if __name__ == "__main__":
+    main()
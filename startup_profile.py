@@ -0,0 +1,93 @@
+import argparse
+import subprocess
+import sys
+
+# Script used to profile the cold start of the website.
+# It imports app.py in a fresh python process with -X importtime so every module reports how long it took to import, then
+# times the first request made to the home page. The slowest modules are printed along with the total import and first request
+# times. If --budget is given, the script fails when the total startup time exceeds that many seconds, which is how the
+# GitHub Workflow keeps slow imports such as geopandas from creeping back into the startup path.
+
+# Code run in the fresh python process. The import and first request times are printed on the last line of stdout
+startup_code = """
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.server.test_client().get("/")
+first_request = time.perf_counter()
+print(f"{imported - start} {first_request - imported}")
+"""
+
+# Runs app.py in a fresh python process and returns the import time and first request time in seconds along with the -X importtime output
+def run_startup():
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", startup_code], capture_output=True, text=True, check=True)
+    import_seconds, first_request_seconds = result.stdout.strip().splitlines()[-1].split()
+    return float(import_seconds), float(first_request_seconds), result.stderr
+
+# Returns a list of (module, self seconds, cumulative seconds) from the output of -X importtime sorted from slowest to fastest
+# ----------------------------------------------------------------------------------
+# importtime_output is the text written to stderr by python -X importtime
+# ----------------------------------------------------------------------------------
+def parse_import_times(importtime_output):
+    modules = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        modules.append((module.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return sorted(modules, key=lambda module: module[2], reverse=True)
+
+# Returns the modules imported directly by app.py sorted from slowest to fastest
+# ----------------------------------------------------------------------------------
+# importtime_output is the text written to stderr by python -X importtime. A module is listed after all the modules it
+# imports and is indented by 2 more spaces than the module that imported it
+# ----------------------------------------------------------------------------------
+def get_app_imports(importtime_output):
+    imported = []
+    for line in importtime_output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        depth = (len(module) - len(module.lstrip()) - 1) // 2
+        if depth == 1:
+            imported.append((module.strip(), int(cumulative_us) / 1e6))
+        elif depth == 0:
+            if module.strip() == "app":
+                return sorted(imported, key=lambda module: module[1], reverse=True)
+            imported = []
+    return []
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile the import time and first request time of the website")
+    parser.add_argument("--top", type=int, default=20, help="number of slowest modules to show")
+    parser.add_argument("--budget", type=float, help="fail if the import and first request take longer than this many seconds in total")
+    parser.add_argument("--runs", type=int, default=3, help="number of fresh processes to start, the fastest one is reported")
+    args = parser.parse_args()
+
+    runs = [run_startup() for _ in range(args.runs)]
+    import_seconds, first_request_seconds, importtime_output = min(runs, key=lambda run: run[0] + run[1])
+    total_seconds = import_seconds + first_request_seconds
+
+    print("Modules imported by app.py (cumulative):")
+    for module, cumulative_seconds in get_app_imports(importtime_output):
+        print(f"  {cumulative_seconds * 1000:8.1f} ms  {module}")
+    print(f"\nSlowest {args.top} modules (self / cumulative):")
+    for module, self_seconds, cumulative_seconds in parse_import_times(importtime_output)[:args.top]:
+        print(f"  {self_seconds * 1000:8.1f} ms / {cumulative_seconds * 1000:8.1f} ms  {module}")
+    print(f"\nImport of app.py: {import_seconds:.3f} s")
+    print(f"First request to /: {first_request_seconds:.3f} s")
+    print(f"Total startup: {total_seconds:.3f} s")
+
+    loaded_geopandas = any(module == "geopandas" for module, _, _ in parse_import_times(importtime_output))
+    if loaded_geopandas:
+        print("Warning: geopandas was imported during startup")
+
+    if args.budget is not None:
+        if total_seconds > args.budget or loaded_geopandas:
+            print(f"Startup budget of {args.budget:.3f} s exceeded", flush=True)
+            sys.exit(1)
+        print(f"Startup is within the budget of {args.budget:.3f} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import glob
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+# Versioned static GTFS datasets.
+# Every static ingest made by fetch_data.py is written to a new directory data/static/<version> along with a manifest listing its
+# files, and is only activated once it is completely written by atomically replacing the small data/static/current pointer file.
+# Readers therefore always see one complete version: stop_times part files from an older, larger feed never linger and a schedule is
+# never half old and half new while it is being written. A new version is only written when the downloaded feed has changed, and the
+# previous version is kept for a while so that readers which started reading it before the swap can finish. When no version has been
+# activated yet, the csv files directly inside /data are used as before.
+
+legacy_dir = "data"
+static_root = os.path.join("data", "static")
+pointer_file = os.path.join(static_root, "current")
+static_tables = ["trips", "stops", "routes", "calendar_dates"]
+# Tables only saved when the feed has them. Versions ingested before shapes.txt was saved have no shapes.csv
+optional_static_tables = ["shapes"]
+
+# How many versions are kept on disk and how often the pointer file is checked for a new version
+kept_versions = 2
+pointer_check_seconds = 1
+
+# The directory of the active version as of the last check of the pointer file
+active = {"version": None, "dir": legacy_dir, "checked": 0}
+active_lock = threading.Lock()
+
+# Returns the name of the active version or None if no version has been activated
+def get_active_version():
+    try:
+        with open(pointer_file, "r") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+# Returns the directory containing the static csv files of the active version, or /data if no version has been activated
+def get_static_dir():
+    if time.monotonic() - active["checked"] >= pointer_check_seconds:
+        with active_lock:
+            version = get_active_version()
+            if version != active["version"]:
+                active["version"] = version
+                active["dir"] = os.path.join(static_root, version) if version else legacy_dir
+            active["checked"] = time.monotonic()
+    return active["dir"]
+
+# Returns the path of one of the static csv files e.g. get_static_file("trips") for trips.csv
+# ----------------------------------------------------------------------------------
+# name is the name of the file without .csv
+# static_dir is the directory of the version to read from, or the active version if it isn't given
+# ----------------------------------------------------------------------------------
+def get_static_file(name, static_dir=None):
+    return os.path.join(static_dir or get_static_dir(), f"{name}.csv")
+
+# Returns the paths of every stop_times part file in the order they were written
+# ----------------------------------------------------------------------------------
+# static_dir is the directory of the version to read from, or the active version if it isn't given
+# ----------------------------------------------------------------------------------
+def get_stop_times_files(static_dir=None):
+    files = glob.glob(os.path.join(static_dir or get_static_dir(), "stop_times_part_*.csv"))
+    return sorted(files, key=lambda file: int(re.search(r"_(\d+)\.csv$", file).group(1)))
+
+# Returns a value that changes whenever a new version of the static data is available: the active version, or the modification
+# times and sizes of the csv files in /data if no version has been activated
+def get_signature():
+    version = get_active_version()
+    if version:
+        return version
+    signature = []
+    optional_files = [get_static_file(name, legacy_dir) for name in optional_static_tables if os.path.exists(get_static_file(name, legacy_dir))]
+    for file in [get_static_file(name, legacy_dir) for name in static_tables] + optional_files + get_stop_times_files(legacy_dir):
+        file_stat = os.stat(file)
+        signature.append([file, file_stat.st_mtime_ns, file_stat.st_size])
+    return signature
+
+# Returns the manifest of a version or None if it can't be read
+def get_manifest(version):
+    try:
+        with open(os.path.join(static_root, version, "manifest.json"), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Atomically makes version the active version and removes the older versions no longer kept
+def activate_version(version):
+    temp_pointer_file = f"{pointer_file}.{os.getpid()}.tmp"
+    with open(temp_pointer_file, "w") as f:
+        f.write(version)
+    os.replace(temp_pointer_file, pointer_file)
+
+    versions = sorted(d for d in os.listdir(static_root) if d.startswith("static-") and os.path.isdir(os.path.join(static_root, d)))
+    for old_version in versions[:-kept_versions]:
+        if old_version != version:
+            shutil.rmtree(os.path.join(static_root, old_version), ignore_errors=True)
+
+# Writes a complete static ingest to a new version directory and activates it
+# ----------------------------------------------------------------------------------
+# feed_hash is the sha256 of the downloaded GTFS zip file, saved in the manifest so an unchanged feed isn't written again
+# tables is a dictionary of the static_tables dataframes e.g. {"trips": trips_df, ...}
+# stop_times_chunks is an iterable of stop_times dataframes, each saved as its own stop_times_part file
+# Returns the name of the new version
+# ----------------------------------------------------------------------------------
+def write_version(feed_hash, tables, stop_times_chunks):
+    version = f"static-{time.time_ns():020d}"
+    version_dir = os.path.join(static_root, version)
+    os.makedirs(version_dir)
+    manifest = {"version": version, "feed_hash": feed_hash, "created": time.time(), "files": {}}
+    try:
+        for name, df in tables.items():
+            df.to_csv(get_static_file(name, version_dir), index=False)
+            manifest["files"][f"{name}.csv"] = len(df)
+        for i, chunk in enumerate(stop_times_chunks):
+            chunk.to_csv(os.path.join(version_dir, f"stop_times_part_{i}.csv"), index=False)
+            manifest["files"][f"stop_times_part_{i}.csv"] = len(chunk)
+        with open(os.path.join(version_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+    except Exception:
+        shutil.rmtree(version_dir, ignore_errors=True)
+        raise
+    activate_version(version)
+    return version
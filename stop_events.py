@@ -0,0 +1,244 @@
+import os
+import threading
+from datetime import datetime
+from zoneinfo import ZoneInfo
+
+import numpy as np
+import pandas as pd
+
+import data_plane
+import eta_engine
+import interpolation
+import on_time
+
+# Actual arrival and departure events extracted from consecutive realtime snapshots.
+# Every bus is remembered with its trip, the stop_sequence of its next stop, where it was and when it reported it. When a new snapshot
+# comes in, a bus whose next stop moved further along the same trip has left every stop in between, and the time it passed each of
+# them is interpolated between the two reports in proportion to the straight line distances from its previous position through those
+# stops to its current position. A bus reported within arrival_radius_meters of its next stop has arrived at it, so the stop gets an
+# arrival event and is later given a departure event when the bus moves on, while stops the bus went through between two reports get
+# a single passed event. Only the previous report of every bus is looked at, so each refresh costs O(vehicles) and the raw feeds never
+# have to be stored.
+# The events of each service day are appended to data/events/YYYYMMDD.events as fixed size binary records (see event_dtype). The trip,
+# route and vehicle of a record are indexes into the names of data/events/YYYYMMDD.names, one per line, which are always written
+# before the records using them, so reliability reports can load a whole day with a single read.
+
+events_dir = os.environ.get("EVENTS_DIR", os.path.join("data", "events"))
+
+# A bus reported this close to its next stop is at that stop
+arrival_radius_meters = 40
+
+# Kinds of events: a bus seen at the stop, a bus leaving a stop it was seen at, and a bus going through a stop between two reports
+event_kinds = ["arrival", "departure", "passed"]
+
+# time is the unix timestamp of the event and delay the number of seconds it happened after the scheduled arrival (or departure for
+# departure events)
+event_dtype = np.dtype([
+    ("time", "<u4"),
+    ("trip", "<i4"),
+    ("route", "<i4"),
+    ("vehicle", "<i4"),
+    ("stop_id", "<i4"),
+    ("stop_sequence", "<i2"),
+    ("delay", "<i4"),
+    ("kind", "u1"),
+])
+
+# The last report of every bus, the names of the current service day, and the number of events written by this process
+detector = {"signature": None, "last_seen": {}, "date": None, "names": {}, "written": 0}
+detector_lock = threading.Lock()
+
+# Returns the paths of the event and name files of a service day
+def get_event_files(service_date):
+    return os.path.join(events_dir, f"{service_date}.events"), os.path.join(events_dir, f"{service_date}.names")
+
+# Returns the names of a service day, in the order their indexes were given
+def load_names(service_date):
+    try:
+        with open(get_event_files(service_date)[1], "r") as f:
+            return f.read().splitlines()
+    except OSError:
+        return []
+
+# Returns the dates of every saved event log from newest to oldest
+def get_event_dates():
+    if not os.path.isdir(events_dir):
+        return []
+    return sorted((file[:-7] for file in os.listdir(events_dir) if file.endswith(".events")), reverse=True)
+
+# Returns the times at which a bus went through some stops between two reports
+# ----------------------------------------------------------------------------------
+# points is a numpy array with the x and y in meters of the previous position, of every stop, and of the current position
+# previous_time and current_time are the unix timestamps of the two reports
+# ----------------------------------------------------------------------------------
+def get_passage_times(points, previous_time, current_time):
+    distances = np.cumsum(np.hypot(np.diff(points[:, 0]), np.diff(points[:, 1])))
+    if not np.isfinite(distances[-1]) or distances[-1] <= 0:
+        # Stops without coordinates are assumed to be evenly spread between the two reports
+        fractions = np.arange(1, len(points) - 1) / (len(points) - 1)
+    else:
+        fractions = distances[:-1] / distances[-1]
+    return previous_time + (current_time - previous_time) * fractions
+
+# Returns the stop codes, stop ids, stop_sequence values, scheduled arrival and departure times and shape_dist_traveled of every stop time of a trip
+def get_trip_stops(static, trip):
+    def build():
+        tables = static["tables"]
+        trip_offsets = np.asarray(tables["indexes"]["trip_offsets"])
+        positions = np.arange(trip_offsets[trip + 1] - trip_offsets[trip])
+        trips = np.full(len(positions), trip)
+        return {column: data_plane.get_stop_time_values(tables, trips, positions, column) for column in ["stop", "stop_id", "stop_sequence", "arrival", "departure", "shape_dist_traveled"]}
+
+    return data_plane.get_cached(static, ("trip_stops", int(trip)), build)
+
+# Returns the index of a name in the names of the current service day, appending it to the names file if it is new
+def get_name_index(name, names_file):
+    names = detector["names"]
+    if name not in names:
+        with open(names_file, "a") as f:
+            f.write(f"{name}\n")
+        names[name] = len(names)
+    return names[name]
+
+# Detects the events of a new realtime snapshot and appends them to the event log of the current service day
+# ----------------------------------------------------------------------------------
+# buses is the list of dictionaries containing all the realtime data from bus_updates.json
+# current_trips is the list of dictionaries containing all the realtime data from trip_updates.json
+# now is the current datetime in the service timezone
+# ----------------------------------------------------------------------------------
+def process_snapshot(buses, current_trips, now):
+    service_date = now.strftime("%Y%m%d")
+    if detector["date"] != service_date:
+        detector["date"] = service_date
+        detector["names"] = {name: index for index, name in enumerate(load_names(service_date))}
+    service_day_start = eta_engine.get_service_day_start(now)
+
+    next_stop_sequences = {(trip["trip_id"], str(trip["stop_id"])): trip["stop_sequence"] for trip in current_trips}
+    static = data_plane.get_static()
+    trip_lookup = data_plane.get_trip_lookup(static)
+    stops = static["tables"]["stops"]
+    stop_x = np.asarray(stops["stop_lon"], dtype=np.float64) * interpolation.meters_per_degree_lon
+    stop_y = np.asarray(stops["stop_lat"], dtype=np.float64) * interpolation.meters_per_degree_lat
+
+    running = [bus for bus in buses if bus["trip_id"] and (bus["trip_id"], str(bus["stop_id"])) in next_stop_sequences]
+    running_trips = trip_lookup.get_indexer([bus["trip_id"] for bus in running]) if running else np.array([], dtype=np.int64)
+
+    last_seen = detector["last_seen"]
+    seen = {}
+    events = []
+
+    # Adds an event at the position of a trip's stop time
+    def add_event(trip_id, route_id, vehicle, trip_stops, position, event_time, kind):
+        scheduled = trip_stops["departure" if event_kinds[kind] == "departure" else "arrival"][position]
+        delay = int(round(event_time)) - service_day_start - int(scheduled)
+        # A trip of the previous service day still running after midnight is scheduled past 24:00 of the previous day
+        if delay < -43200:
+            delay += 86400
+        events.append((int(round(event_time)), trip_id, route_id, vehicle, int(trip_stops["stop_id"][position]),
+                       int(trip_stops["stop_sequence"][position]), delay, kind))
+
+    for bus, trip in zip(running, running_trips):
+        if trip < 0:
+            continue
+        trip_stops = get_trip_stops(static, trip)
+        position = int(np.searchsorted(trip_stops["stop_sequence"], next_stop_sequences[(bus["trip_id"], str(bus["stop_id"]))]))
+        if position >= len(trip_stops["stop_sequence"]):
+            continue
+        report_time = interpolation.get_report_time(bus)
+        x = bus["lon"] * interpolation.meters_per_degree_lon
+        y = bus["lat"] * interpolation.meters_per_degree_lat
+        stop_codes = trip_stops["stop"]
+        stop_points = np.column_stack([np.where(stop_codes >= 0, stop_x[stop_codes], np.nan), np.where(stop_codes >= 0, stop_y[stop_codes], np.nan)])
+        previous = last_seen.get(bus["id"])
+        if previous is not None and report_time <= previous["time"]:
+            # The bus hasn't reported a new position since the previous snapshot
+            seen[bus["id"]] = previous
+            continue
+
+        arrived = None
+        if previous is not None and previous["trip"] == trip and previous["position"] < position:
+            # Every stop from the previous next stop up to the current one was left between the two reports
+            passed = np.arange(previous["position"], position)
+            points = np.vstack([[previous["x"], previous["y"]], stop_points[passed], [x, y]])
+            for passed_position, passed_time in zip(passed, get_passage_times(points, previous["time"], report_time)):
+                add_event(bus["trip_id"], bus["route"], bus["id"], trip_stops, passed_position, passed_time, 1 if passed_position == previous["arrived"] else 2)
+        elif previous is not None and previous["trip"] == trip and previous["position"] == position:
+            arrived = previous["arrived"]
+        elif previous is not None and previous["trip"] != trip and previous["arrived"] is None:
+            # A bus starting a new trip before being seen at the last stop of its previous trip went through that last stop
+            previous_stops = get_trip_stops(static, previous["trip"])
+            if previous["position"] == len(previous_stops["stop_sequence"]) - 1:
+                stop_code = previous_stops["stop"][previous["position"]]
+                stop_point = [stop_x[stop_code], stop_y[stop_code]] if stop_code >= 0 else [np.nan, np.nan]
+                points = np.array([[previous["x"], previous["y"]], stop_point, [x, y]])
+                add_event(previous["trip_id"], previous["route"], bus["id"], previous_stops, previous["position"], get_passage_times(points, previous["time"], report_time)[0], 2)
+
+        # A bus within arrival_radius_meters of its next stop arrived there when it came within that distance of the stop
+        distance = np.hypot(stop_points[position, 0] - x, stop_points[position, 1] - y)
+        if arrived is None and distance <= arrival_radius_meters:
+            arrival_time = report_time
+            if previous is not None and previous["trip"] == trip:
+                previous_distance = np.hypot(stop_points[position, 0] - previous["x"], stop_points[position, 1] - previous["y"])
+                if previous_distance > distance:
+                    fraction = min(max((previous_distance - arrival_radius_meters) / (previous_distance - distance), 0), 1)
+                    arrival_time = previous["time"] + (report_time - previous["time"]) * fraction
+            add_event(bus["trip_id"], bus["route"], bus["id"], trip_stops, position, arrival_time, 0)
+            arrived = position
+        seen[bus["id"]] = {"trip": trip, "trip_id": bus["trip_id"], "route": bus["route"], "position": position, "arrived": arrived, "time": report_time, "x": x, "y": y}
+
+    detector["last_seen"] = seen
+    if not events:
+        return 0
+    os.makedirs(events_dir, exist_ok=True)
+    events_file, names_file = get_event_files(service_date)
+    records = np.zeros(len(events), dtype=event_dtype)
+    for record, (event_time, trip_id, route_id, vehicle, stop_id, stop_sequence, delay, kind) in zip(records, events):
+        record["time"] = event_time
+        record["trip"] = get_name_index(trip_id, names_file)
+        record["route"] = get_name_index(route_id, names_file)
+        record["vehicle"] = get_name_index(vehicle, names_file)
+        record["stop_id"] = stop_id
+        record["stop_sequence"] = stop_sequence
+        record["delay"] = delay
+        record["kind"] = kind
+    with open(events_file, "ab") as f:
+        f.write(records.tobytes())
+    detector["written"] += len(events)
+    return len(events)
+
+# Detects the events of the latest realtime snapshot if it hasn't been processed yet.
+# Only one process should call this: the data plane refresher when it is running, or the website itself otherwise
+def update_from_snapshot():
+    with detector_lock:
+        signature = data_plane.get_realtime_signature()
+        if signature == detector["signature"]:
+            return 0
+        detector["signature"] = signature
+        buses = data_plane.load_realtime("bus_updates")
+        current_trips = data_plane.load_realtime("trip_updates")
+        if buses is None:
+            buses = on_time.read_json(os.path.join("data", "bus_updates.json"))
+            current_trips = on_time.read_json(os.path.join("data", "trip_updates.json"))
+        return process_snapshot(buses, current_trips, datetime.now(ZoneInfo(on_time.service_timezone)))
+
+# Returns every event of a service day as a dataframe sorted by time, with the trip_id, route_id and vehicle id of every event
+def load_events(service_date):
+    events_file = get_event_files(service_date)[0]
+    try:
+        size = os.path.getsize(events_file)
+    except OSError:
+        size = 0
+    # A record being appended while the file is read is left out
+    records = np.fromfile(events_file, dtype=event_dtype, count=size // event_dtype.itemsize) if size else np.zeros(0, dtype=event_dtype)
+    names = np.array(load_names(service_date) or [""], dtype=object)
+    events_df = pd.DataFrame({
+        "time": records["time"].astype(np.int64),
+        "trip_id": names[records["trip"]],
+        "route_id": names[records["route"]],
+        "vehicle": names[records["vehicle"]],
+        "stop_id": records["stop_id"],
+        "stop_sequence": records["stop_sequence"],
+        "delay": records["delay"],
+        "kind": np.array(event_kinds, dtype=object)[records["kind"]],
+    })
+    return events_df.sort_values("time", kind="stable").reset_index(drop=True)
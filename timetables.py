@@ -0,0 +1,225 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import data_plane
+
+# Prebuilt scheduled timetables of every stop for every service day of the static data.
+# The scheduled arrivals at a stop on a service day never change until a new static feed is published, so after every static
+# ingest they are written once as one small gzipped json file per stop and service day in data/timetables/<version>, and served
+# as is with long cache headers so that browsers and CDNs can answer most schedule requests without reaching the website. Service
+# days running the same service ids have the same timetables, so every distinct set of service ids is only written once and days.json
+# gives the set of every date. The timetables of a set are gathered for every stop at once from the stop index, and the json of every
+# stop is encoded and compressed in parallel by a process pool. The build runs in its own python process started by the data plane
+# refresher (or by running this script) so the website keeps serving while it runs, and a version directory is only renamed into
+# place once all its files have been written. Most stops aren't served at all by most sets of service ids, so only the timetables
+# with stop times are written, and an empty timetable or one which hasn't been built yet is computed on the spot instead.
+# The url of a timetable doesn't change with the static data, so a written timetable is only cached for cache_seconds with its version
+# as ETag, after which browsers and CDNs check whether it changed, and a timetable computed on the spot isn't cached at all.
+
+timetables_dir = os.environ.get("TIMETABLES_DIR", os.path.join("data", "timetables"))
+
+# Number of stops written by every task of the process pool, number of versions kept on disk, and how long browsers and CDNs may
+# keep a written timetable before checking whether its version changed
+stops_per_task = 200
+kept_versions = 2
+cache_seconds = 300
+
+# Columns of every timetable. arrival and departure are in seconds since the start of the service day
+timetable_columns = ["trip_id", "route_number", "trip_headsign", "block_id", "stop_sequence", "arrival", "departure"]
+
+# The process building the timetables started by the data plane refresher, the timetables version it should build or None once built,
+# how many builds in a row failed, and when the next build is started or None if none is waiting
+build_process = {"process": None, "version": None, "failures": 0, "retry_at": None}
+
+# Delay before starting a failed build again, doubled after every failure in a row up to max_build_retry_seconds
+build_retry_seconds = 60
+max_build_retry_seconds = 3600
+
+# Returns the name of the timetables version of a static version, which only changes when the static csv files change
+def get_timetable_version(static):
+    return hashlib.sha256(json.dumps(static["manifest"]["signature"]).encode()).hexdigest()[:16]
+
+# Returns the sorted service ids running on every date of calendar_dates e.g. {"20260901": [4528, 5222], ...}
+def get_service_days(static):
+    def build():
+        calendar_dates = static["tables"]["calendar_dates"]
+        service_days = {}
+        for service_date, service_id in zip(np.asarray(calendar_dates["date"]).astype(str), np.asarray(calendar_dates["service_id"]).astype(np.int64)):
+            service_days.setdefault(service_date, set()).add(int(service_id))
+        return {service_date: sorted(service_ids) for service_date, service_ids in service_days.items()}
+
+    return data_plane.get_cached(static, "service_days", build)
+
+# Returns the name of the directory of the timetables of a set of service ids e.g. 4528-5222
+def get_day_key(service_ids):
+    return "-".join(str(service_id) for service_id in service_ids) or "none"
+
+# Returns the scheduled stop times of several stops on a service day, sorted by stop and then arrival time
+# ----------------------------------------------------------------------------------
+# static is the static data returned by data_plane.get_static()
+# service_ids is the list of service ids running that day
+# stop_ids is a numpy array of stop ids
+# Returns a dictionary with the stop_id and the timetable_columns of every stop time as numpy arrays
+# ----------------------------------------------------------------------------------
+def build_day_columns(static, service_ids, stop_ids):
+    trips = static["tables"]["trips"]
+    trip, positions = data_plane.get_stop_trip_positions(static, stop_ids)
+    trip = trip.astype(np.int64)
+    keep = np.isin(np.asarray(trips["service_id"])[trip], np.asarray(service_ids, dtype=np.int64))
+    trip = trip[keep]
+    positions = positions[keep]
+
+    def get_values(column):
+        return data_plane.get_stop_time_values(static["tables"], trip, positions, column)
+
+    return {
+        "stop_id": get_values("stop_id").astype(np.int64),
+        "trip_id": data_plane.decode_ids(static, "trip", trip),
+        "route_number": pd.Series(np.asarray(trips["route_id"])[trip]).astype(str).str.split("-").str[0].to_numpy(),
+        "trip_headsign": np.asarray(trips["trip_headsign"])[trip].astype(str),
+        "block_id": np.asarray(trips["block_id"])[trip].astype(np.int64),
+        "stop_sequence": get_values("stop_sequence").astype(np.int64),
+        "arrival": get_values("arrival").astype(np.int64),
+        "departure": get_values("departure").astype(np.int64),
+    }
+
+# Returns the gzipped json timetable of one stop
+# ----------------------------------------------------------------------------------
+# columns is the dictionary returned by build_day_columns, or part of it, containing every stop time of the stop
+# stop_id is the stop id
+# service_ids is the list of service ids running that day
+# version is the timetables version
+# ----------------------------------------------------------------------------------
+def encode_timetable(columns, stop_id, service_ids, version):
+    first, last = np.searchsorted(columns["stop_id"], [stop_id, stop_id + 1])
+    timetable = {"stop_id": int(stop_id), "service_ids": list(service_ids), "version": version}
+    timetable.update({column: columns[column][first:last].tolist() for column in timetable_columns})
+    return gzip.compress(json.dumps(timetable, separators=(",", ":")).encode(), compresslevel=9, mtime=0)
+
+# Writes the timetables of some stops to the directory of a set of service ids, skipping the stops with no stop times. Run by the
+# tasks of the process pool
+def write_stop_timetables(day_dir, stop_ids, columns, service_ids, version):
+    for stop_id in np.intersect1d(stop_ids, columns["stop_id"]):
+        with open(os.path.join(day_dir, f"{stop_id}.json.gz"), "wb") as f:
+            f.write(encode_timetable(columns, stop_id, service_ids, version))
+
+# Writes the timetables of every stop and service day of the active static version, unless they have already been written
+# ----------------------------------------------------------------------------------
+# workers is the number of processes of the process pool, or the number of cpus if it isn't given
+# Returns the timetables version, or None if it had already been written
+# ----------------------------------------------------------------------------------
+def build_timetables(workers=None):
+    static = data_plane.get_static()
+    version = get_timetable_version(static)
+    version_dir = os.path.join(timetables_dir, version)
+    if os.path.isdir(version_dir):
+        return None
+    temp_dir = f"{version_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    stop_ids = np.unique(np.asarray(static["tables"]["stops"]["stop_id"]).astype(np.int64))
+    service_days = get_service_days(static)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            tasks = []
+            for service_ids in {tuple(service_ids) for service_ids in service_days.values()}:
+                day_dir = os.path.join(temp_dir, get_day_key(service_ids))
+                os.makedirs(day_dir)
+                columns = build_day_columns(static, service_ids, stop_ids)
+                for first in range(0, len(stop_ids), stops_per_task):
+                    task_stop_ids = stop_ids[first:first + stops_per_task]
+                    first_row, last_row = np.searchsorted(columns["stop_id"], [task_stop_ids[0], task_stop_ids[-1] + 1])
+                    task_columns = {column: values[first_row:last_row] for column, values in columns.items()}
+                    tasks.append(pool.submit(write_stop_timetables, day_dir, task_stop_ids, task_columns, list(service_ids), version))
+            for task in tasks:
+                task.result()
+        with open(os.path.join(temp_dir, "days.json"), "w") as f:
+            json.dump({service_date: get_day_key(service_ids) for service_date, service_ids in service_days.items()}, f)
+        os.replace(temp_dir, version_dir)
+    except Exception:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    versions = sorted((d for d in os.listdir(timetables_dir) if not d.endswith(".tmp")), key=lambda d: os.path.getmtime(os.path.join(timetables_dir, d)))
+    for old_version in versions[:-kept_versions]:
+        shutil.rmtree(os.path.join(timetables_dir, old_version), ignore_errors=True)
+    return version
+
+# Starts building the timetables of the active static version in a new python process unless they have already been written. Called by
+# the data plane refresher when it starts and after every new static version it publishes, which can't start a process pool itself since
+# it runs as a daemon process. A build already running for an older version is left to finish, and check_build starts this one after it
+def start_build():
+    version = get_timetable_version(data_plane.get_static())
+    build_process["failures"] = 0
+    if os.path.isdir(os.path.join(timetables_dir, version)):
+        build_process["version"] = None
+        build_process["retry_at"] = None
+        return
+    build_process["version"] = version
+    build_process["retry_at"] = time.monotonic()
+    check_build()
+
+# Checks the build started by start_build. Called by the data plane refresher every second, so a build that exits with an error is
+# started again after build_retry_seconds, then twice as long after every failure in a row
+def check_build():
+    process = build_process["process"]
+    if process is not None:
+        return_code = process.poll()
+        if return_code is None:
+            return
+        build_process["process"] = None
+        if return_code != 0:
+            build_process["failures"] += 1
+            delay = min(build_retry_seconds * 2 ** (build_process["failures"] - 1), max_build_retry_seconds)
+            build_process["retry_at"] = time.monotonic() + delay
+            print(f"Error building timetables {build_process['version']}: exit code {return_code}, retrying in {delay} s", flush=True)
+        elif build_process["retry_at"] is None:
+            build_process["version"] = None
+            build_process["failures"] = 0
+    if build_process["version"] is not None and build_process["retry_at"] is not None and time.monotonic() >= build_process["retry_at"]:
+        build_process["process"] = subprocess.Popen([sys.executable, os.path.abspath(__file__)])
+        build_process["retry_at"] = None
+
+# Returns the gzipped json timetable of a stop on a service day along with its timetables version, or None as the version if it was
+# computed on the spot because it hasn't been written. Returns None, None if the stop or the service day is unknown
+# ----------------------------------------------------------------------------------
+# service_date is the date of the service day e.g. 20260901
+# stop_id is the stop id e.g. 100032
+# ----------------------------------------------------------------------------------
+def get_timetable(service_date, stop_id):
+    static = data_plane.get_static()
+    service_ids = get_service_days(static).get(service_date)
+    if service_ids is None or not np.isin(stop_id, np.asarray(static["tables"]["stops"]["stop_id"])):
+        return None, None
+    version = get_timetable_version(static)
+    try:
+        with open(os.path.join(timetables_dir, version, get_day_key(service_ids), f"{stop_id}.json.gz"), "rb") as f:
+            return f.read(), version
+    except OSError:
+        # The stop isn't served that day or the timetables of this static version haven't been built yet
+        return encode_timetable(build_day_columns(static, service_ids, np.array([stop_id])), stop_id, service_ids, version), None
+
+def main():
+    parser = argparse.ArgumentParser(description="Write the scheduled timetables of every stop for every service day of the static data")
+    parser.add_argument("--workers", type=int, help="number of processes writing the timetables, the number of cpus by default")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    version = build_timetables(args.workers)
+    if version is None:
+        print("Timetables are already up-to-date", flush=True)
+    else:
+        print(f"Timetables {version} written in {time.perf_counter() - start:.1f} s", flush=True)
+
+if __name__ == "__main__":
+    main()